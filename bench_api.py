@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+SIPS API - Benchmark de throughput de GET /sips/<cups>
+=======================================================
+Lanza peticiones concurrentes contra una o varias APIs ya arrancadas y
+mide peticiones por segundo y latencias (p50, p95, p99). Sirve para
+comparar el servidor de desarrollo (app.run) con gunicorn:
+
+    python3 sips_api_crm.py                                  # puerto 5000
+    API_PORT=5001 gunicorn -c gunicorn.conf.py               # puerto 5001
+    python3 bench_api.py --cups-file cups.txt \\
+        --url http://localhost:5000 --url http://localhost:5001
+
+Por defecto las peticiones llevan save=false para no llenar CouchDB. Con
+la caché de resultados activa (SIPS_RESULT_CACHE) la ruta caliente no toca
+MySQL; para medir el camino completo arranca la API con
+SIPS_RESULT_CACHE=false.
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import sys
+import time
+import argparse
+import threading
+from typing import Any, Dict, List
+
+import requests
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentil (nearest-rank) de una lista ya ordenada"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+
+def run_benchmark(
+    url: str,
+    cups_list: List[str],
+    concurrency: int,
+    duration: float,
+    params: Dict[str, str],
+    timeout: float = 30
+) -> Dict[str, Any]:
+    """
+    `concurrency` hilos piden GET {url}/sips/<cups> en bucle durante
+    `duration` segundos (cada hilo con su sesión keep-alive)
+
+    Returns:
+        Peticiones, errores, req/s y latencias en ms
+    """
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(offset: int):
+        nonlocal errors
+        session = requests.Session()
+        local_latencies = []
+        local_errors = 0
+        i = offset
+        while time.perf_counter() < deadline:
+            cups = cups_list[i % len(cups_list)]
+            i += concurrency
+            start = time.perf_counter()
+            try:
+                response = session.get(f"{url}/sips/{cups}", params=params, timeout=timeout)
+                ok = response.status_code in (200, 404)
+            except requests.RequestException:
+                ok = False
+            local_latencies.append(time.perf_counter() - start)
+            if not ok:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'url': url,
+        'requests': len(latencies),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 2),
+        'req_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def read_cups(path: str) -> List[str]:
+    """CUPS del fichero (uno por línea, se ignora lo que vaya tras una coma)"""
+    with open(path, encoding='utf-8') as f:
+        return [line.split(',')[0].strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Benchmark de GET /sips/<cups> contra una o varias APIs')
+    parser.add_argument('--url', action='append', required=True, help='URL base de la API (repetible)')
+    parser.add_argument('--cups', action='append', default=[], help='CUPS a consultar (repetible)')
+    parser.add_argument('--cups-file', help='Fichero con un CUPS por línea')
+    parser.add_argument('--concurrency', type=int, default=16, help='Peticiones simultáneas')
+    parser.add_argument('--duration', type=float, default=20, help='Segundos por URL')
+    parser.add_argument('--warmup', type=float, default=2, help='Segundos de calentamiento por URL')
+    parser.add_argument('--save', action='store_true', help='Guardar en CouchDB (por defecto save=false)')
+    args = parser.parse_args(argv)
+
+    cups_list = args.cups + (read_cups(args.cups_file) if args.cups_file else [])
+    if not cups_list:
+        parser.error('Indica --cups o --cups-file')
+
+    params = {'save': 'true' if args.save else 'false'}
+
+    print(f"\n{'='*60}")
+    print(f"⏱️  BENCHMARK GET /sips/<cups>")
+    print(f"{'='*60}")
+    print(f"CUPS distintos: {len(cups_list)}")
+    print(f"Concurrencia: {args.concurrency}")
+    print(f"Duración: {args.duration} s por URL (+{args.warmup} s de calentamiento)")
+    print(f"{'='*60}\n")
+
+    results = []
+    for url in args.url:
+        url = url.rstrip('/')
+        if args.warmup:
+            run_benchmark(url, cups_list, args.concurrency, args.warmup, params)
+        result = run_benchmark(url, cups_list, args.concurrency, args.duration, params)
+        results.append(result)
+        print(f"✅ {url}: {result['req_per_s']} req/s "
+              f"(p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, "
+              f"{result['errors']} errores de {result['requests']})")
+
+    if len(results) > 1 and results[0]['req_per_s']:
+        print()
+        for result in results[1:]:
+            print(f"📈 {result['url']} vs {results[0]['url']}: "
+                  f"x{result['req_per_s'] / results[0]['req_per_s']:.2f}")
+
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
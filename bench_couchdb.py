@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+SIPS Client - Benchmark de escritura en CouchDB
+================================================
+Compara el guardado documento a documento (save_to_couchdb, un POST por
+CUPS) con el escritor bulk (queue_to_couchdb + _bulk_docs) usando
+documentos SIPS sintéticos sobre una base de datos de pruebas.
+
+Uso:
+    python3 bench_couchdb.py --docs 1000 --bulk-size 100
+
+Autor: Aenergetic
+Fecha: 2026-10-16
+"""
+
+import os
+import io
+import time
+import argparse
+import contextlib
+from datetime import datetime, timedelta
+
+import requests
+
+from sips_client_crm import SIPSClient
+
+
+def make_sips_data(index: int, records: int):
+    """Genera datos SIPS sintéticos con `records` filas de demanda"""
+    start = datetime(2025, 1, 1)
+    periods = ['P1', 'P2', 'P3', 'P4', 'P5', 'P6']
+    demand_data = [
+        {
+            'fecha': (start + timedelta(days=i)).isoformat(),
+            'periodo': periods[i % 6],
+            'consumo_kwh': 100.0 + i % 50,
+            'potencia_maxima': 10.0 + i % 7,
+        }
+        for i in range(records)
+    ]
+    return {
+        'cups': f"ES00BENCH{index:011d}0F",
+        'current_powers': {p: 15.0 for p in periods},
+        'demand_data': demand_data,
+        'periods': periods,
+        'records_found': records,
+    }
+
+
+def run_single(client: SIPSClient, dataset):
+    """Un POST por documento (camino actual)"""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok = sum(1 for sips_data in dataset if client.save_to_couchdb(sips_data))
+    return ok, len(dataset), time.perf_counter() - start
+
+
+def run_bulk(client: SIPSClient, dataset):
+    """Documentos encolados y enviados con _bulk_docs"""
+    start = time.perf_counter()
+    futures = [client.queue_to_couchdb(sips_data) for sips_data in dataset]
+    client.flush_couchdb()
+    ok = sum(1 for future in futures if future.result()['ok'])
+    requests_made = client.get_couch_writer().stats()['requests']
+    return ok, requests_made, time.perf_counter() - start
+
+
+def main():
+    """Ejecuta el benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmark de escritura SIPS en CouchDB')
+    parser.add_argument('--docs', type=int, default=1000, help='Documentos por prueba (default: 1000)')
+    parser.add_argument('--records', type=int, default=365, help='Filas de demand_data por documento')
+    parser.add_argument('--bulk-size', type=int, default=100, help='Documentos por _bulk_docs')
+    parser.add_argument('--database', default=os.getenv('COUCHDB_BENCH_DATABASE', 'sips_history_bench'),
+                        help='Base de datos de pruebas (se crea y se borra)')
+    parser.add_argument('--keep', action='store_true', help='No borrar la base de datos al terminar')
+    args = parser.parse_args()
+
+    client = SIPSClient()
+    client.couchdb_db = args.database
+    client.couch_bulk_size = args.bulk_size
+
+    db_url = f"{client.couchdb_url}/{args.database}"
+    auth = (client.couchdb_user, client.couchdb_password)
+    requests.put(db_url, auth=auth, timeout=10)
+
+    dataset = [make_sips_data(i, args.records) for i in range(args.docs)]
+
+    print("\n" + "="*60)
+    print("⏱️  BENCHMARK COUCHDB")
+    print("="*60)
+    print(f"URL: {db_url}")
+    print(f"Documentos: {args.docs} ({args.records} filas cada uno)")
+    print(f"Bulk size: {args.bulk_size}")
+    print("="*60 + "\n")
+
+    try:
+        for name, runner in (('POST individual', run_single), ('_bulk_docs', run_bulk)):
+            ok, http_calls, elapsed = runner(client, dataset)
+            print(f"{name}:")
+            print(f"   - Guardados: {ok}/{args.docs}")
+            print(f"   - Peticiones HTTP: {http_calls}")
+            print(f"   - Tiempo: {elapsed:.2f} s")
+            print(f"   - Throughput: {args.docs / elapsed:.1f} docs/s\n")
+    finally:
+        if not args.keep:
+            requests.delete(db_url, auth=auth, timeout=10)
+
+
+if __name__ == '__main__':
+    main()
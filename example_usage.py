@@ -4,10 +4,14 @@ Ejemplo de uso del SIPS Client
 """
 
 from sips_client import SIPSClient
+from sips_logging import setup_logging
 
 def main():
     """Ejemplo básico de uso"""
     
+    # Salida del cliente en la consola, como en la CLI
+    setup_logging('cli')
+    
     # Crear cliente (usa variables de entorno del .env)
     client = SIPSClient()
     
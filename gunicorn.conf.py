@@ -0,0 +1,117 @@
+"""
+SIPS API - Configuración de producción (gunicorn)
+==================================================
+app.run() es el servidor de desarrollo de Flask: un solo proceso. En
+producción la API se sirve con gunicorn, varios procesos (workers) con
+varios hilos cada uno:
+
+    gunicorn -c gunicorn.conf.py                               # sips_api_crm:app
+    SIPS_API_APP=sips_api:app gunicorn -c gunicorn.conf.py     # versión IGNIS
+
+Cada worker importa la API y crea su propio SIPSClient (pool MySQL, sesión
+CouchDB, hilos) después del fork; no se comparte nada entre procesos. Las
+conexiones MySQL abiertas son GUNICORN_WORKERS x CRM_DB_POOL_SIZE.
+
+El ejecutor de trabajos (sips_jobs) y el spool de CouchDB (sips_spool) solo
+corren en el worker que obtiene su lock; si ese worker termina, otro lo
+recoge en SIPS_LEADER_RETRY segundos.
+
+Recarga sin cortar peticiones (código, .env y esta configuración):
+
+    kill -HUP $(cat gunicorn.pid)
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import os
+import sys
+import threading
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass  # dotenv no instalado, usar variables de sistema
+
+wsgi_app = os.getenv('SIPS_API_APP', 'sips_api_crm:app')
+
+bind = f"{os.getenv('API_HOST', '0.0.0.0')}:{os.getenv('API_PORT', 5000)}"
+
+# Workers con hilos: las peticiones esperan sobre todo a MySQL y CouchDB
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', max(2, min(os.cpu_count() or 1, 4))))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# /sips/batch puede tardar; graceful_timeout es lo que se espera en una recarga
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Reciclar workers cada N peticiones (0 = nunca)
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+# Sin preload: cada worker crea sus conexiones después del fork
+preload_app = False
+
+pidfile = os.getenv('GUNICORN_PIDFILE', 'gunicorn.pid')
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+LEADER_RETRY = float(os.getenv('SIPS_LEADER_RETRY', 5))
+
+
+def _api_module(worker):
+    """Módulo de la API que sirve este worker (sips_api_crm o sips_api)"""
+    return sys.modules[worker.wsgi.import_name]
+
+
+def _claim_background_work(api, stop: threading.Event):
+    """
+    Intenta cada LEADER_RETRY segundos obtener el lock de los trabajos y del
+    spool hasta conseguirlos (p. ej. cuando termina el worker que los tenía)
+    """
+    while not stop.is_set():
+        client = api.get_client()
+        jobs_ready = api.get_job_manager().start()
+        spool_ready = not client.couch_write_behind or client.get_couch_spool().start()
+        if jobs_ready and spool_ready:
+            return
+        stop.wait(LEADER_RETRY)
+
+
+def post_worker_init(worker):
+    """Inicializa el SIPSClient del worker y el trabajo en segundo plano"""
+    api = _api_module(worker)
+    api.get_client()
+
+    worker.sips_stop = threading.Event()
+    threading.Thread(
+        target=_claim_background_work,
+        args=(api, worker.sips_stop),
+        name='sips-leader',
+        daemon=True
+    ).start()
+
+    worker.log.info("SIPS API lista en el worker %s", worker.pid)
+
+
+def worker_exit(server, worker):
+    """Cierre ordenado: detiene trabajos, vacía el spool y cierra conexiones"""
+    stop = getattr(worker, 'sips_stop', None)
+    if stop is not None:
+        stop.set()
+
+    api = sys.modules.get(getattr(worker.wsgi, 'import_name', None))
+    if api is None:
+        return
+
+    if api.job_manager is not None:
+        api.job_manager.stop()
+
+    client = api.sips_client
+    if client is not None:
+        client.close_couch_spool()
+        client.flush_couchdb()
+        client.disconnect_db()
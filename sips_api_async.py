@@ -0,0 +1,713 @@
+#!/usr/bin/env python3
+"""
+SIPS API - Versión ASGI (asyncio) de la API del CRM
+====================================================
+Mismos endpoints y respuestas que sips_api_crm.py, servidos con Quart
+sobre AsyncSIPSClient (aiomysql + httpx). Cada petición es una corrutina:
+mientras espera a MySQL o a CouchDB el proceso atiende otras, así un solo
+proceso sostiene cientos de llamadas simultáneas de n8n.
+
+Endpoints:
+    GET  /sips/<cups>                - Obtener histórico SIPS
+    GET  /sips/<cups>/summary        - Resumen por periodo y mes (sin demand_data)
+    POST /sips                       - Obtener histórico SIPS (body JSON)
+    POST /sips/batch                 - Procesar múltiples CUPS (JSON o NDJSON)
+    GET  /health                     - Health check
+    GET  /cache/stats                - Estadísticas de la caché en memoria
+    POST /cache/invalidate           - Invalidar caché (un CUPS o entera)
+    GET  /metrics                    - Métricas en formato Prometheus
+
+Los trabajos asíncronos (/sips/jobs) siguen en sips_api_crm.py.
+
+Uso:
+    python3 sips_api_async.py
+    hypercorn sips_api_async:app --bind 0.0.0.0:5000
+
+Requiere: pip install quart aiomysql httpx
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from quart import Quart, Response, g, request, jsonify
+
+from sips_client_async import AsyncSIPSClient
+from sips_result_cache import result_cache_from_env
+from sips_columnar import HAS_NUMPY, to_columnar
+from sips_metrics import (
+    REGISTRY, CONTENT_TYPE, StageTimings, collect_timings, stop_timings, stage,
+    observe_batch, register_client_gauges, request_started, request_finished
+)
+from sips_logging import get_logger, setup_logging
+from sips_batch import (
+    failed_item, to_ndjson, OK, ERROR, TIMEOUT,
+    DEFAULT_MAX_PARALLEL, DEFAULT_ITEM_TIMEOUT, DEFAULT_BATCH_TIMEOUT
+)
+
+try:
+    from quart_cors import cors
+except ImportError:
+    cors = None
+
+app = Quart(__name__)
+if cors is not None:
+    app = cors(app, allow_origin='*')  # Habilitar CORS para llamadas desde n8n
+
+# Logs JSON a través de una cola (sin bloquear el event loop); el detalle por
+# petición solo con LOG_LEVEL=DEBUG
+setup_logging('api')
+logger = get_logger(__name__)
+
+# CUPS por ventana en /sips/batch con streaming NDJSON
+STREAM_WINDOW = int(os.getenv('SIPS_BATCH_STREAM_WINDOW', 500))
+
+# Cliente global (uno por proceso, compartido por todas las corrutinas)
+sips_client: Optional[AsyncSIPSClient] = None
+
+# Pool y cachés del cliente en /metrics
+register_client_gauges(lambda: sips_client)
+
+
+async def get_client() -> AsyncSIPSClient:
+    """Obtiene o crea el cliente SIPS"""
+    global sips_client
+    if sips_client is None:
+        client = AsyncSIPSClient(result_cache=result_cache_from_env())
+        await client.connect_db()
+        if client.couch_read_max_age:
+            # Índice Mango para servir lecturas desde CouchDB
+            await client.ensure_couch_index()
+        sips_client = client
+    return sips_client
+
+
+@app.before_serving
+async def startup():
+    """Crea el cliente (pool MySQL y CouchDB) al arrancar el servidor"""
+    await get_client()
+
+
+@app.after_serving
+async def shutdown():
+    """Cierra las conexiones al parar el servidor"""
+    if sips_client is not None:
+        await sips_client.close()
+
+
+@app.before_request
+async def start_request_metrics():
+    """Peticiones en curso y duración por endpoint (ver sips_metrics)"""
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_start = request_started(g.metrics_endpoint)
+    # Desglose por etapa de esta petición (cabecera Server-Timing)
+    g.stage_timings = collect_timings()
+
+
+@app.after_request
+async def finish_request_metrics(response):
+    if 'stage_timings' in g:
+        response.headers['Server-Timing'] = g.stage_timings.server_timing()
+    if 'metrics_start' in g:
+        started = g.pop('metrics_start')
+        request_finished(g.metrics_endpoint, request.method, response.status_code, started)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "%s %s %s", request.method, request.path, response.status_code,
+                extra={
+                    'endpoint': g.metrics_endpoint,
+                    'status': response.status_code,
+                    'duration_ms': round((time.perf_counter() - started) * 1000, 3)
+                }
+            )
+    return response
+
+
+@app.teardown_request
+async def abort_request_metrics(error):
+    stop_timings()
+    # Excepción sin respuesta: after_request no ha llegado a ejecutarse
+    if 'metrics_start' in g:
+        request_finished(g.metrics_endpoint, request.method, 500, g.pop('metrics_start'))
+
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    """Health check endpoint"""
+    return jsonify({
+        'status': 'ok',
+        'service': 'SIPS API (CRM version, asyncio)',
+        'timestamp': datetime.now().isoformat(),
+        'version': '1.0.0',
+        'db_pool': sips_client.pool_stats() if sips_client else {'connected': False}
+    })
+
+
+def format_result(sips_data: Dict[str, Any], output_format: Optional[str]) -> Dict[str, Any]:
+    """Aplica el formato de salida pedido (?format=columnar) a un resultado"""
+    if output_format == 'columnar':
+        return to_columnar(sips_data)
+    return sips_data
+
+
+def wants_timings(data: Optional[Dict[str, Any]] = None) -> bool:
+    """?timings=true (o "timings": true en el body): incluir el desglose por etapa en el JSON"""
+    if request.args.get('timings', default='false').lower() == 'true':
+        return True
+    return isinstance(data, dict) and data.get('timings') is True
+
+
+def timed_json(payload: Dict[str, Any], status: int = 200, include_timings: bool = False):
+    """jsonify() medido como la etapa serialize, con "timings" si se pide (ver sips_api_crm)"""
+    timings = g.get('stage_timings')
+    if include_timings and timings is not None:
+        payload = {**payload, 'timings': timings.as_dict()}
+    with stage('serialize'):
+        response = jsonify(payload)
+    return response, status
+
+
+def check_format(output_format: Optional[str]):
+    """Valida el formato de salida: (respuesta de error, código) o None"""
+    if output_format not in (None, 'json', 'columnar'):
+        return jsonify({
+            'error': f"Formato no soportado: {output_format}",
+            'formats': ['json', 'columnar']
+        }), 400
+    if output_format == 'columnar' and not HAS_NUMPY:
+        return jsonify({
+            'error': 'format=columnar requiere NumPy (pip install numpy)'
+        }), 501
+    return None
+
+
+def check_timeouts(data: Dict[str, Any], *keys: str):
+    """
+    Valida los plazos del body (item_timeout, batch_timeout): (respuesta de
+    error, código) o None. Deben ser un número de segundos mayor que 0.
+    """
+    for key in keys:
+        if key not in data:
+            continue
+        value = data[key]
+        try:
+            seconds = None if isinstance(value, bool) else float(value)
+        except (TypeError, ValueError):
+            seconds = None
+        # Descarta también NaN e infinito
+        if seconds is None or not 0 < seconds < float('inf'):
+            return jsonify({
+                'error': f"{key} debe ser un número de segundos mayor que 0"
+            }), 400
+    return None
+
+
+def check_max_parallel(data: Dict[str, Any]):
+    """
+    Valida max_parallel del body: (respuesta de error, código) o None. Debe
+    ser un entero mayor que 0.
+    """
+    if 'max_parallel' not in data:
+        return None
+    value = data['max_parallel']
+    try:
+        parallel = None if isinstance(value, (bool, float)) else int(value)
+    except (TypeError, ValueError):
+        parallel = None
+    if parallel is None or parallel < 1:
+        return jsonify({
+            'error': 'max_parallel debe ser un entero mayor que 0'
+        }), 400
+    return None
+
+
+async def sips_response(
+    cups: str,
+    invoice_id: Optional[int],
+    output_format: Optional[str],
+    optimize_p6: bool,
+    save_to_couch: bool,
+    include_timings: bool = False
+):
+    """Consulta un CUPS y construye la respuesta de GET y POST /sips"""
+    if not cups or len(cups) < 10:
+        return jsonify({
+            'error': 'CUPS inválido',
+            'cups': cups
+        }), 400
+
+    format_error = check_format(output_format)
+    if format_error:
+        return format_error
+
+    client = await get_client()
+    sips_data = await client.get_sips_history(
+        cups=cups,
+        invoice_id=invoice_id,
+        optimize_p6=optimize_p6,
+        save_to_couch=save_to_couch
+    )
+
+    if sips_data:
+        return timed_json({
+            'success': True,
+            'data': format_result(sips_data, output_format),
+            'saved_to_couchdb': save_to_couch
+        }, 200, include_timings)
+
+    return timed_json({
+        'success': False,
+        'error': 'No se encontraron datos SIPS en la caché',
+        'cups': cups
+    }, 404, include_timings)
+
+
+@app.route('/sips/<cups>', methods=['GET'])
+async def get_sips_by_cups(cups):
+    """
+    Obtener histórico SIPS por CUPS (método GET)
+
+    Query params: invoice_id, optimize_p6, save, format, timings (como sips_api_crm)
+    """
+    try:
+        return await sips_response(
+            cups,
+            request.args.get('invoice_id', type=int),
+            request.args.get('format'),
+            request.args.get('optimize_p6', default='false').lower() == 'true',
+            request.args.get('save', default='true').lower() == 'true',
+            wants_timings()
+        )
+    except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/sips/<cups>/summary', methods=['GET'])
+async def get_sips_summary(cups):
+    """
+    Resumen compacto por periodo y mes (sin demand_data)
+
+    Query params:
+        - months: Número de meses (default: 12)
+    """
+    try:
+        months = request.args.get('months', default=12, type=int)
+
+        if not cups or len(cups) < 10:
+            return jsonify({
+                'error': 'CUPS inválido',
+                'cups': cups
+            }), 400
+
+        summary = await (await get_client()).get_sips_summary(cups, months)
+
+        if summary:
+            return jsonify({
+                'success': True,
+                'data': summary
+            }), 200
+
+        return jsonify({
+            'success': False,
+            'error': 'No se encontraron datos para el CUPS',
+            'cups': cups
+        }), 404
+
+    except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/sips', methods=['POST'])
+async def get_sips_post():
+    """
+    Obtener histórico SIPS (método POST)
+
+    Body JSON: {"cups", "invoice_id", "optimize_p6", "save", "format", "timings"}
+    (como sips_api_crm)
+    """
+    try:
+        data = await request.get_json(silent=True)
+
+        if not data:
+            return jsonify({
+                'error': 'Body JSON vacío'
+            }), 400
+
+        return await sips_response(
+            data.get('cups'),
+            data.get('invoice_id'),
+            data.get('format'),
+            data.get('optimize_p6', False),
+            data.get('save', True),
+            wants_timings(data)
+        )
+    except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+async def process_batch_item(
+    client: AsyncSIPSClient,
+    item: Dict[str, Any],
+    options: Dict[str, Any],
+    prefetched: Optional[Dict[str, Any]] = None
+) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """Procesa un elemento del batch: (resultado, datos a guardar en CouchDB o None)"""
+    cups = item.get('cups')
+    invoice_id = item.get('invoice_id')
+
+    if not cups:
+        return {
+            'cups': None,
+            'success': False,
+            'error': 'CUPS vacío'
+        }, None
+
+    sips_data = await client.get_sips_history(
+        cups=cups,
+        invoice_id=invoice_id,
+        optimize_p6=options.get('optimize_p6', False),
+        save_to_couch=False,
+        prefetched=prefetched
+    )
+
+    return {
+        'cups': cups,
+        'invoice_id': invoice_id,
+        'success': sips_data is not None,
+        'records_found': sips_data.get('records_found', 0) if sips_data else 0,
+        **({'optimization': sips_data['optimization']} if sips_data and 'optimization' in sips_data else {}),
+        **({'data': sips_data} if sips_data and options.get('include_data') else {})
+    }, sips_data if sips_data and options['save'] else None
+
+
+async def iter_async_batch(
+    items: List[Any],
+    fn: Callable[[Any], Any],
+    max_parallel: int = DEFAULT_MAX_PARALLEL,
+    item_timeout: Optional[float] = DEFAULT_ITEM_TIMEOUT,
+    batch_timeout: Optional[float] = DEFAULT_BATCH_TIMEOUT
+) -> AsyncIterator[Tuple[int, str, Any]]:
+    """
+    Versión asyncio de sips_batch.iter_batch: como mucho `max_parallel`
+    elementos a la vez, produce (índice, estado, valor) según terminan
+
+    Como los hilos de iter_batch, un elemento que supera su plazo no se
+    cancela (su consulta termina en segundo plano), solo deja de esperarse.
+    Al vencer batch_timeout (o cerrarse el generador) se cancelan los que
+    siguen en cola, que ya no empiezan.
+    """
+    if not items:
+        return
+
+    semaphore = asyncio.Semaphore(max(1, max_parallel))
+
+    async def run(index: int, item: Any) -> Tuple[int, str, Any]:
+        async with semaphore:
+            task = asyncio.ensure_future(fn(item))
+            try:
+                return index, OK, await asyncio.wait_for(asyncio.shield(task), item_timeout)
+            except asyncio.TimeoutError:
+                return index, TIMEOUT, 'item_timeout'
+            except Exception as e:
+                return index, ERROR, str(e)
+
+    tasks = [asyncio.ensure_future(run(i, item)) for i, item in enumerate(items)]
+    finished = set()
+
+    def cancel_pending():
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=batch_timeout or None):
+            index, status, value = await next_done
+            finished.add(index)
+            yield index, status, value
+    except asyncio.TimeoutError:
+        # Antes de responder: lo que queda no debe seguir ocupando el semáforo
+        cancel_pending()
+        for index in range(len(items)):
+            if index not in finished:
+                yield index, TIMEOUT, 'batch_timeout'
+    finally:
+        cancel_pending()
+
+
+async def save_batch(
+    client: AsyncSIPSClient,
+    to_save: List[Tuple[int, Dict[str, Any], Optional[int]]]
+) -> List[Tuple[int, Dict[str, Any]]]:
+    """Guarda con un _bulk_docs los resultados del batch: [(índice, resultado CouchDB)]"""
+    if not to_save:
+        return []
+    results = await client.save_many_to_couchdb([(sips_data, invoice_id) for _, sips_data, invoice_id in to_save])
+    return [(index, result) for (index, _, _), result in zip(to_save, results)]
+
+
+async def stream_batch(
+    client: AsyncSIPSClient,
+    cups_list: List[Dict[str, Any]],
+    options: Dict[str, Any],
+    max_parallel: int,
+    item_timeout: Optional[float],
+    batch_timeout: Optional[float],
+    timings: Optional[StageTimings] = None
+) -> AsyncIterator[str]:
+    """
+    Genera el batch en NDJSON: una línea por CUPS según termina (con su
+    "index" en cups_list) y una línea final con "summary": true (y el
+    desglose por etapa en "timings" si se pasa `timings`)
+    """
+    # El cuerpo se genera después de la vista: volver a activar el desglose
+    if timings is not None:
+        collect_timings(timings)
+
+    start = time.monotonic()
+    saved = 0
+    couchdb_errors = []
+    timed_out = 0
+
+    for offset in range(0, len(cups_list), STREAM_WINDOW):
+        window = cups_list[offset:offset + STREAM_WINDOW]
+
+        remaining = None
+        if batch_timeout:
+            remaining = batch_timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                for index, item in enumerate(cups_list[offset:], offset):
+                    timed_out += 1
+                    yield to_ndjson({'index': index, **failed_item(item, TIMEOUT, 'batch_timeout')})
+                break
+
+        prefetched = await client.get_sips_from_cache_many(
+            [item.get('cups') for item in window]
+        ) if client.pool is not None else None
+
+        to_save = []
+        async for index, status, value in iter_async_batch(
+            window,
+            lambda item: process_batch_item(client, item, options, prefetched),
+            max_parallel=max_parallel,
+            item_timeout=item_timeout,
+            batch_timeout=remaining
+        ):
+            if status == OK:
+                result, sips_data = value
+                if sips_data is not None:
+                    to_save.append((offset + index, sips_data, window[index].get('invoice_id')))
+            else:
+                result = failed_item(window[index], status, value)
+                timed_out += result['timed_out']
+
+            yield to_ndjson({'index': offset + index, **result})
+
+        for index, couch_result in await save_batch(client, to_save):
+            if couch_result['ok']:
+                saved += 1
+            else:
+                couchdb_errors.append({
+                    'index': index,
+                    'error': couch_result.get('reason') or couch_result.get('error')
+                })
+
+    summary = {
+        'summary': True,
+        'success': True,
+        'processed': len(cups_list),
+        'timed_out': timed_out,
+        'saved_to_couchdb': saved,
+        'couchdb_errors': couchdb_errors,
+        'elapsed_ms': round((time.monotonic() - start) * 1000)
+    }
+    if timings is not None:
+        summary['timings'] = timings.as_dict()
+    yield to_ndjson(summary)
+
+
+@app.route('/sips/batch', methods=['POST'])
+async def get_sips_batch():
+    """
+    Procesar múltiples CUPS en batch (mismo body y respuesta que sips_api_crm)
+
+    Con la cabecera `Accept: application/x-ndjson` la respuesta se envía
+    en streaming: una línea JSON por CUPS según termina y una línea final
+    de resumen (con "timings" si se pide).
+    """
+    try:
+        data = await request.get_json(silent=True)
+
+        if not data or 'cups_list' not in data:
+            return jsonify({
+                'error': 'Falta cups_list en el body'
+            }), 400
+
+        option_error = check_max_parallel(data) or check_timeouts(data, 'item_timeout', 'batch_timeout')
+        if option_error:
+            return option_error
+
+        cups_list = data['cups_list']
+        observe_batch('/sips/batch', len(cups_list))
+        options = {
+            'save': data.get('save', True),
+            'include_data': data.get('include_data', False),
+            'optimize_p6': data.get('optimize_p6', False),
+        }
+
+        client = await get_client()
+        start = time.monotonic()
+
+        # Más corrutinas que conexiones del pool solo añadirían espera
+        max_parallel = max(1, min(int(data.get('max_parallel', DEFAULT_MAX_PARALLEL)), client.pool_size))
+        item_timeout = float(data.get('item_timeout', DEFAULT_ITEM_TIMEOUT))
+        batch_timeout = float(data.get('batch_timeout', DEFAULT_BATCH_TIMEOUT))
+
+        if 'application/x-ndjson' in request.headers.get('Accept', ''):
+            return Response(
+                stream_batch(
+                    client, cups_list, options, max_parallel, item_timeout, batch_timeout,
+                    g.stage_timings if wants_timings(data) else None
+                ),
+                mimetype='application/x-ndjson'
+            )
+
+        # Una query por bloque de CUPS en lugar de una por CUPS
+        prefetched = await client.get_sips_from_cache_many(
+            [item.get('cups') for item in cups_list]
+        ) if client.pool is not None else None
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(cups_list)
+        to_save = []
+        async for index, status, value in iter_async_batch(
+            cups_list,
+            lambda item: process_batch_item(client, item, options, prefetched),
+            max_parallel=max_parallel,
+            item_timeout=item_timeout,
+            batch_timeout=batch_timeout
+        ):
+            if status == OK:
+                results[index], sips_data = value
+                if sips_data is not None:
+                    to_save.append((index, sips_data, cups_list[index].get('invoice_id')))
+            else:
+                results[index] = failed_item(cups_list[index], status, value)
+
+        for index, couch_result in await save_batch(client, to_save):
+            results[index]['saved_to_couchdb'] = couch_result['ok']
+            if not couch_result['ok']:
+                results[index]['couchdb_error'] = couch_result.get('reason') or couch_result.get('error')
+
+        return timed_json({
+            'success': True,
+            'processed': len(results),
+            'timed_out': sum(1 for r in results if r.get('timed_out')),
+            'elapsed_ms': round((time.monotonic() - start) * 1000),
+            'results': results
+        }, 200, wants_timings(data))
+
+    except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/cache/stats', methods=['GET'])
+async def cache_stats():
+    """Estadísticas de la caché en memoria (SIPS_RESULT_CACHE)"""
+    client = await get_client()
+    return jsonify({
+        **client.cache_stats(),
+        'single_flight': client.inflight_stats(),
+        'couch_read': client.couch_read_stats(),
+        'negative': client.negative_cache_stats()
+    })
+
+
+@app.route('/cache/invalidate', methods=['POST'])
+async def cache_invalidate():
+    """
+    Invalidar la caché en memoria
+
+    Body JSON (opcional):
+        {"cups": "ES0031406091590001JF0F"}   // sin cups: vacía toda la caché
+    """
+    data = await request.get_json(silent=True) or {}
+    cups = data.get('cups')
+    removed = (await get_client()).invalidate_cache(cups)
+
+    return jsonify({
+        'success': True,
+        'cups': cups,
+        'invalidated': removed
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """Métricas en formato de texto de Prometheus (ver sips_metrics)"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+@app.errorhandler(404)
+async def not_found(error):
+    """Handler para rutas no encontradas"""
+    return jsonify({
+        'error': 'Endpoint no encontrado',
+        'available_endpoints': [
+            'GET  /health',
+            'GET  /sips/<cups>',
+            'GET  /sips/<cups>/summary',
+            'POST /sips',
+            'POST /sips/batch',
+            'GET  /cache/stats',
+            'POST /cache/invalidate',
+            'GET  /metrics'
+        ]
+    }), 404
+
+
+@app.errorhandler(500)
+async def internal_error(error):
+    """Handler para errores internos"""
+    return jsonify({
+        'error': 'Error interno del servidor',
+        'message': str(error)
+    }), 500
+
+
+if __name__ == '__main__':
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    # Configuración desde variables de entorno
+    host = os.getenv('API_HOST', '0.0.0.0')
+    port = int(os.getenv('API_PORT', 5000))
+
+    logger.info(
+        "🚀 SIPS API (CRM, asyncio) - Iniciando servidor (%s:%s)", host, port,
+        extra={'host': host, 'port': port}
+    )
+
+    config = Config()
+    config.bind = [f"{host}:{port}"]
+    asyncio.run(serve(app, config))
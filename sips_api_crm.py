@@ -6,35 +6,119 @@ API REST que expone el SIPS Client adaptado para el CRM de Aenergetic
 
 Endpoints:
     GET  /sips/<cups>                - Obtener histórico SIPS
+    GET  /sips/<cups>/summary        - Resumen por periodo y mes (sin demand_data)
     POST /sips                       - Obtener histórico SIPS (body JSON)
+    POST /sips/jobs                  - Crear trabajo asíncrono (batches grandes)
+    GET  /sips/jobs/<id>             - Progreso de un trabajo
+    GET  /sips/jobs/<id>/results     - Resultados de un trabajo
     GET  /health                     - Health check
+    GET  /cache/stats                - Estadísticas de la caché en memoria
+    POST /cache/invalidate           - Invalidar caché (un CUPS o entera)
+    GET  /metrics                    - Métricas en formato Prometheus
 
 Autor: Aenergetic
 Fecha: 2026-02-03
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
 from sips_client_crm import SIPSClient
+from sips_result_cache import result_cache_from_env
+from sips_jobs import JobManager
+from sips_columnar import HAS_NUMPY, to_columnar
+from sips_metrics import (
+    REGISTRY, CONTENT_TYPE, StageTimings, collect_timings, stop_timings, stage,
+    observe_batch, register_client_gauges, request_started, request_finished
+)
+from sips_logging import get_logger, setup_logging
+from sips_batch import (
+    iter_batch, run_batch, failed_item, to_ndjson, OK, TIMEOUT,
+    DEFAULT_MAX_PARALLEL, DEFAULT_ITEM_TIMEOUT, DEFAULT_BATCH_TIMEOUT
+)
 import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
 from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 app = Flask(__name__)
 CORS(app)  # Habilitar CORS para llamadas desde n8n
 
-# Cliente global (reutilizable)
+# Logs JSON a través de una cola; el detalle por petición solo con LOG_LEVEL=DEBUG
+setup_logging('api')
+logger = get_logger(__name__)
+
+# CUPS por ventana en /sips/batch con streaming NDJSON
+STREAM_WINDOW = int(os.getenv('SIPS_BATCH_STREAM_WINDOW', 500))
+
+# Cliente global (reutilizable, thread-safe gracias al pool de conexiones)
 sips_client = None
+_client_lock = threading.Lock()
+
+# Gestor de trabajos asíncronos (/sips/jobs)
+job_manager = None
+_jobs_lock = threading.Lock()
+
+# Pool, spool y cachés del cliente en /metrics
+register_client_gauges(lambda: sips_client)
 
 
 def get_client():
     """Obtiene o crea el cliente SIPS"""
     global sips_client
     if sips_client is None:
-        sips_client = SIPSClient()
-        sips_client.connect_db()
+        with _client_lock:
+            if sips_client is None:
+                client = SIPSClient(result_cache=result_cache_from_env())
+                client.connect_db()
+                if client.couch_write_behind:
+                    # Arranca el envío del spool (incluido lo pendiente de antes de reiniciar)
+                    client.get_couch_spool()
+                if client.couch_read_max_age:
+                    # Índice Mango para servir lecturas desde CouchDB
+                    client.ensure_couch_index()
+                sips_client = client
     return sips_client
 
 
+@app.before_request
+def start_request_metrics():
+    """Peticiones en curso y duración por endpoint (ver sips_metrics)"""
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_start = request_started(g.metrics_endpoint)
+    # Desglose por etapa de esta petición (cabecera Server-Timing)
+    g.stage_timings = collect_timings()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    if 'stage_timings' in g:
+        response.headers['Server-Timing'] = g.stage_timings.server_timing()
+    if 'metrics_start' in g:
+        started = g.pop('metrics_start')
+        request_finished(g.metrics_endpoint, request.method, response.status_code, started)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "%s %s %s", request.method, request.path, response.status_code,
+                extra={
+                    'endpoint': g.metrics_endpoint,
+                    'status': response.status_code,
+                    'duration_ms': round((time.perf_counter() - started) * 1000, 3)
+                }
+            )
+    return response
+
+
+@app.teardown_request
+def abort_request_metrics(error):
+    stop_timings()
+    # Excepción sin respuesta: after_request no ha llegado a ejecutarse
+    if 'metrics_start' in g:
+        request_finished(g.metrics_endpoint, request.method, 500, g.pop('metrics_start'))
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -42,10 +126,95 @@ def health_check():
         'status': 'ok',
         'service': 'SIPS API (CRM version)',
         'timestamp': datetime.now().isoformat(),
-        'version': '1.0.0'
+        'version': '1.0.0',
+        'db_pool': sips_client.pool_stats() if sips_client else {'connected': False},
+        'couch_spool': sips_client.spool_stats() if sips_client else {'enabled': False}
     })
 
 
+def format_result(sips_data: Dict[str, Any], output_format: Optional[str]) -> Dict[str, Any]:
+    """Aplica el formato de salida pedido (?format=columnar) a un resultado"""
+    if output_format == 'columnar':
+        return to_columnar(sips_data)
+    return sips_data
+
+
+def wants_timings(data: Optional[Dict[str, Any]] = None) -> bool:
+    """?timings=true (o "timings": true en el body): incluir el desglose por etapa en el JSON"""
+    if request.args.get('timings', default='false').lower() == 'true':
+        return True
+    return isinstance(data, dict) and data.get('timings') is True
+
+
+def timed_json(payload: Dict[str, Any], status: int = 200, include_timings: bool = False):
+    """
+    jsonify() medido como la etapa serialize
+    
+    Con include_timings añade "timings": ms por etapa hasta este punto y
+    el total. La serialización solo aparece en la cabecera Server-Timing.
+    """
+    timings = g.get('stage_timings')
+    if include_timings and timings is not None:
+        payload = {**payload, 'timings': timings.as_dict()}
+    with stage('serialize'):
+        response = jsonify(payload)
+    return response, status
+
+
+def check_format(output_format: Optional[str]):
+    """Valida el formato de salida: (respuesta de error, código) o None"""
+    if output_format not in (None, 'json', 'columnar'):
+        return jsonify({
+            'error': f"Formato no soportado: {output_format}",
+            'formats': ['json', 'columnar']
+        }), 400
+    if output_format == 'columnar' and not HAS_NUMPY:
+        return jsonify({
+            'error': 'format=columnar requiere NumPy (pip install numpy)'
+        }), 501
+    return None
+
+
+def check_timeouts(data: Dict[str, Any], *keys: str):
+    """
+    Valida los plazos del body (item_timeout, batch_timeout): (respuesta de
+    error, código) o None. Deben ser un número de segundos mayor que 0.
+    """
+    for key in keys:
+        if key not in data:
+            continue
+        value = data[key]
+        try:
+            seconds = None if isinstance(value, bool) else float(value)
+        except (TypeError, ValueError):
+            seconds = None
+        # Descarta también NaN e infinito
+        if seconds is None or not 0 < seconds < float('inf'):
+            return jsonify({
+                'error': f"{key} debe ser un número de segundos mayor que 0"
+            }), 400
+    return None
+
+
+def check_max_parallel(data: Dict[str, Any]):
+    """
+    Valida max_parallel del body: (respuesta de error, código) o None. Debe
+    ser un entero mayor que 0.
+    """
+    if 'max_parallel' not in data:
+        return None
+    value = data['max_parallel']
+    try:
+        parallel = None if isinstance(value, (bool, float)) else int(value)
+    except (TypeError, ValueError):
+        parallel = None
+    if parallel is None or parallel < 1:
+        return jsonify({
+            'error': 'max_parallel debe ser un entero mayor que 0'
+        }), 400
+    return None
+
+
 @app.route('/sips/<cups>', methods=['GET'])
 def get_sips_by_cups(cups):
     """
@@ -53,7 +222,14 @@ def get_sips_by_cups(cups):
     
     Query params:
         - invoice_id: ID de factura (opcional)
+        - optimize_p6: true/false - calcular potencias óptimas (default: false)
         - save: true/false - guardar en CouchDB (default: true)
+        - format: columnar - demand_data en columnas y agregados en demand_stats
+        - timings: true - añadir "timings" (ms por etapa) a la respuesta
+    
+    La cabecera Server-Timing lleva siempre el desglose por etapa
+    (db_connect, sips_cache_query, json_parse, invoice_lookup, couch_write,
+    serialize...).
     
     Ejemplo:
         GET /sips/ES0031406091590001JF0F?invoice_id=12345
@@ -61,7 +237,10 @@ def get_sips_by_cups(cups):
     try:
         # Parsear parámetros
         invoice_id = request.args.get('invoice_id', type=int)
+        output_format = request.args.get('format')
+        optimize_p6 = request.args.get('optimize_p6', default='false').lower() == 'true'
         save_to_couch = request.args.get('save', default='true').lower() == 'true'
+        include_timings = wants_timings()
         
         # Validar CUPS
         if not cups or len(cups) < 10:
@@ -70,6 +249,10 @@ def get_sips_by_cups(cups):
                 'cups': cups
             }), 400
         
+        format_error = check_format(output_format)
+        if format_error:
+            return format_error
+        
         # Obtener cliente
         client = get_client()
         
@@ -77,23 +260,74 @@ def get_sips_by_cups(cups):
         sips_data = client.get_sips_history(
             cups=cups,
             invoice_id=invoice_id,
+            optimize_p6=optimize_p6,
             save_to_couch=save_to_couch
         )
         
         if sips_data:
-            return jsonify({
+            return timed_json({
                 'success': True,
-                'data': sips_data,
+                'data': format_result(sips_data, output_format),
                 'saved_to_couchdb': save_to_couch
+            }, 200, include_timings)
+        else:
+            return timed_json({
+                'success': False,
+                'error': 'No se encontraron datos SIPS en la caché',
+                'cups': cups
+            }, 404, include_timings)
+            
+    except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/sips/<cups>/summary', methods=['GET'])
+def get_sips_summary(cups):
+    """
+    Resumen compacto por periodo y mes (sin demand_data)
+    
+    Totales de kWh, máxima demanda y potencia contratada por periodo, y
+    kWh / máxima por mes y periodo.
+    
+    Si el CUPS está en sips_cache se resume su JSON (agregado una vez y
+    cacheado); si no, se agrega consumos_historicos en MySQL.
+    
+    Query params:
+        - months: Número de meses (default: 12)
+    
+    Ejemplo:
+        GET /sips/ES0031406091590001JF0F/summary?months=12
+    """
+    try:
+        months = request.args.get('months', default=12, type=int)
+        
+        # Validar CUPS
+        if not cups or len(cups) < 10:
+            return jsonify({
+                'error': 'CUPS inválido',
+                'cups': cups
+            }), 400
+        
+        summary = get_client().get_sips_summary(cups, months)
+        
+        if summary:
+            return jsonify({
+                'success': True,
+                'data': summary
             }), 200
         else:
             return jsonify({
                 'success': False,
-                'error': 'No se encontraron datos SIPS en la caché',
+                'error': 'No se encontraron datos para el CUPS',
                 'cups': cups
             }), 404
             
     except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
         return jsonify({
             'success': False,
             'error': str(e)
@@ -109,7 +343,10 @@ def get_sips_post():
         {
             "cups": "ES0031406091590001JF0F",
             "invoice_id": 12345,         // opcional
-            "save": true                 // opcional, default: true
+            "optimize_p6": false,        // opcional, calcular potencias óptimas
+            "save": true,                // opcional, default: true
+            "format": "columnar",        // opcional, demand_data en columnas
+            "timings": false             // opcional, ms por etapa en "timings"
         }
     
     Ejemplo desde n8n:
@@ -127,7 +364,10 @@ def get_sips_post():
         
         cups = data.get('cups')
         invoice_id = data.get('invoice_id')
+        output_format = data.get('format')
+        optimize_p6 = data.get('optimize_p6', False)
         save_to_couch = data.get('save', True)
+        include_timings = wants_timings(data)
         
         # Validar CUPS
         if not cups or len(cups) < 10:
@@ -136,6 +376,10 @@ def get_sips_post():
                 'cups': cups
             }), 400
         
+        format_error = check_format(output_format)
+        if format_error:
+            return format_error
+        
         # Obtener cliente
         client = get_client()
         
@@ -143,33 +387,202 @@ def get_sips_post():
         sips_data = client.get_sips_history(
             cups=cups,
             invoice_id=invoice_id,
+            optimize_p6=optimize_p6,
             save_to_couch=save_to_couch
         )
         
         if sips_data:
-            return jsonify({
+            return timed_json({
                 'success': True,
-                'data': sips_data,
+                'data': format_result(sips_data, output_format),
                 'saved_to_couchdb': save_to_couch
-            }), 200
+            }, 200, include_timings)
         else:
-            return jsonify({
+            return timed_json({
                 'success': False,
                 'error': 'No se encontraron datos SIPS en la caché',
                 'cups': cups
-            }), 404
+            }, 404, include_timings)
             
     except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
 
+def process_batch_item(
+    client: SIPSClient,
+    item: Dict[str, Any],
+    options: Dict[str, Any],
+    prefetched: Optional[Dict[str, Any]] = None
+) -> Tuple[Dict[str, Any], Optional[Future]]:
+    """Procesa un elemento del batch: (resultado, Future de CouchDB o None)"""
+    cups = item.get('cups')
+    invoice_id = item.get('invoice_id')
+    
+    if not cups:
+        return {
+            'cups': None,
+            'success': False,
+            'error': 'CUPS vacío'
+        }, None
+    
+    sips_data = client.get_sips_history(
+        cups=cups,
+        invoice_id=invoice_id,
+        optimize_p6=options.get('optimize_p6', False),
+        save_to_couch=False,
+        prefetched=prefetched
+    )
+    
+    # Guardado en CouchDB en bloque (_bulk_docs)
+    future = None
+    if sips_data and options['save']:
+        future = client.queue_to_couchdb(sips_data, invoice_id, "python_client")
+    
+    return {
+        'cups': cups,
+        'invoice_id': invoice_id,
+        'success': sips_data is not None,
+        'records_found': sips_data.get('records_found', 0) if sips_data else 0,
+        **({'optimization': sips_data['optimization']} if sips_data and 'optimization' in sips_data else {}),
+        **({'data': sips_data} if sips_data and options.get('include_data') else {})
+    }, future
+
+
+def stream_batch(
+    client: SIPSClient,
+    cups_list: List[Dict[str, Any]],
+    options: Dict[str, Any],
+    max_parallel: int,
+    item_timeout: Optional[float],
+    batch_timeout: Optional[float],
+    timings: Optional[StageTimings] = None
+) -> Iterator[str]:
+    """
+    Genera el batch en NDJSON: una línea por CUPS según termina (con su
+    "index" en cups_list) y una línea final con "summary": true (y el
+    desglose por etapa en "timings" si se pasa `timings`)
+
+    Los CUPS se procesan por ventanas de STREAM_WINDOW (una query a
+    sips_cache por ventana), así la memoria no crece con el tamaño del batch.
+    """
+    # El cuerpo se genera después de la vista: volver a activar el desglose
+    if timings is not None:
+        collect_timings(timings)
+    
+    start = time.monotonic()
+    pending = []  # (índice en cups_list, Future de CouchDB)
+    timed_out = 0
+    
+    for offset in range(0, len(cups_list), STREAM_WINDOW):
+        window = cups_list[offset:offset + STREAM_WINDOW]
+        
+        remaining = None
+        if batch_timeout:
+            remaining = batch_timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                for index, item in enumerate(cups_list[offset:], offset):
+                    timed_out += 1
+                    yield to_ndjson({'index': index, **failed_item(item, TIMEOUT, 'batch_timeout')})
+                break
+        
+        prefetched = client.get_sips_from_cache_many(
+            [item.get('cups') for item in window]
+        ) if client.pool is not None else None
+        
+        outcomes = iter_batch(
+            window,
+            lambda item: process_batch_item(client, item, options, prefetched),
+            max_workers=max_parallel,
+            item_timeout=item_timeout,
+            batch_timeout=remaining
+        )
+        
+        for index, status, value in outcomes:
+            if status == OK:
+                result, future = value
+                if future is not None:
+                    pending.append((offset + index, future))
+            else:
+                result = failed_item(window[index], status, value)
+                timed_out += result['timed_out']
+            
+            yield to_ndjson({'index': offset + index, **result})
+    
+    summary = batch_summary(client, len(cups_list), timed_out, pending, start)
+    if timings is not None:
+        summary['timings'] = timings.as_dict()
+    yield to_ndjson(summary)
+
+
+def batch_summary(
+    client: SIPSClient,
+    processed: int,
+    timed_out: int,
+    pending: List[Tuple[int, Future]],
+    start: float
+) -> Dict[str, Any]:
+    """Última línea del batch en streaming: totales y errores de CouchDB"""
+    client.flush_couchdb()
+    
+    saved = 0
+    couchdb_errors = []
+    for index, future in pending:
+        couch_result = future.result()
+        if couch_result['ok']:
+            saved += 1
+        else:
+            couchdb_errors.append({
+                'index': index,
+                'error': couch_result.get('reason') or couch_result.get('error')
+            })
+    
+    return {
+        'summary': True,
+        'success': True,
+        'processed': processed,
+        'timed_out': timed_out,
+        'saved_to_couchdb': saved,
+        'couchdb_errors': couchdb_errors,
+        'elapsed_ms': round((time.monotonic() - start) * 1000)
+    }
+
+
+def collect_batch(
+    client: SIPSClient,
+    items: List[Dict[str, Any]],
+    outcomes: List[Tuple[str, Any]]
+) -> List[Dict[str, Any]]:
+    """Resultados del batch en el orden de `items`, con el estado de CouchDB"""
+    results = []
+    pending = []  # (índice en results, Future de CouchDB)
+    
+    for item, (status, value) in zip(items, outcomes):
+        if status == OK:
+            result, future = value
+            if future is not None:
+                pending.append((len(results), future))
+            results.append(result)
+        else:
+            results.append(failed_item(item, status, value))
+    
+    client.flush_couchdb()
+    for index, future in pending:
+        couch_result = future.result()
+        results[index]['saved_to_couchdb'] = couch_result['ok']
+        if not couch_result['ok']:
+            results[index]['couchdb_error'] = couch_result.get('reason') or couch_result.get('error')
+    
+    return results
+
+
 @app.route('/sips/batch', methods=['POST'])
 def get_sips_batch():
     """
-    Procesar múltiples CUPS en batch
+    Procesar múltiples CUPS en batch (en paralelo)
     
     Body JSON:
         {
@@ -177,8 +590,25 @@ def get_sips_batch():
                 {"cups": "ES...", "invoice_id": 123},
                 {"cups": "ES...", "invoice_id": 124}
             ],
-            "save": true
+            "save": true,
+            "max_parallel": 8,           // opcional, CUPS en paralelo
+            "item_timeout": 30,          // opcional, segundos por CUPS
+            "batch_timeout": 300,        // opcional, segundos para todo el batch
+            "include_data": false,       // opcional, incluir los datos SIPS completos
+            "optimize_p6": false,        // opcional, potencias óptimas por CUPS
+            "timings": false             // opcional, ms por etapa en "timings"
         }
+    
+    Los resultados mantienen el orden de cups_list. Los CUPS que superan
+    su plazo se devuelven con "timed_out": true.
+    
+    Con la cabecera `Accept: application/x-ndjson` la respuesta se envía
+    en streaming: una línea JSON por CUPS según termina y una línea final
+    de resumen.
+    
+    Server-Timing y "timings" suman cada etapa de todos los CUPS (en
+    paralelo, así que pueden superar a total). En streaming las cabeceras
+    salen antes de procesar nada: "timings" va en la línea de resumen.
     """
     try:
         data = request.get_json()
@@ -188,50 +618,264 @@ def get_sips_batch():
                 'error': 'Falta cups_list en el body'
             }), 400
         
+        option_error = check_max_parallel(data) or check_timeouts(data, 'item_timeout', 'batch_timeout')
+        if option_error:
+            return option_error
+        
         cups_list = data['cups_list']
-        save_to_couch = data.get('save', True)
+        observe_batch('/sips/batch', len(cups_list))
+        options = {
+            'save': data.get('save', True),
+            'include_data': data.get('include_data', False),
+            'optimize_p6': data.get('optimize_p6', False),
+        }
         
         client = get_client()
-        results = []
+        start = time.monotonic()
         
-        for item in cups_list:
-            cups = item.get('cups')
-            invoice_id = item.get('invoice_id')
-            
-            if not cups:
-                results.append({
-                    'cups': None,
-                    'success': False,
-                    'error': 'CUPS vacío'
-                })
-                continue
-            
-            sips_data = client.get_sips_history(
-                cups=cups,
-                invoice_id=invoice_id,
-                save_to_couch=save_to_couch
+        # Más hilos que conexiones del pool solo añadirían espera
+        max_parallel = max(1, min(int(data.get('max_parallel', DEFAULT_MAX_PARALLEL)), client.pool_size))
+        item_timeout = float(data.get('item_timeout', DEFAULT_ITEM_TIMEOUT))
+        batch_timeout = float(data.get('batch_timeout', DEFAULT_BATCH_TIMEOUT))
+        
+        if 'application/x-ndjson' in request.headers.get('Accept', ''):
+            return Response(
+                stream_batch(
+                    client, cups_list, options, max_parallel, item_timeout, batch_timeout,
+                    g.stage_timings if wants_timings(data) else None
+                ),
+                mimetype='application/x-ndjson'
             )
-            
-            results.append({
-                'cups': cups,
-                'invoice_id': invoice_id,
-                'success': sips_data is not None,
-                'records_found': sips_data.get('records_found', 0) if sips_data else 0
-            })
         
-        return jsonify({
+        # Una query por bloque de CUPS en lugar de una por CUPS
+        prefetched = client.get_sips_from_cache_many(
+            [item.get('cups') for item in cups_list]
+        ) if client.pool is not None else None
+        
+        outcomes = run_batch(
+            cups_list,
+            lambda item: process_batch_item(client, item, options, prefetched),
+            max_workers=max_parallel,
+            item_timeout=item_timeout,
+            batch_timeout=batch_timeout
+        )
+        
+        results = collect_batch(client, cups_list, outcomes)
+        
+        return timed_json({
             'success': True,
             'processed': len(results),
+            'timed_out': sum(1 for r in results if r.get('timed_out')),
+            'elapsed_ms': round((time.monotonic() - start) * 1000),
             'results': results
-        }), 200
+        }, 200, wants_timings(data))
         
     except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
 
+def run_job_chunk(items: List[Dict[str, Any]], options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Procesa un bloque de CUPS de un trabajo asíncrono (ver sips_jobs)"""
+    client = get_client()
+    max_parallel = max(1, min(int(options.get('max_parallel', DEFAULT_MAX_PARALLEL)), client.pool_size))
+    
+    prefetched = client.get_sips_from_cache_many(
+        [item.get('cups') for item in items]
+    ) if client.pool is not None else None
+    
+    outcomes = run_batch(
+        items,
+        lambda item: process_batch_item(client, item, options, prefetched),
+        max_workers=max_parallel,
+        item_timeout=options.get('item_timeout', DEFAULT_ITEM_TIMEOUT),
+        batch_timeout=None
+    )
+    return collect_batch(client, items, outcomes)
+
+
+def get_job_manager():
+    """Obtiene o crea el gestor de trabajos asíncronos y arranca su ejecutor"""
+    global job_manager
+    if job_manager is None:
+        with _jobs_lock:
+            if job_manager is None:
+                manager = JobManager(run_job_chunk)
+                if manager.start():
+                    logger.info("⚙️  Ejecutor de trabajos activo (%s)", manager.db_path)
+                job_manager = manager
+    return job_manager
+
+
+@app.route('/sips/jobs', methods=['POST'])
+def create_sips_job():
+    """
+    Crear un trabajo asíncrono para batches muy grandes
+    
+    Body JSON (mismas opciones que /sips/batch, sin batch_timeout):
+        {
+            "cups_list": [
+                {"cups": "ES...", "invoice_id": 123},
+                {"cups": "ES...", "invoice_id": 124}
+            ],
+            "save": true,
+            "max_parallel": 8,
+            "item_timeout": 30,
+            "include_data": false
+        }
+    
+    Responde 202 con el id del trabajo. El progreso se consulta en
+    GET /sips/jobs/<id> y los resultados en GET /sips/jobs/<id>/results.
+    El trabajo sobrevive a reinicios de la API.
+    """
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('cups_list'), list):
+            return jsonify({
+                'error': 'Falta cups_list en el body'
+            }), 400
+        
+        option_error = check_max_parallel(data) or check_timeouts(data, 'item_timeout')
+        if option_error:
+            return option_error
+        
+        cups_list = data['cups_list']
+        options = {
+            'save': data.get('save', True),
+            'include_data': data.get('include_data', False),
+            'optimize_p6': data.get('optimize_p6', False),
+            'max_parallel': int(data.get('max_parallel', DEFAULT_MAX_PARALLEL)),
+            'item_timeout': float(data.get('item_timeout', DEFAULT_ITEM_TIMEOUT)),
+        }
+        
+        job_id = get_job_manager().submit(cups_list, options)
+        observe_batch('/sips/jobs', len(cups_list))
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'queued',
+            'total': len(cups_list),
+            'status_url': f"/sips/jobs/{job_id}",
+            'results_url': f"/sips/jobs/{job_id}/results"
+        }), 202
+        
+    except Exception as e:
+        logger.exception("❌ Error en %s %s", request.method, request.path)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/sips/jobs/<job_id>', methods=['GET'])
+def get_sips_job(job_id):
+    """Estado de un trabajo: progreso, throughput (CUPS/s) y ETA"""
+    job = get_job_manager().get(job_id)
+    
+    if job is None:
+        return jsonify({
+            'error': 'Trabajo no encontrado',
+            'job_id': job_id
+        }), 404
+    
+    return jsonify(job)
+
+
+@app.route('/sips/jobs/<job_id>/results', methods=['GET'])
+def get_sips_job_results(job_id):
+    """
+    Resultados de un trabajo, en el orden de cups_list
+    
+    Query params:
+        - offset: primer índice de cups_list (default: 0)
+        - limit: resultados por página (default: 1000, máximo: 10000)
+    
+    Los CUPS aún no procesados aparecen con "status": "pending". Con la
+    cabecera `Accept: application/x-ndjson` se envían en streaming todos
+    los resultados desde offset, sin paginar.
+    """
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    
+    if job is None:
+        return jsonify({
+            'error': 'Trabajo no encontrado',
+            'job_id': job_id
+        }), 404
+    
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return Response(
+            (to_ndjson(result) for result in manager.iter_results(job_id, offset)),
+            mimetype='application/x-ndjson'
+        )
+    
+    limit = min(max(1, request.args.get('limit', 1000, type=int)), 10000)
+    results = list(manager.iter_results(job_id, offset, limit))
+    next_offset = offset + len(results)
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': job['status'],
+        'total': job['total'],
+        'offset': offset,
+        'limit': limit,
+        'next_offset': next_offset if next_offset < job['total'] else None,
+        'results': results
+    })
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Estadísticas de la caché en memoria (SIPS_RESULT_CACHE)"""
+    client = get_client()
+    return jsonify({
+        **client.cache_stats(),
+        'single_flight': client.inflight_stats(),
+        'couch_dedupe': client.dedupe_stats(),
+        'couch_read': client.couch_read_stats(),
+        'negative': client.negative_cache_stats()
+    })
+
+
+@app.route('/cache/invalidate', methods=['POST'])
+def cache_invalidate():
+    """
+    Invalidar la caché en memoria
+    
+    Body JSON (opcional):
+        {"cups": "ES0031406091590001JF0F"}   // sin cups: vacía toda la caché
+    """
+    data = request.get_json(silent=True) or {}
+    cups = data.get('cups')
+    removed = get_client().invalidate_cache(cups)
+    
+    return jsonify({
+        'success': True,
+        'cups': cups,
+        'invalidated': removed
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Métricas en formato de texto de Prometheus (ver sips_metrics)
+    
+    Latencia por etapa de get_sips_history, aciertos y fallos por origen
+    (sips_cache, consumos_historicos, CouchDB, cachés en memoria), errores
+    de CouchDB, tamaño de los batches y peticiones en curso. Con gunicorn
+    son las del worker que atiende la petición.
+    """
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
 @app.errorhandler(404)
 def not_found(error):
     """Handler para rutas no encontradas"""
@@ -240,8 +884,15 @@ def not_found(error):
         'available_endpoints': [
             'GET  /health',
             'GET  /sips/<cups>',
+            'GET  /sips/<cups>/summary',
             'POST /sips',
-            'POST /sips/batch'
+            'POST /sips/batch',
+            'POST /sips/jobs',
+            'GET  /sips/jobs/<id>',
+            'GET  /sips/jobs/<id>/results',
+            'GET  /cache/stats',
+            'POST /cache/invalidate',
+            'GET  /metrics'
         ]
     }), 404
 
@@ -261,17 +912,12 @@ if __name__ == '__main__':
     port = int(os.getenv('API_PORT', 5000))
     debug = os.getenv('API_DEBUG', 'false').lower() == 'true'
     
-    print("\n" + "="*60)
-    print("🚀 SIPS API (CRM) - Iniciando servidor")
-    print("="*60)
-    print(f"Host: {host}")
-    print(f"Port: {port}")
-    print(f"Debug: {debug}")
-    print("\nEndpoints disponibles:")
-    print("  GET  /health")
-    print("  GET  /sips/<cups>")
-    print("  POST /sips")
-    print("  POST /sips/batch")
-    print("="*60 + "\n")
+    logger.info(
+        "🚀 SIPS API (CRM) - Iniciando servidor (%s:%s, debug=%s)", host, port, debug,
+        extra={'host': host, 'port': port, 'debug': debug}
+    )
+    
+    # Reanudar los trabajos que quedaron a medias
+    get_job_manager()
     
     app.run(host=host, port=port, debug=debug)
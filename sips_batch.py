@@ -0,0 +1,146 @@
+"""
+SIPS Batch - Ejecución concurrente de lotes de CUPS
+====================================================
+Procesa los elementos de un batch en un pool de hilos acotado, con plazo
+máximo por elemento y para el batch completo. Un CUPS lento ya no bloquea
+al resto: el batch tarda aproximadamente lo que el elemento más lento.
+
+Los elementos que superan su plazo se devuelven como 'timeout'. Sus hilos
+no se pueden interrumpir y terminan en segundo plano, pero el batch no
+los espera.
+
+Autor: Aenergetic
+Fecha: 2026-10-16
+"""
+
+import os
+import json
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Estados de cada elemento
+OK = 'ok'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+
+DEFAULT_MAX_PARALLEL = int(os.getenv('SIPS_BATCH_MAX_PARALLEL', 8))
+DEFAULT_ITEM_TIMEOUT = float(os.getenv('SIPS_BATCH_ITEM_TIMEOUT', 30))
+DEFAULT_BATCH_TIMEOUT = float(os.getenv('SIPS_BATCH_TIMEOUT', 300))
+
+
+def iter_batch(
+    items: List[Any],
+    fn: Callable[[Any], Any],
+    max_workers: int = DEFAULT_MAX_PARALLEL,
+    item_timeout: Optional[float] = DEFAULT_ITEM_TIMEOUT,
+    batch_timeout: Optional[float] = DEFAULT_BATCH_TIMEOUT
+) -> Iterator[Tuple[int, str, Any]]:
+    """
+    Ejecuta fn(item) en paralelo y produce los resultados según terminan
+
+    Args:
+        items: Elementos del batch
+        fn: Función a ejecutar por elemento
+        max_workers: Número máximo de elementos en paralelo
+        item_timeout: Segundos máximos por elemento (desde que empieza)
+        batch_timeout: Segundos máximos para el batch completo
+
+    Yields:
+        (índice, estado, valor) con estado OK (valor = resultado de fn),
+        ERROR (valor = mensaje) o TIMEOUT (valor = 'item_timeout' o
+        'batch_timeout')
+    """
+    if not items:
+        return
+
+    started: Dict[int, float] = {}
+
+    def run(index: int, item: Any):
+        started[index] = time.monotonic()
+        return fn(item)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='sips-batch')
+    # Cada elemento con una copia del contexto: las etapas medidas en los
+    # hilos se suman al desglose de la petición (ver sips_metrics)
+    futures = {executor.submit(contextvars.copy_context().run, run, i, item): i for i, item in enumerate(items)}
+    pending = set(futures)
+    batch_deadline = time.monotonic() + batch_timeout if batch_timeout else None
+
+    try:
+        while pending:
+            now = time.monotonic()
+
+            if batch_deadline is not None and now >= batch_deadline:
+                for index in sorted(futures[f] for f in pending):
+                    yield index, TIMEOUT, 'batch_timeout'
+                for future in pending:
+                    future.cancel()
+                return
+
+            wake_at = batch_deadline
+
+            if item_timeout:
+                for future in list(pending):
+                    index = futures[future]
+                    if index not in started or future.done():
+                        continue
+                    deadline = started[index] + item_timeout
+                    if now >= deadline:
+                        pending.discard(future)
+                        futures.pop(future)
+                        yield index, TIMEOUT, 'item_timeout'
+                    elif wake_at is None or deadline < wake_at:
+                        wake_at = deadline
+
+                # Elementos en cola pueden empezar en cualquier momento
+                if any(futures[f] not in started for f in pending):
+                    wake_at = min(wake_at, now + 0.5) if wake_at is not None else now + 0.5
+
+            timeout = max(0.0, wake_at - time.monotonic()) if wake_at is not None else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                # Soltar la referencia: el resultado solo vive hasta que se consume
+                pending.discard(future)
+                index = futures.pop(future)
+                try:
+                    yield index, OK, future.result()
+                except Exception as e:
+                    yield index, ERROR, str(e)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_batch(
+    items: List[Any],
+    fn: Callable[[Any], Any],
+    max_workers: int = DEFAULT_MAX_PARALLEL,
+    item_timeout: Optional[float] = DEFAULT_ITEM_TIMEOUT,
+    batch_timeout: Optional[float] = DEFAULT_BATCH_TIMEOUT
+) -> List[Tuple[str, Any]]:
+    """
+    Como iter_batch, pero devuelve [(estado, valor)] en el orden de `items`
+    """
+    outcomes: List[Tuple[str, Any]] = [(TIMEOUT, 'batch_timeout')] * len(items)
+    for index, status, value in iter_batch(items, fn, max_workers, item_timeout, batch_timeout):
+        outcomes[index] = (status, value)
+    return outcomes
+
+
+def failed_item(item: Any, status: str, reason: Any) -> Dict[str, Any]:
+    """Resultado de un elemento que falló o superó su plazo"""
+    item = item if isinstance(item, dict) else {}
+    return {
+        'cups': item.get('cups'),
+        'invoice_id': item.get('invoice_id'),
+        'success': False,
+        'timed_out': status == TIMEOUT,
+        'error': reason,
+    }
+
+
+def to_ndjson(obj: Dict[str, Any]) -> str:
+    """Serializa un resultado como una línea NDJSON"""
+    return json.dumps(obj, ensure_ascii=False, default=str) + '\n'
@@ -12,13 +12,27 @@ Fecha: 2026-02-03
 import os
 import sys
 import json
-import requests
+import logging
+import sqlite3
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-import mysql.connector
+from typing import Dict, Iterator, List, Optional, Any
+import threading
+from concurrent.futures import Future
 from mysql.connector import Error
 import argparse
 
+from sips_pool import MySQLPool
+from sips_couch import CouchBulkWriter, create_couch_session, couch_request
+from sips_dedupe import CouchDedupe, payload_hash, stable_doc_id
+from sips_spool import CouchSpool
+from sips_result_cache import ResultCache, SingleFlight
+from sips_metrics import count_couch_error, count_lookup, stage, timed
+from sips_logging import get_logger, setup_logging
+from sips_stream import demand_record, export_ndjson
+from sips_columnar import DemandColumns, columns_from_rows
+from sips_optimizer import optimize_sips_data
+from sips_summary import SUMMARY_QUERY, CURRENT_POWERS_QUERY, summary_from_aggregates
+
 # Intentar cargar variables de entorno desde .env
 try:
     from dotenv import load_dotenv
@@ -26,6 +40,10 @@ try:
 except ImportError:
     pass  # dotenv no instalado, usar variables de sistema
 
+logger = get_logger(__name__)
+
+BANNER = '=' * 60
+
 
 class SIPSClient:
     """Cliente para extraer histórico SIPS desde IGNIS"""
@@ -39,6 +57,8 @@ class SIPSClient:
         couchdb_url: str = None,
         couchdb_user: str = None,
         couchdb_password: str = None,
+        pool_size: int = None,
+        result_cache: Optional[ResultCache] = None,
     ):
         """
         Inicializa el cliente SIPS
@@ -51,6 +71,8 @@ class SIPSClient:
             couchdb_url: URL de CouchDB
             couchdb_user: Usuario de CouchDB
             couchdb_password: Password de CouchDB
+            pool_size: Tamaño del pool de conexiones MySQL
+            result_cache: Caché en memoria de resultados (opcional)
         """
         # Usar variables de entorno como fallback
         self.db_host = db_host or os.getenv('IGNIS_DB_HOST', 'localhost')
@@ -63,32 +85,122 @@ class SIPSClient:
         self.couchdb_password = couchdb_password or os.getenv('COUCHDB_PASSWORD', '')
         self.couchdb_db = os.getenv('COUCHDB_DATABASE', 'sips_history')
         
-        self.connection = None
+        # Pool de conexiones MySQL (una conexión por llamada)
+        self.pool_size = pool_size or int(os.getenv('IGNIS_DB_POOL_SIZE', 10))
+        self.pool_recycle = int(os.getenv('IGNIS_DB_POOL_RECYCLE', 300))
+        self.pool_timeout = float(os.getenv('IGNIS_DB_POOL_TIMEOUT', 10))
+        
+        self.pool = None
+        self._pool_lock = threading.Lock()
+        
+        # Filas por bloque al leer consumos_historicos en streaming
+        self.stream_chunk_size = int(os.getenv('SIPS_STREAM_CHUNK_SIZE', 1000))
+        
+        # Sesión HTTP persistente con CouchDB (pool igual a la concurrencia)
+        self.couch_pool_size = int(os.getenv('COUCHDB_POOL_SIZE', self.pool_size))
+        self.couch_retries = int(os.getenv('COUCHDB_RETRIES', 3))
+        self.couch_backoff = float(os.getenv('COUCHDB_BACKOFF', 0.5))
+        self.couch_timeout = float(os.getenv('COUCHDB_TIMEOUT', 10))
+        self.couch_gzip = os.getenv('COUCHDB_GZIP', 'false').lower() == 'true'
+        self._couch_session = None
+        
+        # Escritor bulk de CouchDB (se crea bajo demanda)
+        self.couch_bulk_size = int(os.getenv('COUCHDB_BULK_SIZE', 100))
+        self.couch_bulk_interval = float(os.getenv('COUCHDB_BULK_INTERVAL', 2))
+        self._couch_writer = None
+        
+        # Documento único por CUPS; se omiten las escrituras sin cambios
+        self.couch_dedupe = os.getenv('COUCHDB_DEDUPE', 'false').lower() == 'true'
+        self._dedupe = None
+        
+        # Escritura diferida: spool en disco que se envía en segundo plano
+        self.couch_write_behind = os.getenv('COUCHDB_WRITE_BEHIND', 'false').lower() == 'true'
+        self._couch_spool = None
+        
+        # Caché en memoria de resultados de get_sips_history (opcional)
+        self.result_cache = result_cache
+        
+        # Peticiones concurrentes idénticas comparten una única consulta
+        self._inflight = SingleFlight()
     
     def connect_db(self) -> bool:
-        """Conecta a la base de datos MySQL de IGNIS"""
-        try:
-            self.connection = mysql.connector.connect(
+        """Crea el pool de conexiones a la base de datos MySQL de IGNIS"""
+        with self._pool_lock:
+            if self.pool is not None:
+                return True
+            
+            pool = MySQLPool(
+                size=self.pool_size,
+                recycle=self.pool_recycle,
+                timeout=self.pool_timeout,
                 host=self.db_host,
                 user=self.db_user,
                 password=self.db_password,
                 database=self.db_name
             )
             
-            if self.connection.is_connected():
-                db_info = self.connection.get_server_info()
-                print(f"✅ Conectado a MySQL Server versión {db_info}")
-                return True
-                
-        except Error as e:
-            print(f"❌ Error al conectar a MySQL: {e}")
-            return False
+            try:
+                with pool.connection() as conn:
+                    db_info = conn.get_server_info()
+            except Error as e:
+                pool.close()
+                logger.error("❌ Error al conectar a MySQL: %s", e)
+                return False
+            
+            self.pool = pool
+            logger.info(
+                "✅ Conectado a MySQL Server versión %s\n   Pool de conexiones: %s",
+                db_info, self.pool_size, extra={'pool_size': self.pool_size}
+            )
+            return True
     
     def disconnect_db(self):
-        """Cierra la conexión a MySQL"""
-        if self.connection and self.connection.is_connected():
-            self.connection.close()
-            print("🔌 Conexión a MySQL cerrada")
+        """Cierra el pool de conexiones a MySQL"""
+        with self._pool_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+                logger.info("🔌 Conexión a MySQL cerrada")
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """Estadísticas del pool de conexiones MySQL"""
+        if self.pool is None:
+            return {'connected': False}
+        return {'connected': True, **self.pool.stats()}
+    
+    def iter_consumos_rows(
+        self,
+        cups: str,
+        months: int = 12,
+        chunk_size: int = None
+    ) -> Iterator[tuple]:
+        """
+        Filas de consumos_historicos en streaming, de la más reciente a la
+        más antigua, como tuplas (ver sips_stream.CONSUMOS_COLUMNS)
+        
+        Las filas se leen por bloques con un cursor sin buffer, así la
+        memoria no crece con el número de meses. La conexión del pool queda
+        ocupada mientras se itera: consumir el generador o cerrarlo.
+        """
+        if self.pool is None and not self.connect_db():
+            raise Error(msg="No hay conexión a la base de datos")
+        
+        date_limit = datetime.now() - timedelta(days=months * 30)
+        
+        query = """
+            SELECT
+                fecha_lectura,
+                periodo,
+                consumo_kwh,
+                potencia_contratada,
+                potencia_maxima
+            FROM consumos_historicos
+            WHERE cups = %s
+            AND fecha_lectura >= %s
+            ORDER BY fecha_lectura DESC
+        """
+        
+        yield from self.pool.iter_query(query, (cups, date_limit), chunk_size or self.stream_chunk_size)
     
     def get_sips_data_by_cups(
         self,
@@ -107,62 +219,35 @@ class SIPSClient:
         Returns:
             Dict con datos SIPS o None si hay error
         """
-        if not self.connection or not self.connection.is_connected():
-            print("❌ No hay conexión a la base de datos")
+        if self.pool is None:
+            logger.error("❌ No hay conexión a la base de datos")
+            count_lookup('consumos_historicos', 'error')
             return None
         
         try:
-            cursor = self.connection.cursor(dictionary=True)
-            
-            # Calcular fecha límite
-            date_limit = datetime.now() - timedelta(days=months * 30)
-            
-            # Query para obtener datos de consumo histórico
-            query = """
-                SELECT 
-                    cups,
-                    fecha_lectura,
-                    periodo,
-                    consumo_kwh,
-                    potencia_contratada,
-                    potencia_maxima,
-                    precio_energia,
-                    precio_potencia
-                FROM consumos_historicos
-                WHERE cups = %s
-                AND fecha_lectura >= %s
-                ORDER BY fecha_lectura DESC
-            """
-            
-            cursor.execute(query, (cups, date_limit))
-            rows = cursor.fetchall()
-            
-            if not rows:
-                print(f"⚠️ No se encontraron datos para CUPS: {cups}")
-                return None
-            
-            # Procesar datos
+            # Procesar las filas según llegan de MySQL (sin fetchall)
             demand_data = []
             current_powers = {}
             periods = set()
             
-            for row in rows:
-                periodo = row['periodo']
-                periods.add(periodo)
-                
-                # Agregar a demand_data
-                demand_data.append({
-                    'fecha': row['fecha_lectura'].isoformat() if row['fecha_lectura'] else None,
-                    'periodo': periodo,
-                    'consumo_kwh': float(row['consumo_kwh']) if row['consumo_kwh'] else 0,
-                    'potencia_maxima': float(row['potencia_maxima']) if row['potencia_maxima'] else 0,
-                })
-                
-                # Actualizar potencias actuales (último valor por periodo)
-                if periodo not in current_powers:
-                    current_powers[periodo] = float(row['potencia_contratada']) if row['potencia_contratada'] else 0
+            with stage('consumos_query'):
+                for row in self.iter_consumos_rows(cups, months):
+                    _, periodo, _, potencia_contratada, _ = row
+                    periods.add(periodo)
+                    
+                    # Agregar a demand_data
+                    demand_data.append(demand_record(row))
+                    
+                    # Actualizar potencias actuales (último valor por periodo)
+                    if periodo not in current_powers:
+                        current_powers[periodo] = float(potencia_contratada) if potencia_contratada else 0
+            
+            if not demand_data:
+                logger.debug("⚠️ No se encontraron datos para CUPS: %s", cups, extra={'cups': cups})
+                count_lookup('consumos_historicos', 'miss')
+                return None
             
-            cursor.close()
+            count_lookup('consumos_historicos', 'hit')
             
             result = {
                 'cups': cups,
@@ -175,25 +260,81 @@ class SIPSClient:
                 'query_date': datetime.now().isoformat()
             }
             
-            print(f"✅ Datos SIPS extraídos para {cups}:")
-            print(f"   - Registros: {len(demand_data)}")
-            print(f"   - Periodos: {', '.join(sorted(periods))}")
-            print(f"   - Potencias actuales: {current_powers}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "✅ Datos SIPS extraídos para %s:\n   - Registros: %s\n   - Periodos: %s\n"
+                    "   - Potencias actuales: %s",
+                    cups, len(demand_data), ', '.join(result['periods']), current_powers,
+                    extra={'cups': cups, 'records': len(demand_data)}
+                )
             
             return result
             
         except Error as e:
-            print(f"❌ Error en query: {e}")
+            logger.error("❌ Error en query: %s", e, extra={'cups': cups})
+            count_lookup('consumos_historicos', 'error')
             return None
     
-    def save_to_couchdb(
+    @timed('summary')
+    def get_sips_summary(self, cups: str, months: int = 12) -> Optional[Dict[str, Any]]:
+        """
+        Resumen compacto por periodo y mes, sin demand_data (ver sips_summary)
+        
+        La agregación se hace en MySQL (GROUP BY mes, periodo) sobre
+        consumos_historicos: solo viaja una fila por mes y periodo.
+        
+        Args:
+            cups: CUPS a consultar
+            months: Número de meses hacia atrás
+            
+        Returns:
+            Dict con el resumen o None si no hay datos
+        """
+        if self.pool is None and not self.connect_db():
+            return None
+        
+        date_limit = datetime.now() - timedelta(days=months * 30)
+        
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(SUMMARY_QUERY, (cups, date_limit))
+                rows = cursor.fetchall()
+                cursor.execute(CURRENT_POWERS_QUERY, (cups, date_limit, cups))
+                power_rows = cursor.fetchall()
+                cursor.close()
+        except Error as e:
+            logger.error("❌ Error en query: %s", e, extra={'cups': cups})
+            return None
+        
+        summary = summary_from_aggregates(cups, rows, power_rows)
+        if summary is None:
+            logger.debug("⚠️ No se encontraron datos para CUPS: %s", cups, extra={'cups': cups})
+            return None
+        
+        summary['months'] = months
+        logger.debug(
+            "✅ Resumen de %s agregado en MySQL (%s registros)", cups, summary['records'], extra={'cups': cups}
+        )
+        return summary
+    
+    def get_demand_columns(self, cups: str, months: int = 12) -> Optional[DemandColumns]:
+        """
+        demand_data de consumos_historicos en columnas NumPy (ver
+        sips_columnar), construido desde el cursor en streaming sin pasar
+        por un dict por lectura
+        """
+        columns = columns_from_rows(self.iter_consumos_rows(cups, months))
+        return columns if len(columns) else None
+    
+    def build_couch_document(
         self,
         sips_data: Dict[str, Any],
         invoice_id: Optional[int] = None,
         source: str = "python_client"
-    ) -> bool:
+    ) -> Optional[Dict[str, Any]]:
         """
-        Guarda los datos SIPS en CouchDB
+        Construye el documento CouchDB para unos datos SIPS
         
         Args:
             sips_data: Datos SIPS a guardar
@@ -201,11 +342,11 @@ class SIPSClient:
             source: Origen de la consulta
             
         Returns:
-            True si se guardó correctamente
+            Documento CouchDB o None si no hay datos
         """
         if not sips_data:
-            print("❌ No hay datos SIPS para guardar")
-            return False
+            logger.error("❌ No hay datos SIPS para guardar")
+            return None
         
         # Construir documento para CouchDB
         doc_id = f"sips_{sips_data['cups']}_{int(datetime.now().timestamp() * 1000)}"
@@ -224,6 +365,7 @@ class SIPSClient:
             'demand_data': sips_data.get('demand_data', []),
             'periods': sips_data.get('periods', []),
             'optimize_p6': sips_data.get('optimize_p6', False),
+            'optimization': sips_data.get('optimization'),
             
             # Metadata
             'consulted_at': datetime.now().isoformat(),
@@ -231,33 +373,266 @@ class SIPSClient:
             'records_found': sips_data.get('records_found', 0),
         }
         
+        return document
+    
+    @timed('couch_write')
+    def save_to_couchdb(
+        self,
+        sips_data: Dict[str, Any],
+        invoice_id: Optional[int] = None,
+        source: str = "python_client"
+    ) -> bool:
+        """
+        Guarda los datos SIPS en CouchDB
+        
+        Args:
+            sips_data: Datos SIPS a guardar
+            invoice_id: ID de factura relacionada (opcional)
+            source: Origen de la consulta
+            
+        Returns:
+            True si se guardó correctamente
+        """
+        document = self.build_couch_document(sips_data, invoice_id, source)
+        if not document:
+            return False
+        
+        if self.couch_write_behind:
+            result = self._spool_document(document, sips_data, invoice_id)
+            if result.get('queued'):
+                logger.debug("📥 Encolado para CouchDB: %s", result['id'], extra={'doc_id': result['id']})
+            elif result.get('skipped'):
+                logger.debug("⏭️  Sin cambios, no se guarda en CouchDB: %s", result['id'], extra={'doc_id': result['id']})
+            return result['ok']
+        
+        if self.couch_dedupe:
+            return self._save_deduped(document, payload_hash(sips_data, invoice_id))
+        
         # Guardar en CouchDB
         try:
             url = f"{self.couchdb_url}/{self.couchdb_db}"
             
-            response = requests.post(
+            response = couch_request(
+                self.get_couch_session(),
+                'POST',
                 url,
-                auth=(self.couchdb_user, self.couchdb_password),
-                headers={'Content-Type': 'application/json'},
-                json=document,
-                timeout=10
+                document,
+                timeout=self.couch_timeout,
+                compress=self.couch_gzip
             )
             
             if response.status_code in [200, 201]:
                 result = response.json()
-                print(f"✅ Guardado en CouchDB:")
-                print(f"   - Document ID: {result.get('id')}")
-                print(f"   - Revision: {result.get('rev')}")
+                logger.debug(
+                    "✅ Guardado en CouchDB:\n   - Document ID: %s\n   - Revision: %s",
+                    result.get('id'), result.get('rev'), extra={'doc_id': result.get('id')}
+                )
+                return True
+            elif response.status_code == 409 and '_rev' not in document:
+                # El _id es único: lo guardó un intento anterior cuya respuesta se perdió
+                logger.debug("✅ Ya estaba guardado en CouchDB: %s", document['_id'], extra={'doc_id': document['_id']})
                 return True
             else:
-                print(f"❌ Error al guardar en CouchDB: {response.status_code}")
-                print(f"   Response: {response.text}")
+                logger.error(
+                    "❌ Error al guardar en CouchDB: %s\n   Response: %s", response.status_code, response.text,
+                    extra={'doc_id': document['_id']}
+                )
+                count_couch_error('write')
                 return False
                 
         except Exception as e:
-            print(f"❌ Error de conexión a CouchDB: {e}")
+            logger.error("❌ Error de conexión a CouchDB: %s", e, extra={'doc_id': document['_id']})
+            count_couch_error('write')
             return False
     
+    def get_couch_dedupe(self) -> CouchDedupe:
+        """Obtiene (o crea) el deduplicador de escrituras (COUCHDB_DEDUPE)"""
+        with self._pool_lock:
+            if self._dedupe is None:
+                self._dedupe = CouchDedupe(
+                    self.get_couch_session,
+                    f"{self.couchdb_url}/{self.couchdb_db}",
+                    timeout=self.couch_timeout,
+                    compress=self.couch_gzip
+                )
+            return self._dedupe
+    
+    def _save_deduped(self, document: Dict[str, Any], digest: str) -> bool:
+        """save_to_couchdb con _id estable: omite la escritura si el hash no cambia"""
+        dedupe = self.get_couch_dedupe()
+        prepared = dedupe.prepare(document, digest)
+        
+        if prepared is None:
+            doc_id = stable_doc_id(document['cups'])
+            logger.debug("⏭️  Sin cambios, no se guarda en CouchDB: %s", doc_id, extra={'doc_id': doc_id})
+            return True
+        
+        result = dedupe.save(prepared)
+        
+        if result['ok'] and result.get('skipped'):
+            logger.debug("⏭️  Sin cambios, no se guarda en CouchDB: %s", result['id'], extra={'doc_id': result['id']})
+            return True
+        if result['ok']:
+            logger.debug(
+                "✅ Guardado en CouchDB:\n   - Document ID: %s\n   - Revision: %s",
+                result['id'], result['rev'], extra={'doc_id': result['id']}
+            )
+            return True
+        
+        logger.error(
+            "❌ Error al guardar en CouchDB: %s\n   Response: %s", result['error'], result.get('reason'),
+            extra={'doc_id': result.get('id')}
+        )
+        count_couch_error('write')
+        return False
+    
+    def get_couch_spool(self, start: bool = True) -> CouchSpool:
+        """
+        Obtiene (o crea) el spool de escritura diferida (COUCHDB_WRITE_BEHIND)
+        
+        Al crearlo arranca el hilo que lo vacía, que envía también lo que
+        quedó pendiente de ejecuciones anteriores.
+        """
+        with self._pool_lock:
+            if self._couch_spool is None:
+                self._couch_spool = CouchSpool(
+                    self.get_couch_session,
+                    f"{self.couchdb_url}/{self.couchdb_db}",
+                    batch_size=self.couch_bulk_size,
+                    compress=self.couch_gzip,
+                    on_result=self._spool_result
+                )
+                if start:
+                    self._couch_spool.start()
+            return self._couch_spool
+    
+    def _spool_document(
+        self,
+        document: Dict[str, Any],
+        sips_data: Dict[str, Any],
+        invoice_id: Optional[int]
+    ) -> Dict[str, Any]:
+        """Guarda el documento en el spool sin esperar a CouchDB (resultado formato _bulk_docs)"""
+        if self.couch_dedupe:
+            dedupe = self.get_couch_dedupe()
+            prepared = dedupe.prepare(document, payload_hash(sips_data, invoice_id))
+            if prepared is None:
+                return dedupe.skipped_result(document)
+            document = prepared
+        
+        try:
+            self.get_couch_spool().enqueue(document)
+        except sqlite3.Error as e:
+            logger.error("❌ Error al encolar en el spool de CouchDB: %s", e, extra={'doc_id': document['_id']})
+            count_couch_error('spool')
+            return {'id': document['_id'], 'ok': False, 'error': 'spool_error', 'reason': str(e)}
+        
+        return {'id': document['_id'], 'ok': True, 'queued': True}
+    
+    def _spool_result(self, document: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+        """Resultado final de un documento enviado desde el spool"""
+        if self.couch_dedupe and 'payload_hash' in document:
+            return self.get_couch_dedupe().complete(document, result)
+        
+        if result.get('error') == 'conflict' and '_rev' not in document:
+            # El _id es único: un envío anterior llegó aunque se perdiera la respuesta
+            return {'id': document['_id'], 'ok': True, 'rev': None}
+        
+        return result
+    
+    def close_couch_spool(self):
+        """Intenta enviar lo pendiente y detiene el spool (lo que falle queda en disco)"""
+        spool = self._couch_spool
+        if spool is None:
+            return
+        
+        if spool.acquire():
+            sent = spool.drain()
+            depth = spool.stats()['depth']
+            logger.info("📤 Spool CouchDB: %s enviados, %s pendientes", sent, depth)
+        spool.stop()
+    
+    def spool_stats(self) -> Dict[str, Any]:
+        """Profundidad y contadores del spool de escritura diferida"""
+        if not self.couch_write_behind:
+            return {'enabled': False}
+        return {'enabled': True, **self.get_couch_spool().stats()}
+    
+    def dedupe_stats(self) -> Dict[str, Any]:
+        """Estadísticas de escrituras deduplicadas en CouchDB"""
+        if not self.couch_dedupe:
+            return {'enabled': False}
+        return {'enabled': True, **self.get_couch_dedupe().stats()}
+    
+    def get_couch_session(self):
+        """Obtiene (o crea) la sesión HTTP persistente de CouchDB"""
+        if self._couch_session is None:
+            with self._pool_lock:
+                if self._couch_session is None:
+                    self._couch_session = create_couch_session(
+                        (self.couchdb_user, self.couchdb_password),
+                        pool_size=self.couch_pool_size,
+                        retries=self.couch_retries,
+                        backoff=self.couch_backoff
+                    )
+        return self._couch_session
+    
+    def get_couch_writer(self) -> CouchBulkWriter:
+        """Obtiene (o crea) el escritor bulk de CouchDB"""
+        session = self.get_couch_session()
+        with self._pool_lock:
+            if self._couch_writer is None:
+                self._couch_writer = CouchBulkWriter(
+                    session,
+                    f"{self.couchdb_url}/{self.couchdb_db}",
+                    batch_size=self.couch_bulk_size,
+                    flush_interval=self.couch_bulk_interval,
+                    compress=self.couch_gzip
+                )
+            return self._couch_writer
+    
+    @timed('couch_write')
+    def queue_to_couchdb(
+        self,
+        sips_data: Dict[str, Any],
+        invoice_id: Optional[int] = None,
+        source: str = "python_client"
+    ) -> Optional[Future]:
+        """
+        Encola los datos SIPS para guardarlos con _bulk_docs
+        
+        Returns:
+            Future con el resultado del documento, o None si no hay datos
+        """
+        document = self.build_couch_document(sips_data, invoice_id, source)
+        if not document:
+            return None
+        
+        if self.couch_write_behind:
+            future = Future()
+            future.set_result(self._spool_document(document, sips_data, invoice_id))
+            return future
+        
+        if self.couch_dedupe:
+            dedupe = self.get_couch_dedupe()
+            prepared = dedupe.prepare(document, payload_hash(sips_data, invoice_id))
+            if prepared is None:
+                # Sin cambios: no se envía nada
+                future = Future()
+                future.set_result(dedupe.skipped_result(document))
+                return future
+            return dedupe.track_bulk(prepared, self.get_couch_writer().add(prepared))
+        
+        return self.get_couch_writer().add(document)
+    
+    @timed('couch_write')
+    def flush_couchdb(self) -> List[Dict[str, Any]]:
+        """Envía ya los documentos encolados con queue_to_couchdb"""
+        if self._couch_writer is None:
+            return []
+        return self._couch_writer.flush()
+    
+    @timed('get_sips_history')
     def get_sips_history(
         self,
         cups: str,
@@ -273,50 +648,175 @@ class SIPSClient:
             cups: CUPS a consultar
             invoice_id: ID de factura (opcional)
             months: Meses hacia atrás
-            optimize_p6: Optimizar P6
+            optimize_p6: Calcular potencias contratadas óptimas (clave 'optimization')
             save_to_couch: Guardar en CouchDB
             
         Returns:
             Datos SIPS o None
         """
-        print(f"\n{'='*60}")
-        print(f"📊 CONSULTANDO HISTÓRICO SIPS")
-        print(f"{'='*60}")
-        print(f"CUPS: {cups}")
-        print(f"Meses: {months}")
-        print(f"Invoice ID: {invoice_id or 'N/A'}")
-        print(f"{'='*60}\n")
+        logger.debug(
+            "\n%s\n📊 CONSULTANDO HISTÓRICO SIPS\n%s\nCUPS: %s\nMeses: %s\nInvoice ID: %s\n%s\n",
+            BANNER, BANNER, cups, months, invoice_id or 'N/A', BANNER,
+            extra={'cups': cups, 'months': months, 'invoice_id': invoice_id}
+        )
+        
+        cache_key = (cups, months, invoice_id, optimize_p6)
+        
+        # Caché en memoria de resultados (si está activada)
+        if self.result_cache is not None:
+            cached = self.result_cache.get(cache_key)
+            count_lookup('result_cache', 'miss' if cached is None else 'hit')
+            if cached is not None:
+                logger.debug("⚡ Datos SIPS servidos desde caché en memoria", extra={'cups': cups})
+                sips_data = dict(cached)
+                if save_to_couch:
+                    self.save_to_couchdb(sips_data, invoice_id, "python_client")
+                return sips_data
+        
+        def load():
+            sips_data = self._fetch_sips_history(cups, months, optimize_p6)
+            
+            if not sips_data:
+                return None
+            
+            # Optimización de potencias contratadas
+            if optimize_p6:
+                sips_data['optimization'] = self.optimize_powers(sips_data)
+            
+            if self.result_cache is not None:
+                self.result_cache.put(cache_key, dict(sips_data))
+            
+            # Guardar en CouchDB si está habilitado
+            if save_to_couch:
+                self.save_to_couchdb(sips_data, invoice_id, "python_client")
+            
+            return sips_data
+        
+        # Peticiones concurrentes del mismo CUPS esperan a la que está en curso
+        sips_data, shared = self._inflight.do(
+            (cups, months, invoice_id, optimize_p6, save_to_couch), load
+        )
+        
+        if shared:
+            logger.debug("🔗 Resultado compartido con una consulta en curso del mismo CUPS", extra={'cups': cups})
+            return dict(sips_data) if sips_data else None
         
+        return sips_data
+    
+    def _fetch_sips_history(
+        self,
+        cups: str,
+        months: int,
+        optimize_p6: bool
+    ) -> Optional[Dict[str, Any]]:
+        """Consulta MySQL (consumos_historicos)"""
         # Conectar a DB si no está conectado
-        if not self.connection or not self.connection.is_connected():
+        if self.pool is None:
             if not self.connect_db():
                 return None
         
-        # Obtener datos SIPS
-        sips_data = self.get_sips_data_by_cups(cups, months, optimize_p6)
+        return self.get_sips_data_by_cups(cups, months, optimize_p6)
+    
+    @timed('optimize')
+    def optimize_powers(self, sips_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Potencias contratadas óptimas y ahorro estimado (ver sips_optimizer)"""
+        try:
+            optimization = optimize_sips_data(sips_data)
+        except Exception as e:
+            optimization = {'error': str(e)}
         
-        if not sips_data:
-            return None
+        if 'error' in optimization:
+            logger.warning("⚠️  No se pudo optimizar la potencia: %s", optimization['error'], extra={'cups': sips_data.get('cups')})
+        elif optimization['savings'] is not None:
+            logger.debug(
+                "⚙️  Potencias óptimas: %s\n   - Ahorro estimado: %s € (%s%%)",
+                optimization['optimal_powers'], optimization['savings'], optimization['savings_pct']
+            )
+        else:
+            logger.debug("⚙️  Potencias óptimas: %s", optimization['optimal_powers'])
         
-        # Guardar en CouchDB si está habilitado
-        if save_to_couch:
-            self.save_to_couchdb(sips_data, invoice_id, "python_client")
+        return optimization
+    
+    def invalidate_cache(self, cups: Optional[str] = None) -> int:
+        """Invalida la caché en memoria para un CUPS (o entera)"""
+        if self.result_cache is None:
+            return 0
+        return self.result_cache.invalidate(cups)
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché en memoria"""
+        if self.result_cache is None:
+            return {'enabled': False}
+        return {'enabled': True, **self.result_cache.stats()}
+    
+    def inflight_stats(self) -> Dict[str, Any]:
+        """Estadísticas de coalescencia de peticiones concurrentes"""
+        return self._inflight.stats()
+
+
+def read_cups_file(path: str) -> List[Dict[str, Any]]:
+    """Lee un fichero con un CUPS por línea (opcionalmente `CUPS,invoice_id`)"""
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            cups, _, invoice_id = line.partition(',')
+            items.append({
+                'cups': cups.strip(),
+                'invoice_id': int(invoice_id) if invoice_id.strip() else None
+            })
+    return items
+
+
+def run_batch(client: SIPSClient, items: List[Dict[str, Any]], args) -> List[Dict[str, Any]]:
+    """Procesa varios CUPS desde CLI guardando en CouchDB con _bulk_docs"""
+    results = []
+    pending = []
+    
+    for item in items:
+        sips_data = client.get_sips_history(
+            cups=item['cups'],
+            invoice_id=item['invoice_id'],
+            months=args.months,
+            optimize_p6=args.optimize_p6,
+            save_to_couch=False
+        )
         
-        return sips_data
+        if sips_data and not args.no_save:
+            pending.append(client.queue_to_couchdb(sips_data, item['invoice_id'], "python_client"))
+        
+        results.append(sips_data or {'cups': item['cups'], 'error': 'Sin datos SIPS'})
+    
+    client.flush_couchdb()
+    saved = sum(1 for future in pending if future.result()['ok'])
+    
+    logger.info(
+        "\n%s\n📦 BATCH COMPLETADO\n%s\nCUPS procesados: %s\nCon datos: %s%s\n%s",
+        BANNER, BANNER, len(items), sum(1 for r in results if 'error' not in r),
+        "" if args.no_save else f"\nGuardados en CouchDB: {saved}/{len(pending)}", BANNER
+    )
+    
+    return results
 
 
 def main():
     """Función principal para uso CLI"""
+    setup_logging('cli')
+    
     parser = argparse.ArgumentParser(
         description='Cliente SIPS - Extrae histórico de consumos desde IGNIS'
     )
     
-    parser.add_argument('cups', help='CUPS a consultar')
+    parser.add_argument('cups', nargs='?', help='CUPS a consultar')
+    parser.add_argument('--cups-file', help='Fichero con un CUPS por línea (CUPS[,invoice_id]) para modo batch')
     parser.add_argument('--invoice-id', type=int, help='ID de factura')
     parser.add_argument('--months', type=int, default=12, help='Meses hacia atrás (default: 12)')
-    parser.add_argument('--optimize-p6', action='store_true', help='Optimizar periodo 6')
+    parser.add_argument('--optimize-p6', action='store_true', help='Calcular potencias contratadas óptimas')
     parser.add_argument('--no-save', action='store_true', help='No guardar en CouchDB')
     parser.add_argument('--output', help='Archivo JSON de salida')
+    parser.add_argument('--stream-output', help='Exportar consumos_historicos del CUPS a NDJSON fila a fila (memoria constante)')
     
     # Argumentos de conexión DB
     parser.add_argument('--db-host', default='localhost', help='Host de MySQL')
@@ -331,6 +831,9 @@ def main():
     
     args = parser.parse_args()
     
+    if not args.cups and not args.cups_file:
+        parser.error('Indica un CUPS o --cups-file')
+    
     # Crear cliente
     client = SIPSClient(
         db_host=args.db_host,
@@ -343,6 +846,26 @@ def main():
     )
     
     try:
+        # Modo batch desde fichero
+        if args.cups_file:
+            results = run_batch(client, read_cups_file(args.cups_file), args)
+            
+            if args.output:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+                logger.info("\n💾 Datos guardados en: %s", args.output)
+            
+            sys.exit(0 if any('error' not in r for r in results) else 1)
+        
+        # Exportación en streaming de consumos_historicos
+        if args.stream_output:
+            with open(args.stream_output, 'w', encoding='utf-8') as f:
+                summary = export_ndjson(client.iter_consumos_rows(args.cups, args.months), f, args.cups)
+            
+            print(json.dumps(summary, indent=2, ensure_ascii=False))
+            logger.info("\n💾 %s registros exportados a: %s", summary['records'], args.stream_output)
+            sys.exit(0 if summary['records'] else 1)
+        
         # Obtener histórico SIPS
         sips_data = client.get_sips_history(
             cups=args.cups,
@@ -357,15 +880,16 @@ def main():
             if args.output:
                 with open(args.output, 'w', encoding='utf-8') as f:
                     json.dump(sips_data, f, indent=2, ensure_ascii=False, default=str)
-                print(f"\n💾 Datos guardados en: {args.output}")
+                logger.info("\n💾 Datos guardados en: %s", args.output)
             
-            print("\n✅ Proceso completado exitosamente")
+            logger.info("\n✅ Proceso completado exitosamente")
             sys.exit(0)
         else:
-            print("\n❌ No se pudieron obtener datos SIPS")
+            logger.error("\n❌ No se pudieron obtener datos SIPS")
             sys.exit(1)
             
     finally:
+        client.close_couch_spool()
         client.disconnect_db()
 
 
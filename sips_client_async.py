@@ -0,0 +1,998 @@
+"""
+SIPS Async Client - Cliente asyncio para el CRM de Aenergetic
+==============================================================
+Versión asyncio de sips_client_crm.SIPSClient: MySQL con aiomysql y
+CouchDB con httpx (pool de conexiones keep-alive). Mientras una consulta
+espera a MySQL o a CouchDB el event loop atiende otras, así un solo
+proceso mantiene cientos de consultas en vuelo sin un hilo por petición.
+
+Mismos métodos que SIPSClient (con await), mismas variables de entorno y
+mismo comportamiento: caché de resultados, caché negativa, coalescencia de
+peticiones iguales, lectura desde CouchDB (COUCHDB_READ_MAX_AGE) y
+documentos con esquema 2. La escritura diferida (COUCHDB_WRITE_BEHIND) y
+la deduplicación (COUCHDB_DEDUPE) solo existen en el cliente síncrono; aquí
+el guardado es un POST asíncrono que no bloquea otras peticiones.
+
+    client = AsyncSIPSClient()
+    await client.connect_db()
+    sips_data = await client.get_sips_history('ES0031406091590001JF0F')
+    await client.close()
+
+Requiere: pip install aiomysql httpx
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import os
+import json
+import logging
+import gzip
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import aiomysql
+    import httpx
+    HAS_ASYNC = True
+    MySQLError = aiomysql.Error
+except ImportError:
+    HAS_ASYNC = False
+    MySQLError = Exception
+
+from sips_docs import SCHEMA_VERSION, DEMAND_ATTACHMENT, compact_document, decode_demand_attachment
+from sips_couch_read import INDEX_DEFINITION, latest_query, sips_from_document
+from sips_result_cache import AsyncSingleFlight, NegativeCache, ResultCache
+from sips_metrics import count_couch_error, count_lookup, observe_stage, stage, timed
+from sips_logging import get_logger
+from sips_stream import demand_record
+from sips_optimizer import optimize_sips_data
+from sips_summary import SUMMARY_QUERY, CURRENT_POWERS_QUERY, summary_from_aggregates, summarize_demand_data
+
+# Intentar cargar variables de entorno desde .env
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass  # dotenv no instalado, usar variables de sistema
+
+logger = get_logger(__name__)
+
+BANNER = '=' * 60
+
+CONSUMOS_QUERY = """
+    SELECT
+        fecha_lectura,
+        periodo,
+        consumo_kwh,
+        potencia_contratada,
+        potencia_maxima
+    FROM consumos_historicos
+    WHERE cups = %s
+    AND fecha_lectura >= %s
+    ORDER BY fecha_lectura DESC
+"""
+
+INVOICE_QUERY = """
+    SELECT
+        id_invoice,
+        cups,
+        invoice_number,
+        invoice_date,
+        billing_start,
+        billing_end,
+        contracted_power_p1,
+        contracted_power_p2,
+        contracted_power_p3,
+        contracted_power_p4,
+        contracted_power_p5,
+        contracted_power_p6
+    FROM invoices
+    WHERE id_invoice = %s
+"""
+
+
+class AsyncSIPSClient:
+    """Cliente asyncio para extraer histórico SIPS desde CRM"""
+
+    def __init__(
+        self,
+        db_host: str = None,
+        db_user: str = None,
+        db_password: str = None,
+        db_name: str = None,
+        couchdb_url: str = None,
+        couchdb_user: str = None,
+        couchdb_password: str = None,
+        pool_size: int = None,
+        result_cache: Optional[ResultCache] = None
+    ):
+        """
+        Inicializa el cliente (las conexiones se abren en connect_db)
+
+        Args:
+            db_*: Datos de conexión MySQL del CRM (default: CRM_DB_*)
+            couchdb_*: Datos de CouchDB (default: COUCHDB_*)
+            pool_size: Conexiones MySQL (default: CRM_DB_POOL_SIZE o 10)
+            result_cache: Caché en memoria de resultados (opcional)
+        """
+        if not HAS_ASYNC:
+            raise RuntimeError("AsyncSIPSClient requiere aiomysql y httpx (pip install aiomysql httpx)")
+
+        self.db_host = db_host or os.getenv('CRM_DB_HOST', 'localhost')
+        self.db_user = db_user or os.getenv('CRM_DB_USER', 'root')
+        self.db_password = db_password or os.getenv('CRM_DB_PASSWORD', '')
+        self.db_name = db_name or os.getenv('CRM_DB_NAME', 'aenergetic_crm')
+
+        self.couchdb_url = couchdb_url or os.getenv('COUCHDB_URL', 'https://couchdb.aenergetic.app')
+        self.couchdb_user = couchdb_user or os.getenv('COUCHDB_USER', 'admin')
+        self.couchdb_password = couchdb_password or os.getenv('COUCHDB_PASSWORD', '')
+        self.couchdb_db = os.getenv('COUCHDB_DATABASE', 'sips_history')
+
+        # Pool aiomysql
+        self.pool_size = pool_size or int(os.getenv('CRM_DB_POOL_SIZE', 10))
+        self.pool_recycle = int(os.getenv('CRM_DB_POOL_RECYCLE', 300))
+        self.pool = None
+
+        # Filas por bloque al leer consumos_historicos en streaming
+        self.stream_chunk_size = int(os.getenv('SIPS_STREAM_CHUNK_SIZE', 1000))
+
+        # Cliente HTTP de CouchDB (pool igual a la concurrencia)
+        self.couch_pool_size = int(os.getenv('COUCHDB_POOL_SIZE', self.pool_size))
+        self.couch_retries = int(os.getenv('COUCHDB_RETRIES', 3))
+        self.couch_timeout = float(os.getenv('COUCHDB_TIMEOUT', 10))
+        self.couch_gzip = os.getenv('COUCHDB_GZIP', 'false').lower() == 'true'
+        self._couch = None
+
+        # Esquema de documento y demand_data como adjunto (ver sips_docs)
+        self.couch_schema_version = int(os.getenv('COUCHDB_SCHEMA_VERSION', SCHEMA_VERSION))
+        self.couch_demand_attachment = os.getenv('COUCHDB_DEMAND_ATTACHMENT', 'false').lower() == 'true'
+
+        # Lectura desde CouchDB antes que MySQL (ver sips_couch_read)
+        self.couch_read_max_age = float(os.getenv('COUCHDB_READ_MAX_AGE', 0))
+        self.couch_read_timeout = float(os.getenv('COUCHDB_READ_TIMEOUT', 2))
+        self._couch_index_ready = False
+        self._couch_read_stats = {'hits': 0, 'misses': 0, 'errors': 0}
+
+        # Caché en memoria de resultados de get_sips_history (opcional)
+        self.result_cache = result_cache
+
+        # Resúmenes ya agregados del JSON de sips_cache, por (cups, date_add)
+        self.summary_cache = ResultCache(
+            ttl=float(os.getenv('SIPS_SUMMARY_CACHE_TTL', 86400)),
+            max_bytes=int(float(os.getenv('SIPS_SUMMARY_CACHE_MAX_MB', 16)) * 1024 * 1024)
+        )
+
+        # CUPS sin datos (se vacía si aparecen filas nuevas en sips_cache)
+        negative_ttl = float(os.getenv('SIPS_NEGATIVE_CACHE_TTL', 60))
+        self.negative_cache = NegativeCache(
+            ttl=negative_ttl,
+            max_entries=int(os.getenv('SIPS_NEGATIVE_CACHE_MAX', 10000))
+        ) if negative_ttl > 0 else None
+        self.negative_check_interval = float(os.getenv('SIPS_NEGATIVE_CACHE_CHECK', 5))
+        self._negative_checked_at = 0.0
+        self._negative_checking = False
+        self._query_errors = 0
+
+        # Peticiones concurrentes idénticas comparten una única consulta
+        self._inflight = AsyncSingleFlight()
+
+    async def connect_db(self) -> bool:
+        """Crea el pool de conexiones aiomysql a la base de datos del CRM"""
+        if self.pool is not None:
+            return True
+
+        try:
+            pool = await aiomysql.create_pool(
+                host=self.db_host,
+                user=self.db_user,
+                password=self.db_password,
+                db=self.db_name,
+                minsize=1,
+                maxsize=self.pool_size,
+                pool_recycle=self.pool_recycle,
+                autocommit=True
+            )
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("SELECT VERSION()")
+                    (db_info,) = await cursor.fetchone()
+        except MySQLError as e:
+            logger.error("❌ Error al conectar a MySQL: %s", e)
+            return False
+
+        self.pool = pool
+        logger.info(
+            "✅ Conectado a MySQL Server versión %s\n   Base de datos: %s\n   Pool de conexiones: %s (asyncio)",
+            db_info, self.db_name, self.pool_size,
+            extra={'database': self.db_name, 'pool_size': self.pool_size}
+        )
+        return True
+
+    async def disconnect_db(self):
+        """Cierra el pool aiomysql"""
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            pool.close()
+            await pool.wait_closed()
+            logger.info("🔒 Conexión a MySQL cerrada")
+
+    async def close(self):
+        """Cierra MySQL y el cliente HTTP de CouchDB"""
+        await self.disconnect_db()
+        if self._couch is not None:
+            couch, self._couch = self._couch, None
+            await couch.aclose()
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """Estadísticas del pool de conexiones MySQL"""
+        if self.pool is None:
+            return {'connected': False}
+        return {
+            'connected': True,
+            'size': self.pool.maxsize,
+            'open': self.pool.size,
+            'idle': self.pool.freesize,
+            'in_use': self.pool.size - self.pool.freesize,
+        }
+
+    @asynccontextmanager
+    async def _connection(self):
+        """Conexión prestada del pool; la espera se mide como la etapa db_connect"""
+        start = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            observe_stage('db_connect', time.perf_counter() - start)
+            yield conn
+
+    async def _fetchone(
+        self,
+        query: str,
+        params: tuple,
+        dictionary: bool = False,
+        stage_name: Optional[str] = None
+    ):
+        """Ejecuta una query y devuelve la primera fila (medida como la etapa `stage_name`, si se indica)"""
+        async with self._connection() as conn:
+            start = time.perf_counter()
+            try:
+                async with conn.cursor(aiomysql.DictCursor if dictionary else aiomysql.Cursor) as cursor:
+                    await cursor.execute(query, params)
+                    return await cursor.fetchone()
+            finally:
+                if stage_name:
+                    observe_stage(stage_name, time.perf_counter() - start)
+
+    async def _fetchall(
+        self,
+        query: str,
+        params: tuple,
+        dictionary: bool = False,
+        stage_name: Optional[str] = None
+    ) -> List[Any]:
+        """Ejecuta una query y devuelve todas las filas (medida como la etapa `stage_name`, si se indica)"""
+        async with self._connection() as conn:
+            start = time.perf_counter()
+            try:
+                async with conn.cursor(aiomysql.DictCursor if dictionary else aiomysql.Cursor) as cursor:
+                    await cursor.execute(query, params)
+                    return list(await cursor.fetchall())
+            finally:
+                if stage_name:
+                    observe_stage(stage_name, time.perf_counter() - start)
+
+    def _count_query_error(self):
+        self._query_errors += 1
+
+    async def get_sips_from_cache(self, cups: str) -> Optional[Dict[str, Any]]:
+        """Obtiene datos SIPS desde la tabla sips_cache"""
+        if self.pool is None:
+            logger.error("❌ No hay conexión a la base de datos")
+            self._count_query_error()
+            count_lookup('sips_cache', 'error')
+            return None
+
+        query = """
+            SELECT cups, data, date_add
+            FROM sips_cache
+            WHERE cups = %s
+            ORDER BY date_add DESC
+            LIMIT 1
+        """
+
+        try:
+            row = await self._fetchone(query, (cups,), dictionary=True, stage_name='sips_cache_query')
+        except MySQLError as e:
+            logger.error("❌ Error en query: %s", e, extra={'cups': cups})
+            self._count_query_error()
+            count_lookup('sips_cache', 'error')
+            return None
+
+        if not row:
+            logger.debug("⚠️  No se encontraron datos SIPS en caché para: %s", cups, extra={'cups': cups})
+            count_lookup('sips_cache', 'miss')
+            return None
+
+        try:
+            with stage('json_parse'):
+                sips_data = json.loads(row['data'])
+        except json.JSONDecodeError as e:
+            logger.error("❌ Error al parsear JSON de sips_cache: %s", e, extra={'cups': cups})
+            self._count_query_error()
+            count_lookup('sips_cache', 'error')
+            return None
+
+        count_lookup('sips_cache', 'hit')
+
+        logger.debug(
+            "✅ Datos SIPS obtenidos desde caché:\n   - CUPS: %s\n   - Fecha caché: %s",
+            cups, row['date_add'], extra={'cups': cups}
+        )
+
+        return sips_data
+
+    async def get_sips_from_cache_many(
+        self,
+        cups_list: List[str],
+        chunk_size: int = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Obtiene el último registro de sips_cache para muchos CUPS a la vez
+        (una query por bloque de `chunk_size` CUPS)
+
+        Returns:
+            Dict {cups: datos SIPS}. Los CUPS sin datos no aparecen; los que
+            fallan (JSON inválido o error de consulta) van con None para que
+            get_sips() los vuelva a leer uno a uno y el error cuente allí
+            (sin caché negativa).
+        """
+        if self.pool is None:
+            logger.error("❌ No hay conexión a la base de datos")
+            return {}
+
+        chunk_size = chunk_size or int(os.getenv('SIPS_CACHE_CHUNK_SIZE', 500))
+        unique_cups = list(dict.fromkeys(c for c in cups_list if c))
+        found = {}
+        errors = 0
+        fallback = set()  # CUPS consultados uno a uno (ya contados en get_sips_from_cache)
+
+        for start in range(0, len(unique_cups), chunk_size):
+            chunk = unique_cups[start:start + chunk_size]
+            placeholders = ', '.join(['%s'] * len(chunk))
+
+            query = f"""
+                SELECT s.cups, s.data, s.date_add
+                FROM sips_cache s
+                JOIN (
+                    SELECT cups, MAX(date_add) AS max_date
+                    FROM sips_cache
+                    WHERE cups IN ({placeholders})
+                    GROUP BY cups
+                ) latest
+                ON latest.cups = s.cups AND latest.max_date = s.date_add
+            """
+
+            try:
+                rows = await self._fetchall(query, tuple(chunk), dictionary=True, stage_name='sips_cache_query')
+            except MySQLError as e:
+                # Si falla el bloque, consultar sus CUPS uno a uno
+                logger.error("❌ Error en query: %s", e)
+                fallback.update(chunk)
+                for cups in chunk:
+                    errors_before = self._query_errors
+                    sips_data = await self.get_sips_from_cache(cups)
+                    if sips_data or self._query_errors != errors_before:
+                        found[cups] = sips_data
+                continue
+
+            with stage('json_parse'):
+                for row in rows:
+                    # Empates en date_add: nos quedamos con el primero
+                    if row['cups'] in found:
+                        continue
+                    try:
+                        found[row['cups']] = json.loads(row['data'])
+                    except (TypeError, json.JSONDecodeError) as e:
+                        logger.error("❌ Error al parsear JSON de sips_cache: %s", e, extra={'cups': row['cups']})
+                        self._count_query_error()
+                        found[row['cups']] = None
+                        errors += 1
+
+        loaded = sum(1 for sips_data in found.values() if sips_data is not None)
+        bulk_found = sum(1 for cups, sips_data in found.items() if sips_data is not None and cups not in fallback)
+        count_lookup('sips_cache', 'hit', bulk_found)
+        count_lookup('sips_cache', 'miss', len(unique_cups) - len(fallback) - bulk_found - errors)
+        count_lookup('sips_cache', 'error', errors)
+
+        logger.debug(
+            "✅ sips_cache: %s/%s CUPS encontrados%s",
+            loaded, len(unique_cups), f" ({errors} con JSON inválido)" if errors else ""
+        )
+
+        return found
+
+    async def get_invoice_data(self, invoice_id: int) -> Optional[Dict[str, Any]]:
+        """Obtiene datos de una factura específica"""
+        if self.pool is None:
+            return None
+
+        try:
+            return await self._fetchone(INVOICE_QUERY, (invoice_id,), dictionary=True, stage_name='invoice_lookup')
+        except MySQLError as e:
+            logger.error("❌ Error al obtener datos de factura: %s", e, extra={'invoice_id': invoice_id})
+            return None
+
+    async def get_sips_data_by_cups(
+        self,
+        cups: str,
+        months: int = 12,
+        optimize_p6: bool = False
+    ) -> Optional[Dict[str, Any]]:
+        """Extrae datos SIPS desde consumos_historicos (cursor sin buffer, por bloques)"""
+        if self.pool is None:
+            logger.error("❌ No hay conexión a la base de datos")
+            self._count_query_error()
+            count_lookup('consumos_historicos', 'error')
+            return None
+
+        date_limit = datetime.now() - timedelta(days=months * 30)
+        demand_data = []
+        current_powers = {}
+        periods = set()
+
+        try:
+            async with self._connection() as conn:
+                with stage('consumos_query'):
+                    async with conn.cursor(aiomysql.SSCursor) as cursor:
+                        await cursor.execute(CONSUMOS_QUERY, (cups, date_limit))
+                        while True:
+                            rows = await cursor.fetchmany(self.stream_chunk_size)
+                            if not rows:
+                                break
+                            for row in rows:
+                                _, periodo, _, potencia_contratada, _ = row
+                                periods.add(periodo)
+                                demand_data.append(demand_record(row))
+                                if periodo not in current_powers:
+                                    current_powers[periodo] = float(potencia_contratada) if potencia_contratada else 0
+        except MySQLError as e:
+            logger.error("❌ Error en query: %s", e, extra={'cups': cups})
+            self._count_query_error()
+            count_lookup('consumos_historicos', 'error')
+            return None
+
+        if not demand_data:
+            logger.debug("⚠️ No se encontraron datos para CUPS: %s", cups, extra={'cups': cups})
+            count_lookup('consumos_historicos', 'miss')
+            return None
+
+        count_lookup('consumos_historicos', 'hit')
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "✅ Datos SIPS extraídos para %s:\n   - Registros: %s\n   - Periodos: %s\n"
+                "   - Potencias actuales: %s",
+                cups, len(demand_data), ', '.join(sorted(periods)), current_powers,
+                extra={'cups': cups, 'records': len(demand_data)}
+            )
+
+        return {
+            'cups': cups,
+            'current_powers': current_powers,
+            'demand_data': demand_data,
+            'periods': sorted(list(periods)),
+            'optimize_p6': optimize_p6,
+            'months': months,
+            'records_found': len(demand_data),
+            'query_date': datetime.now().isoformat()
+        }
+
+    @timed('summary')
+    async def get_sips_summary(self, cups: str, months: int = 12) -> Optional[Dict[str, Any]]:
+        """Resumen compacto por periodo y mes, sin demand_data (ver SIPSClient.get_sips_summary)"""
+        if self.pool is None and not await self.connect_db():
+            return None
+
+        try:
+            row = await self._fetchone(
+                "SELECT date_add FROM sips_cache WHERE cups = %s ORDER BY date_add DESC LIMIT 1",
+                (cups,)
+            )
+            if not row:
+                return await self._summary_from_consumos(cups, months)
+
+            key = (cups, row[0])
+            summary = self.summary_cache.get(key)
+            if summary is not None:
+                logger.debug("⚡ Resumen de %s servido desde caché", cups, extra={'cups': cups})
+                return dict(summary)
+
+            data_row = await self._fetchone(
+                "SELECT data FROM sips_cache WHERE cups = %s AND date_add = %s LIMIT 1",
+                key
+            )
+
+            try:
+                sips_data = json.loads(data_row[0]) if data_row else None
+            except (TypeError, json.JSONDecodeError) as e:
+                logger.error("❌ Error al parsear JSON de sips_cache: %s", e, extra={'cups': cups})
+                sips_data = None
+
+            summary = summarize_demand_data(cups, sips_data) if sips_data else None
+            if summary is None:
+                return await self._summary_from_consumos(cups, months)
+
+            summary['cache_date'] = str(row[0])
+            self.summary_cache.put(key, dict(summary))
+            logger.debug(
+                "✅ Resumen de %s agregado desde sips_cache (%s registros)", cups, summary['records'],
+                extra={'cups': cups}
+            )
+            return summary
+
+        except MySQLError as e:
+            logger.error("❌ Error en query: %s", e, extra={'cups': cups})
+            return None
+
+    async def _summary_from_consumos(self, cups: str, months: int) -> Optional[Dict[str, Any]]:
+        """Resumen agregado en MySQL sobre consumos_historicos"""
+        date_limit = datetime.now() - timedelta(days=months * 30)
+
+        rows, power_rows = await asyncio.gather(
+            self._fetchall(SUMMARY_QUERY, (cups, date_limit)),
+            self._fetchall(CURRENT_POWERS_QUERY, (cups, date_limit, cups))
+        )
+
+        summary = summary_from_aggregates(cups, rows, power_rows)
+        if summary is None:
+            logger.debug("⚠️ No se encontraron datos para CUPS: %s", cups, extra={'cups': cups})
+            return None
+
+        summary['months'] = months
+        logger.debug(
+            "✅ Resumen de %s agregado desde consumos_historicos (%s registros)", cups, summary['records'],
+            extra={'cups': cups}
+        )
+        return summary
+
+    def get_couch_client(self) -> "httpx.AsyncClient":
+        """Obtiene (o crea) el cliente HTTP de CouchDB (keep-alive, pool de conexiones)"""
+        if self._couch is None:
+            self._couch = httpx.AsyncClient(
+                auth=(self.couchdb_user, self.couchdb_password),
+                limits=httpx.Limits(
+                    max_connections=self.couch_pool_size,
+                    max_keepalive_connections=self.couch_pool_size
+                ),
+                # Reintenta errores de conexión (no respuestas 5xx)
+                transport=httpx.AsyncHTTPTransport(retries=self.couch_retries),
+                timeout=self.couch_timeout
+            )
+        return self._couch
+
+    async def _couch_request(
+        self,
+        method: str,
+        url: str,
+        payload: Any = None,
+        timeout: float = None
+    ) -> "httpx.Response":
+        """Petición JSON a CouchDB, opcionalmente con el cuerpo en gzip (como sips_couch.couch_request)"""
+        headers = {'Content-Type': 'application/json'}
+        body = None
+
+        if payload is not None:
+            body = json.dumps(payload, default=str).encode('utf-8')
+            if self.couch_gzip:
+                body = gzip.compress(body, compresslevel=5)
+                headers['Content-Encoding'] = 'gzip'
+
+        return await self.get_couch_client().request(
+            method, url, content=body, headers=headers, timeout=timeout or self.couch_timeout
+        )
+
+    def build_couch_document(
+        self,
+        sips_data: Dict[str, Any],
+        invoice_id: Optional[int] = None,
+        source: str = "python_client"
+    ) -> Optional[Dict[str, Any]]:
+        """Construye el documento CouchDB para unos datos SIPS (mismo formato que SIPSClient)"""
+        if not sips_data:
+            logger.error("❌ No hay datos SIPS para guardar")
+            return None
+
+        cups = sips_data.get('cups') or sips_data.get('CUPS')
+        if not cups:
+            logger.error("❌ No se encontró CUPS en los datos SIPS")
+            return None
+
+        doc_id = f"sips_{cups}_{int(datetime.now().timestamp() * 1000)}"
+
+        if self.couch_schema_version >= SCHEMA_VERSION:
+            meta = {
+                '_id': doc_id,
+                'cups': cups,
+                'months': sips_data.get('months'),
+                'invoice_id': invoice_id,
+                'source': source,
+                'consulted_at': datetime.now().isoformat(),
+            }
+            return compact_document(sips_data, meta, self.couch_demand_attachment)
+
+        return {
+            '_id': doc_id,
+            'type': 'sips_data',
+            'cups': cups,
+            'months': sips_data.get('months'),
+            'invoice_id': invoice_id,
+            'source': source,
+            'sips_raw_data': sips_data,
+            'current_powers': sips_data.get('current_powers', {}),
+            'demand_data': sips_data.get('demand_data', []),
+            'periods': sips_data.get('periods', []),
+            'consulted_at': datetime.now().isoformat(),
+            'records_found': len(sips_data.get('demand_data', [])),
+        }
+
+    @timed('couch_write')
+    async def save_to_couchdb(
+        self,
+        sips_data: Dict[str, Any],
+        invoice_id: Optional[int] = None,
+        source: str = "python_client"
+    ) -> bool:
+        """Guarda los datos SIPS en CouchDB"""
+        document = self.build_couch_document(sips_data, invoice_id, source)
+        if not document:
+            return False
+
+        try:
+            response = await self._couch_request('POST', f"{self.couchdb_url}/{self.couchdb_db}", document)
+        except httpx.HTTPError as e:
+            logger.error("❌ Error de conexión a CouchDB: %s", e, extra={'doc_id': document['_id']})
+            count_couch_error('write')
+            return False
+
+        if response.status_code in [200, 201, 202]:
+            result = response.json()
+            logger.debug(
+                "✅ Guardado en CouchDB:\n   - Document ID: %s\n   - Revision: %s",
+                result.get('id'), result.get('rev'), extra={'doc_id': result.get('id')}
+            )
+            return True
+
+        logger.error(
+            "❌ Error al guardar en CouchDB: %s\n   Response: %s", response.status_code, response.text,
+            extra={'doc_id': document['_id']}
+        )
+        count_couch_error('write')
+        return False
+
+    @timed('couch_write')
+    async def save_many_to_couchdb(
+        self,
+        items: List[Tuple[Dict[str, Any], Optional[int]]],
+        source: str = "python_client"
+    ) -> List[Dict[str, Any]]:
+        """
+        Guarda varios resultados con un único POST a _bulk_docs
+
+        Args:
+            items: (sips_data, invoice_id) por documento
+
+        Returns:
+            Un resultado por elemento, en el mismo orden ({'id', 'ok', 'rev'}
+            o {'ok': False, 'error', 'reason'})
+        """
+        documents = [self.build_couch_document(sips_data, invoice_id, source) for sips_data, invoice_id in items]
+        docs = [doc for doc in documents if doc]
+        if not docs:
+            return [{'id': None, 'ok': False, 'error': 'no_data'} for _ in items]
+
+        try:
+            response = await self._couch_request(
+                'POST', f"{self.couchdb_url}/{self.couchdb_db}/_bulk_docs", {'docs': docs},
+                timeout=max(self.couch_timeout, 30)
+            )
+            response.raise_for_status()
+            by_id = {item.get('id'): item for item in response.json()}
+        except (httpx.HTTPError, ValueError) as e:
+            by_id = {doc['_id']: {'id': doc['_id'], 'error': 'connection_error', 'reason': str(e)} for doc in docs}
+
+        results = []
+        for document in documents:
+            if not document:
+                results.append({'id': None, 'ok': False, 'error': 'no_data'})
+                continue
+            item = by_id.get(document['_id'], {'error': 'missing', 'reason': 'Sin resultado en la respuesta de _bulk_docs'})
+            if 'error' in item:
+                results.append({'id': document['_id'], 'ok': False, 'error': item['error'], 'reason': item.get('reason')})
+            else:
+                results.append({'id': document['_id'], 'ok': True, 'rev': item.get('rev')})
+
+        count_couch_error('bulk', sum(1 for document, result in zip(documents, results) if document and not result['ok']))
+        return results
+
+    async def ensure_couch_index(self) -> bool:
+        """Crea el índice Mango [cups, months, consulted_at] que usa get_sips_from_couch"""
+        if self._couch_index_ready:
+            return True
+
+        try:
+            response = await self._couch_request(
+                'POST', f"{self.couchdb_url}/{self.couchdb_db}/_index", INDEX_DEFINITION
+            )
+        except httpx.HTTPError as e:
+            logger.warning("⚠️  No se pudo crear el índice de lectura en CouchDB: %s", e)
+            return False
+
+        self._couch_index_ready = response.status_code in [200, 201]
+        if self._couch_index_ready:
+            logger.info("🗂️  Índice de lectura CouchDB listo (máx. %.0f s)", self.couch_read_max_age)
+        return self._couch_index_ready
+
+    async def get_sips_from_couch(
+        self,
+        cups: str,
+        invoice_id: Optional[int] = None,
+        months: int = 12
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Datos SIPS del documento CouchDB más reciente del CUPS para la misma
+        ventana de meses, si tiene menos de COUCHDB_READ_MAX_AGE segundos (ver
+        sips_couch_read)
+        """
+        url = f"{self.couchdb_url}/{self.couchdb_db}"
+        await self.ensure_couch_index()
+
+        try:
+            with stage('couch_read'):
+                response = await self._couch_request(
+                    'POST', f"{url}/_find", latest_query(cups, invoice_id, months, self.couch_read_max_age),
+                    timeout=self.couch_read_timeout
+                )
+                response.raise_for_status()
+                docs = response.json().get('docs', [])
+                document = docs[0] if docs else None
+
+                # _find no trae el contenido de los adjuntos: descargar demand_data
+                if document is not None and DEMAND_ATTACHMENT in (document.get('_attachments') or {}):
+                    attachment = await self.get_couch_client().get(
+                        f"{url}/{document['_id']}/{DEMAND_ATTACHMENT}", timeout=self.couch_read_timeout
+                    )
+                    attachment.raise_for_status()
+                    document = {**document, 'demand_data': decode_demand_attachment(attachment.content)}
+
+                sips_data = sips_from_document(document) if document else None
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning("⚠️  Error al leer de CouchDB, se consulta MySQL: %s", e, extra={'cups': cups})
+            self._couch_read_stats['errors'] += 1
+            count_couch_error('read')
+            count_lookup('couchdb', 'error')
+            return None
+
+        if sips_data is None:
+            self._couch_read_stats['misses'] += 1
+            count_lookup('couchdb', 'miss')
+            return None
+
+        self._couch_read_stats['hits'] += 1
+        count_lookup('couchdb', 'hit')
+        logger.debug(
+            "🛋️  Datos SIPS servidos desde CouchDB (%s, %s)", document['_id'], document.get('consulted_at'),
+            extra={'cups': cups, 'doc_id': document['_id']}
+        )
+        return sips_data
+
+    def couch_read_stats(self) -> Dict[str, Any]:
+        """Estadísticas de lecturas servidas desde CouchDB"""
+        if not self.couch_read_max_age:
+            return {'enabled': False}
+        return {
+            'enabled': True,
+            'max_age_s': self.couch_read_max_age,
+            'index_ready': self._couch_index_ready,
+            **self._couch_read_stats
+        }
+
+    @timed('get_sips_history')
+    async def get_sips_history(
+        self,
+        cups: str,
+        invoice_id: Optional[int] = None,
+        months: int = 12,
+        optimize_p6: bool = False,
+        save_to_couch: bool = True,
+        prefetched: Optional[Dict[str, Dict[str, Any]]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Método principal para obtener histórico SIPS
+
+        Si se pasa `prefetched` (resultado de get_sips_from_cache_many) no se
+        vuelve a consultar sips_cache para este CUPS.
+        """
+        logger.debug(
+            "\n%s\n📊 CONSULTANDO HISTÓRICO SIPS\n%s\nCUPS: %s\nMeses: %s\nInvoice ID: %s\n%s\n",
+            BANNER, BANNER, cups, months, invoice_id or 'N/A', BANNER,
+            extra={'cups': cups, 'months': months, 'invoice_id': invoice_id}
+        )
+
+        cache_key = (cups, months, invoice_id, optimize_p6)
+
+        if self.result_cache is not None:
+            cached = self.result_cache.get(cache_key)
+            count_lookup('result_cache', 'miss' if cached is None else 'hit')
+            if cached is not None:
+                logger.debug("⚡ Datos SIPS servidos desde caché en memoria", extra={'cups': cups})
+                sips_data = dict(cached)
+                if save_to_couch:
+                    await self.save_to_couchdb(sips_data, invoice_id, "python_client")
+                return sips_data
+
+        if await self.is_known_missing(cups, months):
+            logger.debug("🚫 CUPS sin datos (caché negativa), no se consulta MySQL", extra={'cups': cups})
+            count_lookup('negative_cache', 'hit')
+            return None
+
+        async def load():
+            sips_data = None
+            errors_before = self._query_errors
+
+            # CouchDB como segundo nivel (salvo que sips_cache ya venga precargado)
+            if self.couch_read_max_age and not (prefetched and prefetched.get(cups) is not None):
+                sips_data = await self.get_sips_from_couch(cups, invoice_id, months)
+            from_couch = sips_data is not None
+
+            if not from_couch:
+                sips_data = await self._fetch_sips_history(cups, invoice_id, months, optimize_p6, prefetched)
+
+            if not sips_data:
+                # Solo un "no hay datos" limpio; con errores de consulta se reintenta
+                if self.negative_cache is not None and self.pool is not None and self._query_errors == errors_before:
+                    self.negative_cache.add((cups, months))
+                return None
+
+            # Ventana de la consulta (los datos de sips_cache no la traen): el
+            # documento de CouchDB solo se servirá a consultas con los mismos meses
+            sips_data.setdefault('months', months)
+
+            if optimize_p6:
+                sips_data['optimization'] = await self.optimize_powers(sips_data)
+
+            if self.result_cache is not None:
+                self.result_cache.put(cache_key, dict(sips_data))
+
+            # Guardar en CouchDB si está habilitado (no si se acaba de leer de ahí)
+            if save_to_couch and not from_couch:
+                await self.save_to_couchdb(sips_data, invoice_id, "python_client")
+
+            return sips_data
+
+        sips_data, shared = await self._inflight.do(
+            (cups, months, invoice_id, optimize_p6, save_to_couch), load
+        )
+
+        if shared:
+            logger.debug("🔗 Resultado compartido con una consulta en curso del mismo CUPS", extra={'cups': cups})
+            return dict(sips_data) if sips_data else None
+
+        return sips_data
+
+    async def _fetch_sips_history(
+        self,
+        cups: str,
+        invoice_id: Optional[int],
+        months: int,
+        optimize_p6: bool,
+        prefetched: Optional[Dict[str, Dict[str, Any]]]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Consulta MySQL: sips_cache y, si no hay, consumos_historicos; la
+        factura se pide a la vez (otra conexión del pool)
+        """
+        if self.pool is None and not await self.connect_db():
+            return None
+
+        invoice_task = asyncio.ensure_future(self.get_invoice_data(invoice_id)) if invoice_id else None
+
+        try:
+            # None en prefetched: falló la lectura en bloque, se repite la individual
+            if prefetched is not None and prefetched.get(cups, {}) is not None:
+                sips_data = dict(prefetched[cups]) if cups in prefetched else None
+            else:
+                sips_data = await self.get_sips_from_cache(cups)
+
+            if not sips_data:
+                sips_data = await self.get_sips_data_by_cups(cups, months, optimize_p6)
+        except BaseException:
+            if invoice_task is not None:
+                invoice_task.cancel()
+            raise
+
+        if not sips_data:
+            if invoice_task is not None:
+                invoice_task.cancel()
+            return None
+
+        if invoice_task is not None:
+            invoice_data = await invoice_task
+            if invoice_data:
+                sips_data['invoice_data'] = invoice_data
+
+        return sips_data
+
+    @timed('optimize')
+    async def optimize_powers(self, sips_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Potencias óptimas (ver sips_optimizer), en un hilo para no bloquear el event loop"""
+        try:
+            optimization = await asyncio.to_thread(optimize_sips_data, sips_data)
+        except Exception as e:
+            optimization = {'error': str(e)}
+
+        if 'error' in optimization:
+            logger.warning("⚠️  No se pudo optimizar la potencia: %s", optimization['error'], extra={'cups': sips_data.get('cups')})
+        elif optimization['savings'] is not None:
+            logger.debug(
+                "⚙️  Potencias óptimas: %s\n   - Ahorro estimado: %s € (%s%%)",
+                optimization['optimal_powers'], optimization['savings'], optimization['savings_pct']
+            )
+        else:
+            logger.debug("⚙️  Potencias óptimas: %s", optimization['optimal_powers'])
+
+        return optimization
+
+    async def is_known_missing(self, cups: str, months: int = 12) -> bool:
+        """True si el CUPS está en la caché negativa (ver SIPSClient.is_known_missing)"""
+        if self.negative_cache is None:
+            return False
+
+        await self._refresh_negative_generation()
+        return self.negative_cache.contains((cups, months))
+
+    async def _refresh_negative_generation(self):
+        """Vacía la caché negativa si hay filas nuevas en sips_cache"""
+        now = time.monotonic()
+        if self.pool is None or self._negative_checking or now - self._negative_checked_at < self.negative_check_interval:
+            return
+
+        # Una sola comprobación a la vez; el resto sigue con la generación conocida
+        self._negative_checking = True
+        self._negative_checked_at = now
+        try:
+            row = await self._fetchone("SELECT MAX(date_add) FROM sips_cache", ())
+        except MySQLError as e:
+            logger.warning("⚠️  No se pudo comprobar sips_cache para la caché negativa: %s", e)
+            return
+        finally:
+            self._negative_checking = False
+
+        if self.negative_cache.set_generation(row[0] if row else None):
+            logger.info("🔄 Filas nuevas en sips_cache: caché negativa vaciada")
+
+    def invalidate_cache(self, cups: Optional[str] = None) -> int:
+        """Invalida la caché en memoria para un CUPS (o entera)"""
+        removed = self.summary_cache.invalidate(cups)
+        if self.negative_cache is not None:
+            removed += self.negative_cache.invalidate(cups)
+        if self.result_cache is None:
+            return removed
+        return removed + self.result_cache.invalidate(cups)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché en memoria"""
+        if self.result_cache is None:
+            return {'enabled': False}
+        return {'enabled': True, **self.result_cache.stats()}
+
+    def negative_cache_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché negativa (CUPS sin datos)"""
+        if self.negative_cache is None:
+            return {'enabled': False}
+        return {'enabled': True, 'check_interval': self.negative_check_interval, **self.negative_cache.stats()}
+
+    def inflight_stats(self) -> Dict[str, Any]:
+        """Estadísticas de coalescencia de peticiones concurrentes"""
+        return self._inflight.stats()
@@ -12,13 +12,31 @@ Fecha: 2026-02-03
 import os
 import sys
 import json
-import requests
+import logging
+import sqlite3
+import time
+import contextvars
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-import mysql.connector
+from typing import Dict, Iterator, List, Optional, Any, Tuple
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout
 from mysql.connector import Error
 import argparse
 
+from sips_pool import MySQLPool
+from sips_couch import CouchBulkWriter, create_couch_session, couch_request
+from sips_dedupe import CouchDedupe, payload_hash, stable_doc_id
+from sips_spool import CouchSpool
+from sips_docs import SCHEMA_VERSION, compact_document
+from sips_couch_read import ensure_index, find_latest, sips_from_document
+from sips_result_cache import NegativeCache, ResultCache, SingleFlight
+from sips_metrics import count_couch_error, count_lookup, stage, timed
+from sips_logging import get_logger, setup_logging
+from sips_stream import demand_record, export_ndjson
+from sips_columnar import DemandColumns, columns_from_rows
+from sips_optimizer import optimize_sips_data
+from sips_summary import SUMMARY_QUERY, CURRENT_POWERS_QUERY, summary_from_aggregates, summarize_demand_data
+
 # Intentar cargar variables de entorno desde .env
 try:
     from dotenv import load_dotenv
@@ -26,6 +44,10 @@ try:
 except ImportError:
     pass  # dotenv no instalado, usar variables de sistema
 
+logger = get_logger(__name__)
+
+BANNER = '=' * 60
+
 
 class SIPSClient:
     """Cliente para extraer histórico SIPS desde CRM"""
@@ -39,6 +61,9 @@ class SIPSClient:
         couchdb_url: str = None,
         couchdb_user: str = None,
         couchdb_password: str = None,
+        pool_size: int = None,
+        result_cache: Optional[ResultCache] = None,
+        parallel_fetch: bool = None,
     ):
         # Usar variables de entorno como fallback
         self.db_host = db_host or os.getenv('CRM_DB_HOST', 'localhost')
@@ -51,43 +76,149 @@ class SIPSClient:
         self.couchdb_password = couchdb_password or os.getenv('COUCHDB_PASSWORD', '')
         self.couchdb_db = os.getenv('COUCHDB_DATABASE', 'sips_history')
 
-        self.connection = None
+        # Pool de conexiones MySQL (una conexión por llamada)
+        self.pool_size = pool_size or int(os.getenv('CRM_DB_POOL_SIZE', 10))
+        self.pool_recycle = int(os.getenv('CRM_DB_POOL_RECYCLE', 300))
+        self.pool_timeout = float(os.getenv('CRM_DB_POOL_TIMEOUT', 10))
+
+        self.pool = None
+        self._pool_lock = threading.Lock()
+
+        # Filas por bloque al leer consumos_historicos en streaming
+        self.stream_chunk_size = int(os.getenv('SIPS_STREAM_CHUNK_SIZE', 1000))
+
+        # Consultas de sips_cache, consumos_historicos y factura en paralelo
+        if parallel_fetch is None:
+            parallel_fetch = os.getenv('CRM_PARALLEL_FETCH', 'false').lower() == 'true'
+        self.parallel_fetch = parallel_fetch
+        self.hedge_delay = float(os.getenv('CRM_HEDGE_DELAY_MS', 0)) / 1000
+        self._fetch_executor = None
+
+        # Sesión HTTP persistente con CouchDB (pool igual a la concurrencia)
+        self.couch_pool_size = int(os.getenv('COUCHDB_POOL_SIZE', self.pool_size))
+        self.couch_retries = int(os.getenv('COUCHDB_RETRIES', 3))
+        self.couch_backoff = float(os.getenv('COUCHDB_BACKOFF', 0.5))
+        self.couch_timeout = float(os.getenv('COUCHDB_TIMEOUT', 10))
+        self.couch_gzip = os.getenv('COUCHDB_GZIP', 'false').lower() == 'true'
+        self._couch_session = None
+
+        # Escritor bulk de CouchDB (se crea bajo demanda)
+        self.couch_bulk_size = int(os.getenv('COUCHDB_BULK_SIZE', 100))
+        self.couch_bulk_interval = float(os.getenv('COUCHDB_BULK_INTERVAL', 2))
+        self._couch_writer = None
+
+        # Documento único por CUPS; se omiten las escrituras sin cambios
+        self.couch_dedupe = os.getenv('COUCHDB_DEDUPE', 'false').lower() == 'true'
+        self._dedupe = None
+
+        # Escritura diferida: spool en disco que se envía en segundo plano
+        self.couch_write_behind = os.getenv('COUCHDB_WRITE_BEHIND', 'false').lower() == 'true'
+        self._couch_spool = None
+
+        # Esquema de documento (2: sin datos duplicados, ver sips_docs) y
+        # demand_data como adjunto gzip
+        self.couch_schema_version = int(os.getenv('COUCHDB_SCHEMA_VERSION', SCHEMA_VERSION))
+        self.couch_demand_attachment = os.getenv('COUCHDB_DEMAND_ATTACHMENT', 'false').lower() == 'true'
+
+        # Lectura desde CouchDB antes que MySQL si el documento más reciente
+        # tiene menos de COUCHDB_READ_MAX_AGE segundos (0: desactivado)
+        self.couch_read_max_age = float(os.getenv('COUCHDB_READ_MAX_AGE', 0))
+        self.couch_read_timeout = float(os.getenv('COUCHDB_READ_TIMEOUT', 2))
+        self._couch_index_ready = False
+        self._couch_read_stats = {'hits': 0, 'misses': 0, 'errors': 0}
+
+        # Caché en memoria de resultados de get_sips_history (opcional)
+        self.result_cache = result_cache
+
+        # Resúmenes ya agregados del JSON de sips_cache, por (cups, date_add)
+        self.summary_cache = ResultCache(
+            ttl=float(os.getenv('SIPS_SUMMARY_CACHE_TTL', 86400)),
+            max_bytes=int(float(os.getenv('SIPS_SUMMARY_CACHE_MAX_MB', 16)) * 1024 * 1024)
+        )
+
+        # CUPS sin datos: se recuerdan unos segundos para no repetir las dos
+        # consultas (se vacía si aparecen filas nuevas en sips_cache)
+        negative_ttl = float(os.getenv('SIPS_NEGATIVE_CACHE_TTL', 60))
+        self.negative_cache = NegativeCache(
+            ttl=negative_ttl,
+            max_entries=int(os.getenv('SIPS_NEGATIVE_CACHE_MAX', 10000))
+        ) if negative_ttl > 0 else None
+        self.negative_check_interval = float(os.getenv('SIPS_NEGATIVE_CACHE_CHECK', 5))
+        self._negative_checked_at = 0.0
+        self._negative_check_lock = threading.Lock()
+
+        # Errores de consulta: un "sin datos" con errores no se cachea
+        self._query_errors = 0
+
+        # Peticiones concurrentes idénticas comparten una única consulta
+        self._inflight = SingleFlight()
 
     def connect_db(self) -> bool:
-        """Conecta a la base de datos MySQL del CRM"""
-        try:
-            self.connection = mysql.connector.connect(
+        """Crea el pool de conexiones a la base de datos MySQL del CRM"""
+        with self._pool_lock:
+            if self.pool is not None:
+                return True
+
+            pool = MySQLPool(
+                size=self.pool_size,
+                recycle=self.pool_recycle,
+                timeout=self.pool_timeout,
                 host=self.db_host,
                 user=self.db_user,
                 password=self.db_password,
                 database=self.db_name
             )
 
-            if self.connection.is_connected():
-                db_info = self.connection.get_server_info()
-                print(f"✅ Conectado a MySQL Server versión {db_info}")
-                print(f"   Base de datos: {self.db_name}")
-                return True
+            try:
+                with pool.connection() as conn:
+                    db_info = conn.get_server_info()
+            except Error as e:
+                pool.close()
+                logger.error("❌ Error al conectar a MySQL: %s", e)
+                return False
 
-        except Error as e:
-            print(f"❌ Error al conectar a MySQL: {e}")
-            return False
+            self.pool = pool
+            logger.info(
+                "✅ Conectado a MySQL Server versión %s\n   Base de datos: %s\n   Pool de conexiones: %s",
+                db_info, self.db_name, self.pool_size,
+                extra={'database': self.db_name, 'pool_size': self.pool_size}
+            )
+            return True
 
     def disconnect_db(self):
-        """Cierra la conexión a MySQL"""
-        if self.connection and self.connection.is_connected():
-            self.connection.close()
-            print("🔒 Conexión a MySQL cerrada")
+        """Cierra el pool de conexiones a MySQL"""
+        with self._pool_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+                logger.info("🔒 Conexión a MySQL cerrada")
+
+    def get_fetch_executor(self) -> ThreadPoolExecutor:
+        """Hilos para las consultas paralelas (uno por conexión del pool)"""
+        if self._fetch_executor is None:
+            with self._pool_lock:
+                if self._fetch_executor is None:
+                    self._fetch_executor = ThreadPoolExecutor(
+                        max_workers=self.pool_size,
+                        thread_name_prefix='sips-fetch'
+                    )
+        return self._fetch_executor
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """Estadísticas del pool de conexiones MySQL"""
+        if self.pool is None:
+            return {'connected': False}
+        return {'connected': True, **self.pool.stats()}
 
     def get_sips_from_cache(self, cups: str) -> Optional[Dict[str, Any]]:
         """Obtiene datos SIPS desde la tabla sips_cache"""
-        if not self.connection or not self.connection.is_connected():
-            print("❌ No hay conexión a la base de datos")
+        if self.pool is None:
+            logger.error("❌ No hay conexión a la base de datos")
+            self._count_query_error()
+            count_lookup('sips_cache', 'error')
             return None
 
         try:
-            cursor = self.connection.cursor(dictionary=True)
-
             query = """
                 SELECT cups, data, date_add
                 FROM sips_cache
@@ -96,38 +227,193 @@ class SIPSClient:
                 LIMIT 1
             """
 
-            cursor.execute(query, (cups,))
-            row = cursor.fetchone()
-            cursor.close()
+            with self.pool.connection() as conn:
+                with stage('sips_cache_query'):
+                    cursor = conn.cursor(dictionary=True)
+                    cursor.execute(query, (cups,))
+                    row = cursor.fetchone()
+                    cursor.close()
 
             if not row:
-                print(f"⚠️  No se encontraron datos SIPS en caché para: {cups}")
+                logger.debug("⚠️  No se encontraron datos SIPS en caché para: %s", cups, extra={'cups': cups})
+                count_lookup('sips_cache', 'miss')
                 return None
 
             try:
-                sips_data = json.loads(row['data'])
+                with stage('json_parse'):
+                    sips_data = json.loads(row['data'])
             except json.JSONDecodeError as e:
-                print(f"❌ Error al parsear JSON de sips_cache: {e}")
+                logger.error("❌ Error al parsear JSON de sips_cache: %s", e, extra={'cups': cups})
+                self._count_query_error()
+                count_lookup('sips_cache', 'error')
                 return None
 
-            print(f"✅ Datos SIPS obtenidos desde caché:")
-            print(f"   - CUPS: {cups}")
-            print(f"   - Fecha caché: {row['date_add']}")
+            count_lookup('sips_cache', 'hit')
+            logger.debug(
+                "✅ Datos SIPS obtenidos desde caché:\n   - CUPS: %s\n   - Fecha caché: %s",
+                cups, row['date_add'], extra={'cups': cups}
+            )
 
             return sips_data
 
         except Error as e:
-            print(f"❌ Error en query: {e}")
+            logger.error("❌ Error en query: %s", e, extra={'cups': cups})
+            self._count_query_error()
+            count_lookup('sips_cache', 'error')
             return None
 
+    def _count_query_error(self):
+        with self._pool_lock:
+            self._query_errors += 1
+
+    def get_sips_from_cache_many(
+        self,
+        cups_list: List[str],
+        chunk_size: int = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Obtiene el último registro de sips_cache para muchos CUPS a la vez
+
+        Hace una query por bloque de `chunk_size` CUPS (latest-per-group)
+        en lugar de una query por CUPS.
+
+        Args:
+            cups_list: CUPS a consultar (se ignoran vacíos y duplicados)
+            chunk_size: CUPS por query (default: SIPS_CACHE_CHUNK_SIZE o 500)
+
+        Returns:
+            Dict {cups: datos SIPS}. Los CUPS sin datos no aparecen; los que
+            fallan (JSON inválido o error de consulta) van con None para que
+            get_sips() los vuelva a leer uno a uno y el error cuente allí
+            (sin caché negativa).
+        """
+        if self.pool is None:
+            logger.error("❌ No hay conexión a la base de datos")
+            return {}
+
+        chunk_size = chunk_size or int(os.getenv('SIPS_CACHE_CHUNK_SIZE', 500))
+        unique_cups = list(dict.fromkeys(c for c in cups_list if c))
+        found = {}
+        errors = 0
+        fallback = set()  # CUPS consultados uno a uno (ya contados en get_sips_from_cache)
+
+        for start in range(0, len(unique_cups), chunk_size):
+            chunk = unique_cups[start:start + chunk_size]
+            placeholders = ', '.join(['%s'] * len(chunk))
+
+            query = f"""
+                SELECT s.cups, s.data, s.date_add
+                FROM sips_cache s
+                JOIN (
+                    SELECT cups, MAX(date_add) AS max_date
+                    FROM sips_cache
+                    WHERE cups IN ({placeholders})
+                    GROUP BY cups
+                ) latest
+                ON latest.cups = s.cups AND latest.max_date = s.date_add
+            """
+
+            try:
+                with self.pool.connection() as conn:
+                    with stage('sips_cache_query'):
+                        cursor = conn.cursor(dictionary=True)
+                        cursor.execute(query, tuple(chunk))
+                        rows = cursor.fetchall()
+                        cursor.close()
+            except Error as e:
+                # Si falla el bloque, consultar sus CUPS uno a uno
+                logger.error("❌ Error en query: %s", e)
+                fallback.update(chunk)
+                for cups in chunk:
+                    errors_before = self._query_errors
+                    sips_data = self.get_sips_from_cache(cups)
+                    if sips_data or self._query_errors != errors_before:
+                        found[cups] = sips_data
+                continue
+
+            with stage('json_parse'):
+                for row in rows:
+                    # Empates en date_add: nos quedamos con el primero
+                    if row['cups'] in found:
+                        continue
+                    try:
+                        found[row['cups']] = json.loads(row['data'])
+                    except (TypeError, json.JSONDecodeError) as e:
+                        logger.error("❌ Error al parsear JSON de sips_cache: %s", e, extra={'cups': row['cups']})
+                        self._count_query_error()
+                        found[row['cups']] = None
+                        errors += 1
+
+        loaded = sum(1 for sips_data in found.values() if sips_data is not None)
+        bulk_found = sum(1 for cups, sips_data in found.items() if sips_data is not None and cups not in fallback)
+        count_lookup('sips_cache', 'hit', bulk_found)
+        count_lookup('sips_cache', 'miss', len(unique_cups) - len(fallback) - bulk_found - errors)
+        count_lookup('sips_cache', 'error', errors)
+
+        logger.debug(
+            "✅ sips_cache: %s/%s CUPS encontrados%s",
+            loaded, len(unique_cups), f" ({errors} con JSON inválido)" if errors else ""
+        )
+
+        return found
+
+    def iter_sips_cache(self, chunk_size: int = None) -> Iterator[Tuple[str, str]]:
+        """
+        Último registro de sips_cache de cada CUPS, recorriendo la tabla
+        completa por páginas, como (cups, JSON sin parsear)
+
+        Cada página es la misma query latest-per-group que
+        get_sips_from_cache_many, limitada a `chunk_size` CUPS y paginada
+        por clave (cups > último CUPS de la página anterior): el histórico
+        no sale del servidor y la conexión se devuelve al pool entre
+        páginas.
+
+        El JSON se devuelve sin parsear para que lo haga quien lo consume
+        (por ejemplo, los workers de sips_fleet).
+        """
+        if self.pool is None and not self.connect_db():
+            raise Error(msg="No hay conexión a la base de datos")
+
+        chunk_size = chunk_size or self.stream_chunk_size
+
+        query = """
+            SELECT s.cups, s.data
+            FROM sips_cache s
+            JOIN (
+                SELECT cups, MAX(date_add) AS max_date
+                FROM sips_cache
+                WHERE cups > %s
+                GROUP BY cups
+                ORDER BY cups
+                LIMIT %s
+            ) latest
+            ON latest.cups = s.cups AND latest.max_date = s.date_add
+            ORDER BY s.cups
+        """
+
+        last_cups = ''
+        while True:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, (last_cups, chunk_size))
+                rows = cursor.fetchall()
+                cursor.close()
+
+            if not rows:
+                return
+
+            for cups, data in rows:
+                # Empates en date_add: nos quedamos con el primero
+                if cups != last_cups:
+                    last_cups = cups
+                    yield cups, data
+
     def get_invoice_data(self, invoice_id: int) -> Optional[Dict[str, Any]]:
         """Obtiene datos de una factura específica"""
-        if not self.connection or not self.connection.is_connected():
+        if self.pool is None:
             return None
 
         try:
-            cursor = self.connection.cursor(dictionary=True)
-
             query = """
                 SELECT
                     id_invoice,
@@ -146,16 +432,53 @@ class SIPSClient:
                 WHERE id_invoice = %s
             """
 
-            cursor.execute(query, (invoice_id,))
-            row = cursor.fetchone()
-            cursor.close()
+            with self.pool.connection() as conn:
+                with stage('invoice_lookup'):
+                    cursor = conn.cursor(dictionary=True)
+                    cursor.execute(query, (invoice_id,))
+                    row = cursor.fetchone()
+                    cursor.close()
 
             return row
 
         except Error as e:
-            print(f"❌ Error al obtener datos de factura: {e}")
+            logger.error("❌ Error al obtener datos de factura: %s", e, extra={'invoice_id': invoice_id})
             return None
 
+    def iter_consumos_rows(
+        self,
+        cups: str,
+        months: int = 12,
+        chunk_size: int = None
+    ) -> Iterator[tuple]:
+        """
+        Filas de consumos_historicos en streaming, de la más reciente a la
+        más antigua, como tuplas (ver sips_stream.CONSUMOS_COLUMNS)
+
+        Las filas se leen por bloques con un cursor sin buffer, así la
+        memoria no crece con el número de meses. La conexión del pool queda
+        ocupada mientras se itera: consumir el generador o cerrarlo.
+        """
+        if self.pool is None and not self.connect_db():
+            raise Error(msg="No hay conexión a la base de datos")
+
+        date_limit = datetime.now() - timedelta(days=months * 30)
+
+        query = """
+            SELECT
+                fecha_lectura,
+                periodo,
+                consumo_kwh,
+                potencia_contratada,
+                potencia_maxima
+            FROM consumos_historicos
+            WHERE cups = %s
+            AND fecha_lectura >= %s
+            ORDER BY fecha_lectura DESC
+        """
+
+        yield from self.pool.iter_query(query, (cups, date_limit), chunk_size or self.stream_chunk_size)
+
     def get_sips_data_by_cups(
         self,
         cups: str,
@@ -163,57 +486,34 @@ class SIPSClient:
         optimize_p6: bool = False
     ) -> Optional[Dict[str, Any]]:
         """Extrae datos SIPS desde consumos_historicos"""
-        if not self.connection or not self.connection.is_connected():
-            print("❌ No hay conexión a la base de datos")
+        if self.pool is None:
+            logger.error("❌ No hay conexión a la base de datos")
+            self._count_query_error()
+            count_lookup('consumos_historicos', 'error')
             return None
 
         try:
-            cursor = self.connection.cursor(dictionary=True)
-
-            date_limit = datetime.now() - timedelta(days=months * 30)
-
-            query = """
-                SELECT
-                    cups,
-                    fecha_lectura,
-                    periodo,
-                    consumo_kwh,
-                    potencia_contratada,
-                    potencia_maxima,
-                    precio_energia,
-                    precio_potencia
-                FROM consumos_historicos
-                WHERE cups = %s
-                AND fecha_lectura >= %s
-                ORDER BY fecha_lectura DESC
-            """
-
-            cursor.execute(query, (cups, date_limit))
-            rows = cursor.fetchall()
-
-            if not rows:
-                print(f"⚠️ No se encontraron datos para CUPS: {cups}")
-                return None
-
             demand_data = []
             current_powers = {}
             periods = set()
 
-            for row in rows:
-                periodo = row['periodo']
-                periods.add(periodo)
+            # Filas procesadas según llegan de MySQL (sin fetchall)
+            with stage('consumos_query'):
+                for row in self.iter_consumos_rows(cups, months):
+                    _, periodo, _, potencia_contratada, _ = row
+                    periods.add(periodo)
 
-                demand_data.append({
-                    'fecha': row['fecha_lectura'].isoformat() if row['fecha_lectura'] else None,
-                    'periodo': periodo,
-                    'consumo_kwh': float(row['consumo_kwh']) if row['consumo_kwh'] else 0,
-                    'potencia_maxima': float(row['potencia_maxima']) if row['potencia_maxima'] else 0,
-                })
+                    demand_data.append(demand_record(row))
 
-                if periodo not in current_powers:
-                    current_powers[periodo] = float(row['potencia_contratada']) if row['potencia_contratada'] else 0
+                    if periodo not in current_powers:
+                        current_powers[periodo] = float(potencia_contratada) if potencia_contratada else 0
 
-            cursor.close()
+            if not demand_data:
+                logger.debug("⚠️ No se encontraron datos para CUPS: %s", cups, extra={'cups': cups})
+                count_lookup('consumos_historicos', 'miss')
+                return None
+
+            count_lookup('consumos_historicos', 'hit')
 
             result = {
                 'cups': cups,
@@ -226,39 +526,151 @@ class SIPSClient:
                 'query_date': datetime.now().isoformat()
             }
 
-            print(f"✅ Datos SIPS extraídos para {cups}:")
-            print(f"   - Registros: {len(demand_data)}")
-            print(f"   - Periodos: {', '.join(sorted(periods))}")
-            print(f"   - Potencias actuales: {current_powers}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "✅ Datos SIPS extraídos para %s:\n   - Registros: %s\n   - Periodos: %s\n"
+                    "   - Potencias actuales: %s",
+                    cups, len(demand_data), ', '.join(result['periods']), current_powers,
+                    extra={'cups': cups, 'records': len(demand_data)}
+                )
 
             return result
 
         except Error as e:
-            print(f"❌ Error en query: {e}")
+            logger.error("❌ Error en query: %s", e, extra={'cups': cups})
+            self._count_query_error()
+            count_lookup('consumos_historicos', 'error')
             return None
 
-    def save_to_couchdb(
+    @timed('summary')
+    def get_sips_summary(self, cups: str, months: int = 12) -> Optional[Dict[str, Any]]:
+        """
+        Resumen compacto por periodo y mes, sin demand_data (ver sips_summary)
+
+        Si el CUPS está en sips_cache se agrega su JSON en Python una sola
+        vez por registro (memoizado por CUPS y date_add); si no, se agrega
+        consumos_historicos en MySQL con GROUP BY.
+        """
+        if self.pool is None and not self.connect_db():
+            return None
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT date_add FROM sips_cache WHERE cups = %s ORDER BY date_add DESC LIMIT 1",
+                    (cups,)
+                )
+                row = cursor.fetchone()
+                cursor.close()
+
+            if not row:
+                return self._summary_from_consumos(cups, months)
+
+            key = (cups, row[0])
+            summary = self.summary_cache.get(key)
+            if summary is not None:
+                logger.debug("⚡ Resumen de %s servido desde caché", cups, extra={'cups': cups})
+                return dict(summary)
+
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT data FROM sips_cache WHERE cups = %s AND date_add = %s LIMIT 1",
+                    key
+                )
+                data_row = cursor.fetchone()
+                cursor.close()
+
+            try:
+                sips_data = json.loads(data_row[0]) if data_row else None
+            except (TypeError, json.JSONDecodeError) as e:
+                logger.error("❌ Error al parsear JSON de sips_cache: %s", e, extra={'cups': cups})
+                sips_data = None
+
+            summary = summarize_demand_data(cups, sips_data) if sips_data else None
+            if summary is None:
+                return self._summary_from_consumos(cups, months)
+
+            summary['cache_date'] = str(row[0])
+            self.summary_cache.put(key, dict(summary))
+            logger.debug(
+                "✅ Resumen de %s agregado desde sips_cache (%s registros)", cups, summary['records'],
+                extra={'cups': cups}
+            )
+            return summary
+
+        except Error as e:
+            logger.error("❌ Error en query: %s", e, extra={'cups': cups})
+            return None
+
+    def _summary_from_consumos(self, cups: str, months: int) -> Optional[Dict[str, Any]]:
+        """Resumen agregado en MySQL sobre consumos_historicos"""
+        date_limit = datetime.now() - timedelta(days=months * 30)
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SUMMARY_QUERY, (cups, date_limit))
+            rows = cursor.fetchall()
+            cursor.execute(CURRENT_POWERS_QUERY, (cups, date_limit, cups))
+            power_rows = cursor.fetchall()
+            cursor.close()
+
+        summary = summary_from_aggregates(cups, rows, power_rows)
+        if summary is None:
+            logger.debug("⚠️ No se encontraron datos para CUPS: %s", cups, extra={'cups': cups})
+            return None
+
+        summary['months'] = months
+        logger.debug(
+            "✅ Resumen de %s agregado en MySQL (%s registros)", cups, summary['records'], extra={'cups': cups}
+        )
+        return summary
+
+    def get_demand_columns(self, cups: str, months: int = 12) -> Optional[DemandColumns]:
+        """
+        demand_data de consumos_historicos en columnas NumPy (ver
+        sips_columnar), construido desde el cursor en streaming sin pasar
+        por un dict por lectura
+        """
+        columns = columns_from_rows(self.iter_consumos_rows(cups, months))
+        return columns if len(columns) else None
+
+    def build_couch_document(
         self,
         sips_data: Dict[str, Any],
         invoice_id: Optional[int] = None,
         source: str = "python_client"
-    ) -> bool:
-        """Guarda los datos SIPS en CouchDB"""
+    ) -> Optional[Dict[str, Any]]:
+        """Construye el documento CouchDB para unos datos SIPS"""
         if not sips_data:
-            print("❌ No hay datos SIPS para guardar")
-            return False
+            logger.error("❌ No hay datos SIPS para guardar")
+            return None
 
         cups = sips_data.get('cups') or sips_data.get('CUPS')
         if not cups:
-            print("❌ No se encontró CUPS en los datos SIPS")
-            return False
+            logger.error("❌ No se encontró CUPS en los datos SIPS")
+            return None
 
         doc_id = f"sips_{cups}_{int(datetime.now().timestamp() * 1000)}"
 
+        if self.couch_schema_version >= SCHEMA_VERSION:
+            meta = {
+                '_id': doc_id,
+                'cups': cups,
+                'months': sips_data.get('months'),
+                'invoice_id': invoice_id,
+                'source': source,
+                'consulted_at': datetime.now().isoformat(),
+            }
+            return compact_document(sips_data, meta, self.couch_demand_attachment)
+
+        # Esquema 1 (COUCHDB_SCHEMA_VERSION=1): para lectores antiguos
         document = {
             '_id': doc_id,
             'type': 'sips_data',
             'cups': cups,
+            'months': sips_data.get('months'),
             'invoice_id': invoice_id,
             'source': source,
             'sips_raw_data': sips_data,
@@ -269,55 +681,433 @@ class SIPSClient:
             'records_found': len(sips_data.get('demand_data', [])),
         }
 
+        return document
+
+    @timed('couch_write')
+    def save_to_couchdb(
+        self,
+        sips_data: Dict[str, Any],
+        invoice_id: Optional[int] = None,
+        source: str = "python_client"
+    ) -> bool:
+        """Guarda los datos SIPS en CouchDB"""
+        document = self.build_couch_document(sips_data, invoice_id, source)
+        if not document:
+            return False
+
+        if self.couch_write_behind:
+            result = self._spool_document(document, sips_data, invoice_id)
+            if result.get('queued'):
+                logger.debug("📥 Encolado para CouchDB: %s", result['id'], extra={'doc_id': result['id']})
+            elif result.get('skipped'):
+                logger.debug("⏭️  Sin cambios, no se guarda en CouchDB: %s", result['id'], extra={'doc_id': result['id']})
+            return result['ok']
+
+        if self.couch_dedupe:
+            return self._save_deduped(document, payload_hash(sips_data, invoice_id))
+
         try:
             url = f"{self.couchdb_url}/{self.couchdb_db}"
 
-            response = requests.post(
+            response = couch_request(
+                self.get_couch_session(),
+                'POST',
                 url,
-                auth=(self.couchdb_user, self.couchdb_password),
-                headers={'Content-Type': 'application/json'},
-                json=document,
-                timeout=10
+                document,
+                timeout=self.couch_timeout,
+                compress=self.couch_gzip
             )
 
             if response.status_code in [200, 201]:
                 result = response.json()
-                print(f"✅ Guardado en CouchDB:")
-                print(f"   - Document ID: {result.get('id')}")
-                print(f"   - Revision: {result.get('rev')}")
+                logger.debug(
+                    "✅ Guardado en CouchDB:\n   - Document ID: %s\n   - Revision: %s",
+                    result.get('id'), result.get('rev'), extra={'doc_id': result.get('id')}
+                )
+                return True
+            elif response.status_code == 409 and '_rev' not in document:
+                # El _id es único: lo guardó un intento anterior cuya respuesta se perdió
+                logger.debug("✅ Ya estaba guardado en CouchDB: %s", document['_id'], extra={'doc_id': document['_id']})
                 return True
             else:
-                print(f"❌ Error al guardar en CouchDB: {response.status_code}")
-                print(f"   Response: {response.text}")
+                logger.error(
+                    "❌ Error al guardar en CouchDB: %s\n   Response: %s", response.status_code, response.text,
+                    extra={'doc_id': document['_id']}
+                )
+                count_couch_error('write')
                 return False
 
         except Exception as e:
-            print(f"❌ Error de conexión a CouchDB: {e}")
+            logger.error("❌ Error de conexión a CouchDB: %s", e, extra={'doc_id': document['_id']})
+            count_couch_error('write')
             return False
 
+    def get_couch_dedupe(self) -> CouchDedupe:
+        """Obtiene (o crea) el deduplicador de escrituras (COUCHDB_DEDUPE)"""
+        with self._pool_lock:
+            if self._dedupe is None:
+                self._dedupe = CouchDedupe(
+                    self.get_couch_session,
+                    f"{self.couchdb_url}/{self.couchdb_db}",
+                    timeout=self.couch_timeout,
+                    compress=self.couch_gzip
+                )
+            return self._dedupe
+
+    def _save_deduped(self, document: Dict[str, Any], digest: str) -> bool:
+        """save_to_couchdb con _id estable: omite la escritura si el hash no cambia"""
+        dedupe = self.get_couch_dedupe()
+        prepared = dedupe.prepare(document, digest)
+
+        if prepared is None:
+            doc_id = stable_doc_id(document['cups'])
+            logger.debug("⏭️  Sin cambios, no se guarda en CouchDB: %s", doc_id, extra={'doc_id': doc_id})
+            return True
+
+        result = dedupe.save(prepared)
+
+        if result['ok'] and result.get('skipped'):
+            logger.debug("⏭️  Sin cambios, no se guarda en CouchDB: %s", result['id'], extra={'doc_id': result['id']})
+            return True
+        if result['ok']:
+            logger.debug(
+                "✅ Guardado en CouchDB:\n   - Document ID: %s\n   - Revision: %s",
+                result['id'], result['rev'], extra={'doc_id': result['id']}
+            )
+            return True
+
+        logger.error(
+            "❌ Error al guardar en CouchDB: %s\n   Response: %s", result['error'], result.get('reason'),
+            extra={'doc_id': result.get('id')}
+        )
+        count_couch_error('write')
+        return False
+
+    def get_couch_spool(self, start: bool = True) -> CouchSpool:
+        """
+        Obtiene (o crea) el spool de escritura diferida (COUCHDB_WRITE_BEHIND)
+
+        Al crearlo arranca el hilo que lo vacía, que envía también lo que
+        quedó pendiente de ejecuciones anteriores.
+        """
+        with self._pool_lock:
+            if self._couch_spool is None:
+                self._couch_spool = CouchSpool(
+                    self.get_couch_session,
+                    f"{self.couchdb_url}/{self.couchdb_db}",
+                    batch_size=self.couch_bulk_size,
+                    compress=self.couch_gzip,
+                    on_result=self._spool_result
+                )
+                if start:
+                    self._couch_spool.start()
+            return self._couch_spool
+
+    def _spool_document(
+        self,
+        document: Dict[str, Any],
+        sips_data: Dict[str, Any],
+        invoice_id: Optional[int]
+    ) -> Dict[str, Any]:
+        """Guarda el documento en el spool sin esperar a CouchDB (resultado formato _bulk_docs)"""
+        if self.couch_dedupe:
+            dedupe = self.get_couch_dedupe()
+            prepared = dedupe.prepare(document, payload_hash(sips_data, invoice_id))
+            if prepared is None:
+                return dedupe.skipped_result(document)
+            document = prepared
+
+        try:
+            self.get_couch_spool().enqueue(document)
+        except sqlite3.Error as e:
+            logger.error("❌ Error al encolar en el spool de CouchDB: %s", e, extra={'doc_id': document['_id']})
+            count_couch_error('spool')
+            return {'id': document['_id'], 'ok': False, 'error': 'spool_error', 'reason': str(e)}
+
+        return {'id': document['_id'], 'ok': True, 'queued': True}
+
+    def _spool_result(self, document: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+        """Resultado final de un documento enviado desde el spool"""
+        if self.couch_dedupe and 'payload_hash' in document:
+            return self.get_couch_dedupe().complete(document, result)
+
+        if result.get('error') == 'conflict' and '_rev' not in document:
+            # El _id es único: un envío anterior llegó aunque se perdiera la respuesta
+            return {'id': document['_id'], 'ok': True, 'rev': None}
+
+        return result
+
+    def close_couch_spool(self):
+        """Intenta enviar lo pendiente y detiene el spool (lo que falle queda en disco)"""
+        spool = self._couch_spool
+        if spool is None:
+            return
+
+        if spool.acquire():
+            sent = spool.drain()
+            depth = spool.stats()['depth']
+            logger.info("📤 Spool CouchDB: %s enviados, %s pendientes", sent, depth)
+        spool.stop()
+
+    def spool_stats(self) -> Dict[str, Any]:
+        """Profundidad y contadores del spool de escritura diferida"""
+        if not self.couch_write_behind:
+            return {'enabled': False}
+        return {'enabled': True, **self.get_couch_spool().stats()}
+
+    def dedupe_stats(self) -> Dict[str, Any]:
+        """Estadísticas de escrituras deduplicadas en CouchDB"""
+        if not self.couch_dedupe:
+            return {'enabled': False}
+        return {'enabled': True, **self.get_couch_dedupe().stats()}
+
+    def ensure_couch_index(self) -> bool:
+        """Crea el índice Mango [cups, months, consulted_at] que usa get_sips_from_couch"""
+        if self._couch_index_ready:
+            return True
+
+        try:
+            self._couch_index_ready = ensure_index(
+                self.get_couch_session(),
+                f"{self.couchdb_url}/{self.couchdb_db}",
+                timeout=self.couch_timeout
+            )
+        except Exception as e:
+            logger.warning("⚠️  No se pudo crear el índice de lectura en CouchDB: %s", e)
+            return False
+
+        if self._couch_index_ready:
+            logger.info("🗂️  Índice de lectura CouchDB listo (máx. %.0f s)", self.couch_read_max_age)
+        return self._couch_index_ready
+
+    def get_sips_from_couch(
+        self,
+        cups: str,
+        invoice_id: Optional[int] = None,
+        months: int = 12
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Datos SIPS del documento CouchDB más reciente del CUPS para la misma
+        ventana de meses, si tiene menos de COUCHDB_READ_MAX_AGE segundos
+
+        Returns:
+            Datos SIPS, o None (sin documento reciente o CouchDB no disponible)
+        """
+        url = f"{self.couchdb_url}/{self.couchdb_db}"
+        self.ensure_couch_index()
+
+        try:
+            with stage('couch_read'):
+                session = self.get_couch_session()
+                document = find_latest(
+                    session, url, cups, invoice_id, months, self.couch_read_max_age, self.couch_read_timeout
+                )
+                sips_data = sips_from_document(document, session, url, self.couch_read_timeout) if document else None
+        except Exception as e:
+            logger.warning("⚠️  Error al leer de CouchDB, se consulta MySQL: %s", e, extra={'cups': cups})
+            self._count_couch_read('errors')
+            count_couch_error('read')
+            count_lookup('couchdb', 'error')
+            return None
+
+        if sips_data is None:
+            self._count_couch_read('misses')
+            count_lookup('couchdb', 'miss')
+            return None
+
+        self._count_couch_read('hits')
+        count_lookup('couchdb', 'hit')
+        logger.debug(
+            "🛋️  Datos SIPS servidos desde CouchDB (%s, %s)", document['_id'], document.get('consulted_at'),
+            extra={'cups': cups, 'doc_id': document['_id']}
+        )
+        return sips_data
+
+    def _count_couch_read(self, key: str):
+        with self._pool_lock:
+            self._couch_read_stats[key] += 1
+
+    def couch_read_stats(self) -> Dict[str, Any]:
+        """Estadísticas de lecturas servidas desde CouchDB"""
+        if not self.couch_read_max_age:
+            return {'enabled': False}
+        with self._pool_lock:
+            stats = dict(self._couch_read_stats)
+        return {'enabled': True, 'max_age_s': self.couch_read_max_age, 'index_ready': self._couch_index_ready, **stats}
+
+    def get_couch_session(self):
+        """Obtiene (o crea) la sesión HTTP persistente de CouchDB"""
+        if self._couch_session is None:
+            with self._pool_lock:
+                if self._couch_session is None:
+                    self._couch_session = create_couch_session(
+                        (self.couchdb_user, self.couchdb_password),
+                        pool_size=self.couch_pool_size,
+                        retries=self.couch_retries,
+                        backoff=self.couch_backoff
+                    )
+        return self._couch_session
+
+    def get_couch_writer(self) -> CouchBulkWriter:
+        """Obtiene (o crea) el escritor bulk de CouchDB"""
+        session = self.get_couch_session()
+        with self._pool_lock:
+            if self._couch_writer is None:
+                self._couch_writer = CouchBulkWriter(
+                    session,
+                    f"{self.couchdb_url}/{self.couchdb_db}",
+                    batch_size=self.couch_bulk_size,
+                    flush_interval=self.couch_bulk_interval,
+                    compress=self.couch_gzip
+                )
+            return self._couch_writer
+
+    @timed('couch_write')
+    def queue_to_couchdb(
+        self,
+        sips_data: Dict[str, Any],
+        invoice_id: Optional[int] = None,
+        source: str = "python_client"
+    ) -> Optional[Future]:
+        """
+        Encola los datos SIPS para guardarlos con _bulk_docs
+
+        Returns:
+            Future con el resultado del documento, o None si no hay datos
+        """
+        document = self.build_couch_document(sips_data, invoice_id, source)
+        if not document:
+            return None
+
+        if self.couch_write_behind:
+            future = Future()
+            future.set_result(self._spool_document(document, sips_data, invoice_id))
+            return future
+
+        if self.couch_dedupe:
+            dedupe = self.get_couch_dedupe()
+            prepared = dedupe.prepare(document, payload_hash(sips_data, invoice_id))
+            if prepared is None:
+                # Sin cambios: no se envía nada
+                future = Future()
+                future.set_result(dedupe.skipped_result(document))
+                return future
+            return dedupe.track_bulk(prepared, self.get_couch_writer().add(prepared))
+
+        return self.get_couch_writer().add(document)
+
+    @timed('couch_write')
+    def flush_couchdb(self) -> List[Dict[str, Any]]:
+        """Envía ya los documentos encolados con queue_to_couchdb"""
+        if self._couch_writer is None:
+            return []
+        return self._couch_writer.flush()
+
+    @timed('get_sips_history')
     def get_sips_history(
         self,
         cups: str,
         invoice_id: Optional[int] = None,
         months: int = 12,
         optimize_p6: bool = False,
-        save_to_couch: bool = True
+        save_to_couch: bool = True,
+        prefetched: Optional[Dict[str, Dict[str, Any]]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Método principal para obtener histórico SIPS
+
+        Si se pasa `prefetched` (resultado de get_sips_from_cache_many) no se
+        vuelve a consultar sips_cache para este CUPS.
+        """
+        logger.debug(
+            "\n%s\n📊 CONSULTANDO HISTÓRICO SIPS\n%s\nCUPS: %s\nMeses: %s\nInvoice ID: %s\n%s\n",
+            BANNER, BANNER, cups, months, invoice_id or 'N/A', BANNER,
+            extra={'cups': cups, 'months': months, 'invoice_id': invoice_id}
+        )
+
+        cache_key = (cups, months, invoice_id, optimize_p6)
+
+        if self.result_cache is not None:
+            cached = self.result_cache.get(cache_key)
+            count_lookup('result_cache', 'miss' if cached is None else 'hit')
+            if cached is not None:
+                logger.debug("⚡ Datos SIPS servidos desde caché en memoria", extra={'cups': cups})
+                sips_data = dict(cached)
+                if save_to_couch:
+                    self.save_to_couchdb(sips_data, invoice_id, "python_client")
+                return sips_data
+
+        if self.is_known_missing(cups, months):
+            logger.debug("🚫 CUPS sin datos (caché negativa), no se consulta MySQL", extra={'cups': cups})
+            count_lookup('negative_cache', 'hit')
+            return None
+
+        def load():
+            sips_data = None
+            errors_before = self._query_errors
+
+            # CouchDB como segundo nivel (salvo que sips_cache ya venga precargado)
+            if self.couch_read_max_age and not (prefetched and prefetched.get(cups) is not None):
+                sips_data = self.get_sips_from_couch(cups, invoice_id, months)
+            from_couch = sips_data is not None
+
+            if not from_couch:
+                sips_data = self._fetch_sips_history(cups, invoice_id, months, optimize_p6, prefetched)
+
+            if not sips_data:
+                # Solo un "no hay datos" limpio; con errores de consulta se reintenta
+                if self.negative_cache is not None and self.pool is not None and self._query_errors == errors_before:
+                    self.negative_cache.add((cups, months))
+                return None
+
+            # Ventana de la consulta (los datos de sips_cache no la traen): el
+            # documento de CouchDB solo se servirá a consultas con los mismos meses
+            sips_data.setdefault('months', months)
+
+            if optimize_p6:
+                sips_data['optimization'] = self.optimize_powers(sips_data)
+
+            if self.result_cache is not None:
+                self.result_cache.put(cache_key, dict(sips_data))
+
+            # Guardar en CouchDB si está habilitado (no si se acaba de leer de ahí)
+            if save_to_couch and not from_couch:
+                self.save_to_couchdb(sips_data, invoice_id, "python_client")
+
+            return sips_data
+
+        sips_data, shared = self._inflight.do(
+            (cups, months, invoice_id, optimize_p6, save_to_couch), load
+        )
+
+        if shared:
+            logger.debug("🔗 Resultado compartido con una consulta en curso del mismo CUPS", extra={'cups': cups})
+            return dict(sips_data) if sips_data else None
+
+        return sips_data
+
+    def _fetch_sips_history(
+        self,
+        cups: str,
+        invoice_id: Optional[int],
+        months: int,
+        optimize_p6: bool,
+        prefetched: Optional[Dict[str, Dict[str, Any]]]
     ) -> Optional[Dict[str, Any]]:
-        """Método principal para obtener histórico SIPS"""
-        print(f"\n{'='*60}")
-        print(f"📊 CONSULTANDO HISTÓRICO SIPS")
-        print(f"{'='*60}")
-        print(f"CUPS: {cups}")
-        print(f"Meses: {months}")
-        print(f"Invoice ID: {invoice_id or 'N/A'}")
-        print(f"{'='*60}\n")
-
-        if not self.connection or not self.connection.is_connected():
+        """Consulta MySQL: sips_cache, consumos_historicos y factura"""
+        if self.pool is None:
             if not self.connect_db():
                 return None
 
-        # Intentar primero desde sips_cache
-        sips_data = self.get_sips_from_cache(cups)
+        if self.parallel_fetch:
+            return self._fetch_parallel(cups, invoice_id, months, optimize_p6, prefetched)
+
+        # Intentar primero desde sips_cache (None en prefetched: falló la
+        # lectura en bloque, se repite la individual)
+        if prefetched is not None and prefetched.get(cups, {}) is not None:
+            sips_data = dict(prefetched[cups]) if cups in prefetched else None
+        else:
+            sips_data = self.get_sips_from_cache(cups)
 
         # Si no hay en caché, buscar en consumos_historicos
         if not sips_data:
@@ -332,25 +1122,226 @@ class SIPSClient:
             if invoice_data:
                 sips_data['invoice_data'] = invoice_data
 
-        # Guardar en CouchDB si está habilitado
-        if save_to_couch:
-            self.save_to_couchdb(sips_data, invoice_id, "python_client")
+        return sips_data
+
+    def _fetch_parallel(
+        self,
+        cups: str,
+        invoice_id: Optional[int],
+        months: int,
+        optimize_p6: bool,
+        prefetched: Optional[Dict[str, Dict[str, Any]]]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Como _fetch_sips_history, pero con las consultas en paralelo, cada
+        una en su conexión del pool: el fallo de caché cuesta la más lenta
+        de las consultas y no la suma de las tres
+
+        La consulta a consumos_historicos se lanza si sips_cache no ha
+        respondido en hedge_delay segundos (0 = a la vez). Si sips_cache
+        tiene datos, se prefieren y el resultado de consumos se descarta.
+        """
+        executor = self.get_fetch_executor()
+
+        def submit(fn, *args):
+            # Con el contexto de la petición: sus etapas cuentan en el desglose
+            return executor.submit(contextvars.copy_context().run, fn, *args)
+
+        invoice_future = submit(self.get_invoice_data, invoice_id) if invoice_id else None
+        consumos_future = None
+
+        # None en prefetched: falló la lectura en bloque, se repite la individual
+        if prefetched is not None and prefetched.get(cups, {}) is not None:
+            sips_data = dict(prefetched[cups]) if cups in prefetched else None
+        else:
+            cache_future = submit(self.get_sips_from_cache, cups)
+            try:
+                sips_data = cache_future.result(timeout=self.hedge_delay)
+            except FuturesTimeout:
+                consumos_future = submit(self.get_sips_data_by_cups, cups, months, optimize_p6)
+                sips_data = cache_future.result()
+
+        if sips_data:
+            if consumos_future is not None:
+                consumos_future.cancel()
+        else:
+            if consumos_future is None:
+                consumos_future = submit(self.get_sips_data_by_cups, cups, months, optimize_p6)
+            sips_data = consumos_future.result()
+
+        if not sips_data:
+            if invoice_future is not None:
+                invoice_future.cancel()
+            return None
+
+        if invoice_future is not None:
+            invoice_data = invoice_future.result()
+            if invoice_data:
+                sips_data['invoice_data'] = invoice_data
 
         return sips_data
 
+    @timed('optimize')
+    def optimize_powers(self, sips_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Potencias contratadas óptimas y ahorro estimado (ver sips_optimizer)"""
+        try:
+            optimization = optimize_sips_data(sips_data)
+        except Exception as e:
+            optimization = {'error': str(e)}
+
+        if 'error' in optimization:
+            logger.warning("⚠️  No se pudo optimizar la potencia: %s", optimization['error'], extra={'cups': sips_data.get('cups')})
+        elif optimization['savings'] is not None:
+            logger.debug(
+                "⚙️  Potencias óptimas: %s\n   - Ahorro estimado: %s € (%s%%)",
+                optimization['optimal_powers'], optimization['savings'], optimization['savings_pct']
+            )
+        else:
+            logger.debug("⚙️  Potencias óptimas: %s", optimization['optimal_powers'])
+
+        return optimization
+
+    def is_known_missing(self, cups: str, months: int = 12) -> bool:
+        """
+        True si el CUPS está en la caché negativa (consultado hace poco y sin
+        datos)
+
+        Cada SIPS_NEGATIVE_CACHE_CHECK segundos, como mucho, consulta
+        MAX(date_add) de sips_cache: si ha avanzado se vacía la caché negativa.
+        """
+        if self.negative_cache is None:
+            return False
+
+        self._refresh_negative_generation()
+        return self.negative_cache.contains((cups, months))
+
+    def _refresh_negative_generation(self):
+        """Vacía la caché negativa si hay filas nuevas en sips_cache"""
+        now = time.monotonic()
+        if self.pool is None or now - self._negative_checked_at < self.negative_check_interval:
+            return
+
+        # Un solo hilo comprueba; el resto sigue con la generación conocida
+        if not self._negative_check_lock.acquire(blocking=False):
+            return
+
+        try:
+            self._negative_checked_at = now
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT MAX(date_add) FROM sips_cache")
+                row = cursor.fetchone()
+                cursor.close()
+        except Error as e:
+            logger.warning("⚠️  No se pudo comprobar sips_cache para la caché negativa: %s", e)
+            return
+        finally:
+            self._negative_check_lock.release()
+
+        if self.negative_cache.set_generation(row[0] if row else None):
+            logger.info("🔄 Filas nuevas en sips_cache: caché negativa vaciada")
+
+    def invalidate_cache(self, cups: Optional[str] = None) -> int:
+        """Invalida la caché en memoria para un CUPS (o entera)"""
+        removed = self.summary_cache.invalidate(cups)
+        if self.negative_cache is not None:
+            removed += self.negative_cache.invalidate(cups)
+        if self.result_cache is None:
+            return removed
+        return removed + self.result_cache.invalidate(cups)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché en memoria"""
+        if self.result_cache is None:
+            return {'enabled': False}
+        return {'enabled': True, **self.result_cache.stats()}
+
+    def negative_cache_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché negativa (CUPS sin datos)"""
+        if self.negative_cache is None:
+            return {'enabled': False}
+        return {'enabled': True, 'check_interval': self.negative_check_interval, **self.negative_cache.stats()}
+
+    def inflight_stats(self) -> Dict[str, Any]:
+        """Estadísticas de coalescencia de peticiones concurrentes"""
+        return self._inflight.stats()
+
+
+def read_cups_file(path: str) -> List[Dict[str, Any]]:
+    """Lee un fichero con un CUPS por línea (opcionalmente `CUPS,invoice_id`)"""
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            cups, _, invoice_id = line.partition(',')
+            items.append({
+                'cups': cups.strip(),
+                'invoice_id': int(invoice_id) if invoice_id.strip() else None
+            })
+    return items
+
+
+def run_batch(client: SIPSClient, items: List[Dict[str, Any]], args) -> List[Dict[str, Any]]:
+    """Procesa varios CUPS desde CLI guardando en CouchDB con _bulk_docs"""
+    if client.pool is None and not client.connect_db():
+        return []
+
+    prefetched = client.get_sips_from_cache_many([item['cups'] for item in items])
+    results = []
+    pending = []
+
+    for item in items:
+        sips_data = client.get_sips_history(
+            cups=item['cups'],
+            invoice_id=item['invoice_id'],
+            months=args.months,
+            optimize_p6=args.optimize_p6,
+            save_to_couch=False,
+            prefetched=prefetched
+        )
+
+        if sips_data and not args.no_save:
+            pending.append(client.queue_to_couchdb(sips_data, item['invoice_id'], "python_client"))
+
+        results.append(sips_data or {'cups': item['cups'], 'error': 'Sin datos SIPS'})
+
+    client.flush_couchdb()
+    saved = sum(1 for future in pending if future.result()['ok'])
+
+    logger.info(
+        "\n%s\n📦 BATCH COMPLETADO\n%s\nCUPS procesados: %s\nCon datos: %s%s\n%s",
+        BANNER, BANNER, len(items), sum(1 for r in results if 'error' not in r),
+        "" if args.no_save else f"\nGuardados en CouchDB: {saved}/{len(pending)}", BANNER
+    )
+
+    return results
+
 
 def main():
     """Función principal para uso CLI"""
+    setup_logging('cli')
+
+    # Subcomando: optimización de toda la cartera (ver sips_fleet)
+    if len(sys.argv) > 1 and sys.argv[1] == 'fleet':
+        from sips_fleet import main as fleet_main
+        fleet_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
-        description='Cliente SIPS - Extrae histórico desde CRM de Aenergetic'
+        description='Cliente SIPS - Extrae histórico desde CRM de Aenergetic',
+        epilog='Optimización de toda la cartera: %(prog)s fleet --help'
     )
 
-    parser.add_argument('cups', help='CUPS a consultar')
+    parser.add_argument('cups', nargs='?', help='CUPS a consultar')
+    parser.add_argument('--cups-file', help='Fichero con un CUPS por línea (CUPS[,invoice_id]) para modo batch')
     parser.add_argument('--invoice-id', type=int, help='ID de factura')
     parser.add_argument('--months', type=int, default=12, help='Meses hacia atrás (default: 12)')
-    parser.add_argument('--optimize-p6', action='store_true', help='Optimizar periodo 6')
+    parser.add_argument('--optimize-p6', action='store_true', help='Calcular potencias contratadas óptimas')
     parser.add_argument('--no-save', action='store_true', help='No guardar en CouchDB')
     parser.add_argument('--output', help='Archivo JSON de salida')
+    parser.add_argument('--stream-output', help='Exportar consumos_historicos del CUPS a NDJSON fila a fila (memoria constante)')
 
     # Argumentos de conexión DB
     parser.add_argument('--db-host', default='localhost', help='Host de MySQL')
@@ -365,6 +1356,9 @@ def main():
 
     args = parser.parse_args()
 
+    if not args.cups and not args.cups_file:
+        parser.error('Indica un CUPS o --cups-file')
+
     client = SIPSClient(
         db_host=args.db_host,
         db_user=args.db_user,
@@ -376,6 +1370,25 @@ def main():
     )
 
     try:
+        if args.cups_file:
+            results = run_batch(client, read_cups_file(args.cups_file), args)
+
+            if args.output:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+                logger.info("\n💾 Datos guardados en: %s", args.output)
+
+            sys.exit(0 if any('error' not in r for r in results) else 1)
+
+        # Exportación en streaming de consumos_historicos
+        if args.stream_output:
+            with open(args.stream_output, 'w', encoding='utf-8') as f:
+                summary = export_ndjson(client.iter_consumos_rows(args.cups, args.months), f, args.cups)
+
+            print(json.dumps(summary, indent=2, ensure_ascii=False))
+            logger.info("\n💾 %s registros exportados a: %s", summary['records'], args.stream_output)
+            sys.exit(0 if summary['records'] else 1)
+
         sips_data = client.get_sips_history(
             cups=args.cups,
             invoice_id=args.invoice_id,
@@ -388,15 +1401,16 @@ def main():
             if args.output:
                 with open(args.output, 'w', encoding='utf-8') as f:
                     json.dump(sips_data, f, indent=2, ensure_ascii=False, default=str)
-                print(f"\n💾 Datos guardados en: {args.output}")
+                logger.info("\n💾 Datos guardados en: %s", args.output)
 
-            print("\n✅ Proceso completado exitosamente")
+            logger.info("\n✅ Proceso completado exitosamente")
             sys.exit(0)
         else:
-            print("\n❌ No se pudieron obtener datos SIPS")
+            logger.error("\n❌ No se pudieron obtener datos SIPS")
             sys.exit(1)
 
     finally:
+        client.close_couch_spool()
         client.disconnect_db()
 
 
@@ -0,0 +1,221 @@
+"""
+SIPS Columnar - demand_data en columnas NumPy
+==============================================
+Representación columnar de demand_data (un array por campo en lugar de
+un dict por lectura) y agregados vectorizados sobre ella:
+
+    - Máxima demanda por periodo
+    - kWh por mes
+    - Curva de percentiles de demanda por periodo
+    - Factor de carga
+
+NumPy es opcional: si no está instalado HAS_NUMPY es False y las
+funciones lanzan RuntimeError.
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+    HAS_NUMPY = False
+
+DEFAULT_PERCENTILES = (50, 75, 90, 95, 99, 100)
+
+
+class DemandColumns:
+    """
+    demand_data en columnas
+
+    Attributes:
+        fecha: datetime64[s] (NaT si la lectura no tiene fecha)
+        periodo: índice en `periods` de cada lectura (int16)
+        consumo_kwh: float64
+        potencia_maxima: float64
+        periods: etiquetas de periodo ('P1', 'P2', ...)
+    """
+
+    __slots__ = ('fecha', 'periodo', 'consumo_kwh', 'potencia_maxima', 'periods')
+
+    def __init__(self, fecha, periodo, consumo_kwh, potencia_maxima, periods: List[str]):
+        self.fecha = fecha
+        self.periodo = periodo
+        self.consumo_kwh = consumo_kwh
+        self.potencia_maxima = potencia_maxima
+        self.periods = periods
+
+    def __len__(self) -> int:
+        return len(self.consumo_kwh)
+
+    def period_mask(self, period: str):
+        """Máscara booleana de las lecturas de un periodo"""
+        return self.periodo == self.periods.index(period)
+
+    def to_json(self) -> Dict[str, Any]:
+        """Columnas como listas JSON (fechas ISO, None si no hay fecha)"""
+        fechas = self.fecha.astype(str).tolist()
+        return {
+            'fecha': [None if f == 'NaT' else f for f in fechas],
+            'periodo': [self.periods[i] for i in self.periodo.tolist()],
+            'consumo_kwh': self.consumo_kwh.tolist(),
+            'potencia_maxima': self.potencia_maxima.tolist(),
+        }
+
+
+def _require_numpy():
+    if not HAS_NUMPY:
+        raise RuntimeError("NumPy no está instalado (pip install numpy)")
+
+
+def _build(fechas: List[Any], codes: array, consumo: array, potencia: array, periods: List[str]) -> DemandColumns:
+    return DemandColumns(
+        fecha=np.array(fechas, dtype='datetime64[s]'),
+        periodo=np.asarray(codes, dtype=np.int16),
+        consumo_kwh=np.asarray(consumo, dtype=np.float64),
+        potencia_maxima=np.asarray(potencia, dtype=np.float64),
+        periods=periods,
+    )
+
+
+def columns_from_demand_data(demand_data: Iterable[Dict[str, Any]]) -> DemandColumns:
+    """Convierte una lista de demand_data (dicts) en columnas"""
+    _require_numpy()
+
+    fechas, codes, consumo, potencia = [], array('h'), array('d'), array('d')
+    index: Dict[str, int] = {}
+
+    for record in demand_data:
+        periodo = str(record.get('periodo'))
+        if periodo not in index:
+            index[periodo] = len(index)
+        fechas.append(record.get('fecha'))
+        codes.append(index[periodo])
+        consumo.append(float(record.get('consumo_kwh') or 0))
+        potencia.append(float(record.get('potencia_maxima') or 0))
+
+    return _build(fechas, codes, consumo, potencia, list(index))
+
+
+def columns_from_rows(rows: Iterable[tuple]) -> DemandColumns:
+    """
+    Construye las columnas directamente desde filas de consumos_historicos
+    (iter_consumos_rows), sin crear un dict por lectura
+    """
+    _require_numpy()
+
+    fechas, codes, consumo, potencia = [], array('h'), array('d'), array('d')
+    index: Dict[str, int] = {}
+
+    for fecha, periodo, consumo_kwh, _, potencia_maxima in rows:
+        periodo = str(periodo)
+        if periodo not in index:
+            index[periodo] = len(index)
+        fechas.append(fecha)
+        codes.append(index[periodo])
+        consumo.append(float(consumo_kwh or 0))
+        potencia.append(float(potencia_maxima or 0))
+
+    return _build(fechas, codes, consumo, potencia, list(index))
+
+
+def max_demand_by_period(columns: DemandColumns) -> Dict[str, float]:
+    """Máxima potencia demandada (kW) de cada periodo"""
+    maxima = np.zeros(len(columns.periods))
+    np.maximum.at(maxima, columns.periodo, columns.potencia_maxima)
+    return {period: float(maxima[i]) for i, period in enumerate(columns.periods)}
+
+
+def monthly_kwh(columns: DemandColumns) -> Dict[str, float]:
+    """Consumo total (kWh) de cada mes, 'YYYY-MM' -> kWh"""
+    valid = ~np.isnat(columns.fecha)
+    if not valid.any():
+        return {}
+
+    months = columns.fecha[valid].astype('datetime64[M]')
+    unique, inverse = np.unique(months, return_inverse=True)
+    totals = np.bincount(inverse, weights=columns.consumo_kwh[valid], minlength=len(unique))
+    return {str(month): round(float(total), 3) for month, total in zip(unique, totals)}
+
+
+def demand_percentiles(
+    columns: DemandColumns,
+    percentiles: Sequence[float] = DEFAULT_PERCENTILES
+) -> Dict[str, Dict[str, float]]:
+    """
+    Curva de percentiles de potencia demandada por periodo (y 'total')
+
+    Returns:
+        {'P1': {'p50': ..., 'p90': ...}, ..., 'total': {...}}
+    """
+    def curve(values) -> Dict[str, float]:
+        if not len(values):
+            return {}
+        points = np.percentile(values, percentiles)
+        return {f"p{p:g}": round(float(v), 3) for p, v in zip(percentiles, points)}
+
+    result = {period: curve(columns.potencia_maxima[columns.periodo == i])
+              for i, period in enumerate(columns.periods)}
+    result['total'] = curve(columns.potencia_maxima)
+    return result
+
+
+def reading_interval_hours(columns: DemandColumns) -> Optional[float]:
+    """Intervalo típico entre lecturas (mediana), en horas"""
+    fechas = np.sort(columns.fecha[~np.isnat(columns.fecha)])
+    steps = np.diff(fechas).astype('timedelta64[s]').astype(np.float64)
+    steps = steps[steps > 0]
+    if not len(steps):
+        return None
+    return float(np.median(steps)) / 3600
+
+
+def load_factor(columns: DemandColumns) -> Optional[float]:
+    """
+    Factor de carga: demanda media / demanda máxima
+
+    La demanda media es el consumo total entre las horas cubiertas por las
+    lecturas (de la primera a la última más un intervalo).
+    """
+    interval = reading_interval_hours(columns)
+    peak = float(columns.potencia_maxima.max()) if len(columns) else 0.0
+    if not interval or peak <= 0:
+        return None
+
+    fechas = columns.fecha[~np.isnat(columns.fecha)]
+    span_hours = float((fechas.max() - fechas.min()).astype('timedelta64[s]').astype(np.float64)) / 3600
+    hours = span_hours + interval
+
+    return round(float(columns.consumo_kwh.sum()) / (peak * hours), 4)
+
+
+def demand_stats(columns: DemandColumns, percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> Dict[str, Any]:
+    """Todos los agregados de una vez"""
+    return {
+        'records': len(columns),
+        'total_kwh': round(float(columns.consumo_kwh.sum()), 3),
+        'max_demand_by_period': max_demand_by_period(columns),
+        'monthly_kwh': monthly_kwh(columns),
+        'demand_percentiles': demand_percentiles(columns, percentiles),
+        'reading_interval_hours': reading_interval_hours(columns),
+        'load_factor': load_factor(columns),
+    }
+
+
+def to_columnar(sips_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copia de un resultado SIPS con demand_data en columnas y sus agregados
+    en 'demand_stats' (formato de la API con ?format=columnar)
+    """
+    columns = columns_from_demand_data(sips_data.get('demand_data') or [])
+    return {
+        **sips_data,
+        'format': 'columnar',
+        'demand_data': columns.to_json(),
+        'demand_stats': demand_stats(columns),
+    }
@@ -0,0 +1,294 @@
+"""
+SIPS Couch - Acceso HTTP a CouchDB
+===================================
+Sesión HTTP persistente (keep-alive, pool de conexiones, reintentos con
+backoff y cuerpos gzip opcionales) y escritor que acumula documentos y
+los envía a CouchDB con `_bulk_docs` en lugar de un POST por documento.
+
+El envío se dispara al llegar a `batch_size` documentos o cuando el
+documento más antiguo del buffer supera `flush_interval` segundos. Cada
+add() devuelve un Future que se resuelve con el resultado de ese documento:
+
+    {'id': ..., 'ok': True, 'rev': ...}
+    {'id': ..., 'ok': False, 'error': ..., 'reason': ...}
+
+Autor: Aenergetic
+Fecha: 2026-10-16
+"""
+
+import gzip
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Any, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from sips_metrics import count_couch_error
+from sips_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+def create_couch_session(
+    auth: Tuple[str, str],
+    pool_size: int = 10,
+    retries: int = 3,
+    backoff: float = 0.5
+) -> requests.Session:
+    """
+    Crea una sesión HTTP reutilizable para CouchDB
+
+    Las conexiones TCP/TLS se mantienen abiertas (keep-alive) y se reparten
+    entre hilos con un pool de `pool_size` conexiones. Errores de conexión
+    (incluido el reset de una conexión keep-alive caducada) y respuestas 5xx
+    se reintentan con backoff exponencial, también los POST: si el primer
+    intento llegó a CouchDB y se perdió la respuesta, el reintento da 409 y
+    quien llama lo trata como guardado (ver post_bulk_docs).
+
+    Args:
+        auth: (usuario, password) de CouchDB
+        pool_size: Conexiones por host (igualar a la concurrencia de la API)
+        retries: Reintentos ante errores de conexión o 5xx
+        backoff: Factor de backoff entre reintentos (segundos)
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+        # Los documentos llevan _id: reintentar un POST no crea duplicados
+        allowed_methods=frozenset(['GET', 'HEAD', 'PUT', 'POST', 'DELETE']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.auth = auth
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def couch_request(
+    session: requests.Session,
+    method: str,
+    url: str,
+    payload: Any = None,
+    timeout: float = 10,
+    compress: bool = False
+) -> requests.Response:
+    """Envía una petición JSON a CouchDB, opcionalmente con el cuerpo en gzip"""
+    headers = {'Content-Type': 'application/json'}
+    body = None
+
+    if payload is not None:
+        body = json.dumps(payload, default=str).encode('utf-8')
+        if compress:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+
+    return session.request(method, url, data=body, headers=headers, timeout=timeout)
+
+
+def post_bulk_docs(
+    session: requests.Session,
+    url: str,
+    docs: List[Dict[str, Any]],
+    timeout: float = 30,
+    compress: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Envía documentos a `{url}/_bulk_docs` y devuelve un resultado por documento
+
+    Args:
+        session: Sesión de create_couch_session()
+        url: URL de la base de datos (https://host/db)
+        docs: Documentos a guardar
+        timeout: Timeout de la petición HTTP
+        compress: Enviar el cuerpo comprimido con gzip
+
+    Returns:
+        Lista de resultados en el mismo orden que `docs`. Un conflicto en
+        un documento nuevo (sin _rev) cuenta como guardado: su _id es único
+        y solo puede venir de un intento anterior cuya respuesta se perdió.
+        Los de CouchDedupe (con payload_hash) reutilizan el _id y conservan
+        el conflicto para resolverlo.
+    """
+    if not docs:
+        return []
+
+    try:
+        response = couch_request(
+            session, 'POST', f"{url}/_bulk_docs", {'docs': docs},
+            timeout=timeout, compress=compress
+        )
+    except Exception as e:
+        return [
+            {'id': doc.get('_id'), 'ok': False, 'error': 'connection_error', 'reason': str(e)}
+            for doc in docs
+        ]
+
+    if response.status_code not in [200, 201, 202]:
+        return [
+            {'id': doc.get('_id'), 'ok': False, 'error': f"http_{response.status_code}", 'reason': response.text}
+            for doc in docs
+        ]
+
+    try:
+        items = response.json()
+    except ValueError as e:
+        items = []
+        reason = f"Respuesta no válida: {e}"
+    else:
+        reason = 'Sin resultado en la respuesta de _bulk_docs'
+
+    results = []
+    for i, doc in enumerate(docs):
+        item = items[i] if i < len(items) else None
+        if item is None:
+            results.append({'id': doc.get('_id'), 'ok': False, 'error': 'missing_result', 'reason': reason})
+        elif item.get('error') == 'conflict' and '_rev' not in doc and 'payload_hash' not in doc:
+            results.append({'id': item.get('id', doc.get('_id')), 'ok': True, 'rev': None})
+        elif item.get('error'):
+            results.append({
+                'id': item.get('id', doc.get('_id')),
+                'ok': False,
+                'error': item.get('error'),
+                'reason': item.get('reason'),
+            })
+        else:
+            results.append({'id': item.get('id'), 'ok': True, 'rev': item.get('rev')})
+
+    return results
+
+
+class CouchBulkWriter:
+    """Buffer de documentos CouchDB con envío en bloque en segundo plano"""
+
+    def __init__(
+        self,
+        session: requests.Session,
+        url: str,
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        timeout: float = 30,
+        compress: bool = False
+    ):
+        """
+        Args:
+            session: Sesión de create_couch_session()
+            url: URL de la base de datos (https://host/db)
+            batch_size: Documentos por petición _bulk_docs
+            flush_interval: Segundos máximos que un documento espera en el buffer
+            timeout: Timeout de cada petición HTTP
+            compress: Enviar los bloques comprimidos con gzip
+        """
+        self.session = session
+        self.url = url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.compress = compress
+
+        self._buffer: List[Tuple[Dict[str, Any], Future]] = []
+        self._oldest: Optional[float] = None
+        # Solo protege el buffer y las estadísticas: los envíos van en paralelo
+        # (la sesión reparte sus conexiones entre hilos)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        self._stats = {
+            'docs_queued': 0,
+            'docs_ok': 0,
+            'docs_failed': 0,
+            'requests': 0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name='couch-bulk-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, doc: Dict[str, Any]) -> Future:
+        """Añade un documento al buffer y devuelve su Future de resultado"""
+        future = Future()
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("CouchBulkWriter cerrado")
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append((doc, future))
+            self._stats['docs_queued'] += 1
+            full = len(self._buffer) >= self.batch_size
+
+        if full:
+            self._wakeup.set()
+
+        return future
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """Envía ya todo lo pendiente y devuelve los resultados de este envío"""
+        results = []
+        while True:
+            with self._lock:
+                batch = self._buffer[:self.batch_size]
+                self._buffer = self._buffer[self.batch_size:]
+                self._oldest = time.monotonic() if self._buffer else None
+            if not batch:
+                return results
+            results.extend(self._send(batch))
+
+    def _send(self, batch: List[Tuple[Dict[str, Any], Future]]) -> List[Dict[str, Any]]:
+        """Envía un bloque y resuelve los Futures de sus documentos"""
+        docs = [doc for doc, _ in batch]
+
+        results = post_bulk_docs(self.session, self.url, docs, self.timeout, self.compress)
+
+        ok = sum(1 for r in results if r['ok'])
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['docs_ok'] += ok
+            self._stats['docs_failed'] += len(results) - ok
+        count_couch_error('bulk', len(results) - ok)
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+        return results
+
+    def _run(self):
+        """Hilo de fondo: envía por tamaño o por tiempo"""
+        while not self._closed:
+            self._wakeup.wait(timeout=self.flush_interval / 2)
+            self._wakeup.clear()
+
+            with self._lock:
+                pending = len(self._buffer)
+                age = time.monotonic() - self._oldest if self._oldest else 0
+
+            if pending >= self.batch_size or (pending and age >= self.flush_interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error("❌ Error en envío bulk a CouchDB: %s", e)
+
+    def close(self):
+        """Envía lo pendiente y detiene el hilo de fondo"""
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=self.timeout)
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas del escritor"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._buffer)
+        return stats
@@ -0,0 +1,130 @@
+"""
+SIPS Couch Read - Lectura de sips_history como segundo nivel de caché
+======================================================================
+Todos los resultados ya se guardan en CouchDB (sips_history). Con
+COUCHDB_READ_MAX_AGE > 0 get_sips_history busca primero ahí el documento
+más reciente del CUPS para la misma ventana de meses y, si tiene menos de
+esa antigüedad, lo sirve sin tocar el MySQL del CRM; si no, sigue por
+sips_cache como siempre.
+
+La ventana va en el campo `months` del documento (la pone
+build_couch_document). Los documentos sin él, anteriores a este campo, no
+se sirven desde aquí: una consulta de 3 meses no debe recibir 24.
+
+La búsqueda usa un índice Mango sobre [cups, months, consulted_at] (se crea
+al arrancar, ensure_index() es idempotente) y pide un único documento:
+
+    {'selector': {'cups': ..., 'months': ..., 'consulted_at': {'$gte': corte}, ...},
+     'sort': [{'cups': 'desc'}, {'months': 'desc'}, {'consulted_at': 'desc'}], 'limit': 1}
+
+consulted_at se guarda con datetime.now().isoformat(), así que el corte se
+calcula igual y la comparación de cadenas es cronológica.
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+import requests
+
+from sips_couch import couch_request
+from sips_docs import rehydrate_document
+
+INDEX_NAME = 'cups-months-consulted_at'
+INDEX_DDOC = 'sips-read'
+
+# Cuerpo de POST {db}/_index
+INDEX_DEFINITION = {
+    'index': {'fields': ['cups', 'months', 'consulted_at']},
+    'name': INDEX_NAME,
+    'ddoc': INDEX_DDOC,
+    'type': 'json',
+}
+
+
+def ensure_index(session: requests.Session, url: str, timeout: float = 10) -> bool:
+    """
+    Crea (si no existe) el índice Mango [cups, months, consulted_at] en `url`
+
+    Returns:
+        True si el índice existe o se ha creado
+    """
+    response = couch_request(session, 'POST', f"{url}/_index", INDEX_DEFINITION, timeout=timeout)
+    return response.status_code in [200, 201]
+
+
+def latest_query(cups: str, invoice_id: Optional[int], months: int, max_age: float) -> Dict[str, Any]:
+    """
+    Cuerpo de POST {db}/_find para el documento más reciente del CUPS, con
+    la ventana de `months` meses y menos de `max_age` segundos
+
+    Solo vale un documento de la misma factura (invoice_id None incluido):
+    los datos de factura van dentro del documento.
+    """
+    cutoff = (datetime.now() - timedelta(seconds=max_age)).isoformat()
+    return {
+        'selector': {
+            'cups': cups,
+            'months': months,
+            'consulted_at': {'$gte': cutoff},
+            'type': 'sips_data',
+            'invoice_id': invoice_id,
+        },
+        'sort': [{'cups': 'desc'}, {'months': 'desc'}, {'consulted_at': 'desc'}],
+        'limit': 1,
+        'use_index': [INDEX_DDOC, INDEX_NAME],
+    }
+
+
+def find_latest(
+    session: requests.Session,
+    url: str,
+    cups: str,
+    invoice_id: Optional[int],
+    months: int,
+    max_age: float,
+    timeout: float = 10
+) -> Optional[Dict[str, Any]]:
+    """
+    Documento sips_data más reciente del CUPS para `months` meses con menos
+    de `max_age` segundos (ver latest_query)
+
+    Returns:
+        Documento tal cual está en CouchDB, o None si no hay ninguno reciente
+
+    Raises:
+        requests.HTTPError: Si CouchDB responde con error
+    """
+    response = couch_request(
+        session, 'POST', f"{url}/_find", latest_query(cups, invoice_id, months, max_age), timeout=timeout
+    )
+    response.raise_for_status()
+
+    docs = response.json().get('docs', [])
+    return docs[0] if docs else None
+
+
+def sips_from_document(
+    document: Dict[str, Any],
+    session: Optional[requests.Session] = None,
+    url: Optional[str] = None,
+    timeout: float = 10
+) -> Optional[Dict[str, Any]]:
+    """
+    Datos SIPS (formato de get_sips_history) de un documento de cualquier
+    esquema; descarga el adjunto demand_data si hace falta
+
+    La optimización guardada no se devuelve: get_sips_history la recalcula
+    si se pide optimize_p6.
+
+    Returns:
+        Datos SIPS, o None si el documento no los contiene
+    """
+    legacy = rehydrate_document(document, session, url, timeout)
+    sips_data = legacy.get('sips_raw_data')
+    if not isinstance(sips_data, dict) or not sips_data.get('demand_data'):
+        return None
+
+    return {k: v for k, v in sips_data.items() if k != 'optimization'}
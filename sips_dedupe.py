@@ -0,0 +1,254 @@
+"""
+SIPS Dedupe - Documentos CouchDB deterministas sin escrituras repetidas
+========================================================================
+Con COUCHDB_DEDUPE=true cada CUPS tiene un único documento `sips_{cups}`
+en lugar de uno nuevo por consulta. Antes de escribir se calcula el hash
+SHA-256 del payload SIPS normalizado:
+
+    - Si coincide con el último hash guardado del CUPS, no se escribe
+    - Si no, se guarda como nueva revisión del mismo documento
+
+Los últimos hashes y revisiones se guardan en un índice SQLite local
+(COUCHDB_HASH_INDEX), así la comprobación no cuesta ninguna petición a
+CouchDB. Si el índice no conoce la revisión actual (índice nuevo, otra
+máquina escribió el documento) CouchDB responde 409: se lee la revisión
+del documento y se reintenta una vez.
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
+
+from sips_couch import couch_request
+
+# Campos que cambian en cada consulta aunque los datos sean los mismos
+VOLATILE_FIELDS = ('query_date',)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS couch_hashes (
+    doc_id TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    rev TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def payload_hash(sips_data: Dict[str, Any], invoice_id: Optional[int] = None) -> str:
+    """SHA-256 del payload SIPS normalizado (claves ordenadas, sin campos volátiles)"""
+    payload = {k: v for k, v in sips_data.items() if k not in VOLATILE_FIELDS}
+
+    optimization = payload.get('optimization')
+    if isinstance(optimization, dict):
+        payload['optimization'] = {k: v for k, v in optimization.items() if k != 'elapsed_ms'}
+
+    body = json.dumps(
+        {'invoice_id': invoice_id, 'sips': payload},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False,
+        default=str
+    )
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def stable_doc_id(cups: str) -> str:
+    """_id del documento único de un CUPS"""
+    return f"sips_{cups}"
+
+
+class HashIndex:
+    """Último hash y revisión escritos de cada documento (SQLite)"""
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv('COUCHDB_HASH_INDEX', 'couch_hashes.sqlite3')
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Conexión SQLite nueva (una por operación, válida entre hilos)"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self, doc_id: str) -> Optional[Tuple[str, str]]:
+        """(hash, rev) del documento, o None si no está en el índice"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT hash, rev FROM couch_hashes WHERE doc_id = ?', (doc_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, doc_id: str, digest: str, rev: str):
+        """Registra el hash y la revisión recién escritos"""
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO couch_hashes (doc_id, hash, rev, updated_at) VALUES (?, ?, ?, ?)',
+                (doc_id, digest, rev, time.time())
+            )
+
+    def forget(self, doc_id: str):
+        """Elimina un documento del índice"""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM couch_hashes WHERE doc_id = ?', (doc_id,))
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM couch_hashes').fetchone()[0]
+
+
+class CouchDedupe:
+    """Escrituras deduplicadas contra la base de datos `url`"""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], requests.Session],
+        url: str,
+        index: Optional[HashIndex] = None,
+        timeout: float = 10,
+        compress: bool = False
+    ):
+        """
+        Args:
+            session_factory: Devuelve la sesión HTTP de CouchDB (p. ej. client.get_couch_session)
+            url: URL de la base de datos (https://host/db)
+            index: Índice de hashes (default: HashIndex() en COUCHDB_HASH_INDEX)
+            timeout: Timeout de cada petición HTTP
+            compress: Enviar los cuerpos comprimidos con gzip
+        """
+        self.session_factory = session_factory
+        self.url = url
+        self.index = index or HashIndex()
+        self.timeout = timeout
+        self.compress = compress
+
+        self._lock = threading.Lock()
+        self._stats = {'written': 0, 'skipped': 0, 'conflicts': 0, 'failed': 0}
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def prepare(self, document: Dict[str, Any], digest: str) -> Optional[Dict[str, Any]]:
+        """
+        Ajusta un documento de build_couch_document para escribirlo con _id
+        estable: añade payload_hash y la última _rev conocida
+
+        Returns:
+            El documento, o None si el hash coincide con el último escrito
+        """
+        doc_id = stable_doc_id(document['cups'])
+        entry = self.index.get(doc_id)
+
+        if entry is not None and entry[0] == digest:
+            self._count('skipped')
+            return None
+
+        document = {**document, '_id': doc_id, 'payload_hash': digest}
+        if entry is not None:
+            document['_rev'] = entry[1]
+        return document
+
+    def skipped_result(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        """Resultado (formato _bulk_docs) de una escritura omitida"""
+        doc_id = stable_doc_id(document['cups'])
+        entry = self.index.get(doc_id)
+        return {'id': doc_id, 'ok': True, 'rev': entry[1] if entry else None, 'skipped': True}
+
+    def save(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Guarda un documento preparado con PUT; ante 409 relee la revisión
+        actual y reintenta una vez (u omite si el contenido ya es el mismo)
+
+        Returns:
+            Resultado en formato _bulk_docs ({'id', 'ok', 'rev'} o con 'error')
+        """
+        return self.complete(document, self._put(document))
+
+    def complete(self, document: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+        """Resultado final de un documento enviado: resuelve un 409 y registra el hash"""
+        if result.get('error') == 'conflict':
+            result = self.resolve_conflict(document)
+
+        if result['ok'] and not result.get('skipped'):
+            self.index.put(document['_id'], document['payload_hash'], result['rev'])
+            self._count('written')
+        elif not result['ok']:
+            self._count('failed')
+
+        return result
+
+    def resolve_conflict(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        """Relee el documento tras un 409 y reintenta con su revisión actual"""
+        self._count('conflicts')
+        doc_id = document['_id']
+
+        try:
+            response = couch_request(self.session_factory(), 'GET', f"{self.url}/{doc_id}", timeout=self.timeout)
+        except Exception as e:
+            return {'id': doc_id, 'ok': False, 'error': 'connection_error', 'reason': str(e)}
+
+        if response.status_code != 200:
+            return {'id': doc_id, 'ok': False, 'error': f"http_{response.status_code}", 'reason': response.text}
+
+        current = response.json()
+        if current.get('payload_hash') == document['payload_hash']:
+            self.index.put(doc_id, document['payload_hash'], current['_rev'])
+            self._count('skipped')
+            return {'id': doc_id, 'ok': True, 'rev': current['_rev'], 'skipped': True}
+
+        return self._put({**document, '_rev': current['_rev']})
+
+    def _put(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        """PUT del documento, resultado en formato _bulk_docs"""
+        doc_id = document['_id']
+        try:
+            response = couch_request(
+                self.session_factory(),
+                'PUT',
+                f"{self.url}/{doc_id}",
+                document,
+                timeout=self.timeout,
+                compress=self.compress
+            )
+        except Exception as e:
+            return {'id': doc_id, 'ok': False, 'error': 'connection_error', 'reason': str(e)}
+
+        if response.status_code in [200, 201, 202]:
+            return {'id': doc_id, 'ok': True, 'rev': response.json().get('rev')}
+        if response.status_code == 409:
+            return {'id': doc_id, 'ok': False, 'error': 'conflict', 'reason': response.text}
+        return {'id': doc_id, 'ok': False, 'error': f"http_{response.status_code}", 'reason': response.text}
+
+    def track_bulk(self, document: Dict[str, Any], future: Future) -> Future:
+        """
+        Future del resultado final de un documento enviado con _bulk_docs:
+        registra el hash si se escribió y resuelve los 409
+        """
+        outer = Future()
+
+        def done(inner: Future):
+            try:
+                result = self.complete(document, inner.result())
+            except Exception as e:
+                result = {'id': document['_id'], 'ok': False, 'error': 'dedupe_error', 'reason': str(e)}
+            outer.set_result(result)
+
+        future.add_done_callback(done)
+        return outer
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas de escrituras"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['indexed'] = len(self.index)
+        return stats
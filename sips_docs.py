@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+SIPS Docs - Esquema compacto de los documentos sips_data en CouchDB
+====================================================================
+Los documentos antiguos (sin schema_version) guardan los datos SIPS dos
+veces: entero en `sips_raw_data` y copiados en `current_powers`,
+`demand_data` y `periods`. El esquema 2 los guarda una sola vez:
+
+    {
+        '_id': ..., 'type': 'sips_data', 'schema_version': 2,
+        'cups': ..., 'invoice_id': ..., 'source': ..., 'consulted_at': ...,
+        'records_found': ...,
+        'sips': {datos SIPS sin demand_data},
+        'demand_data': [...]                       # o bien, con adjunto:
+        '_attachments': {'demand_data.json.gz': ...}
+    }
+
+Con COUCHDB_DEMAND_ATTACHMENT=true el array demand_data va como adjunto
+gzip: el JSON del documento queda pequeño (vistas e índices más rápidos)
+y el array solo se descarga cuando se pide.
+
+rehydrate_document() devuelve cualquier documento con la forma antigua, y
+este módulo, ejecutado como script, migra en bloque los documentos
+existentes:
+
+    python3 sips_docs.py --dry-run
+    python3 sips_docs.py --batch-size 200 --attach
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import base64
+import argparse
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+
+from sips_couch import post_bulk_docs
+
+SCHEMA_VERSION = 2
+
+DEMAND_ATTACHMENT = 'demand_data.json.gz'
+
+# Campos de metadatos que se conservan al migrar un documento antiguo
+META_FIELDS = ('_id', '_rev', 'type', 'cups', 'invoice_id', 'months', 'source', 'consulted_at', 'payload_hash')
+
+
+def encode_demand_attachment(demand_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """demand_data -> adjunto CouchDB en línea (JSON en gzip, base64)"""
+    body = json.dumps(demand_data, separators=(',', ':'), ensure_ascii=False, default=str).encode('utf-8')
+    return {
+        'content_type': 'application/gzip',
+        'data': base64.b64encode(gzip.compress(body, compresslevel=6)).decode('ascii'),
+    }
+
+
+def decode_demand_attachment(raw: bytes) -> List[Dict[str, Any]]:
+    """Contenido del adjunto (gzip) -> demand_data"""
+    return json.loads(gzip.decompress(raw).decode('utf-8'))
+
+
+def compact_document(
+    sips_data: Dict[str, Any],
+    meta: Dict[str, Any],
+    attach_demand: bool = False
+) -> Dict[str, Any]:
+    """
+    Documento con esquema 2
+
+    Args:
+        sips_data: Datos SIPS (resultado de get_sips_history)
+        meta: _id, cups, invoice_id, source, consulted_at... del documento
+        attach_demand: Guardar demand_data como adjunto gzip
+    """
+    demand_data = sips_data.get('demand_data') or []
+
+    document = {
+        **meta,
+        'type': 'sips_data',
+        'schema_version': SCHEMA_VERSION,
+        'records_found': len(demand_data),
+        'sips': {k: v for k, v in sips_data.items() if k != 'demand_data'},
+    }
+
+    if attach_demand and demand_data:
+        document['_attachments'] = {DEMAND_ATTACHMENT: encode_demand_attachment(demand_data)}
+    else:
+        document['demand_data'] = demand_data
+
+    return document
+
+
+def _fetch_attachment(session: requests.Session, url: str, doc_id: str, timeout: float) -> List[Dict[str, Any]]:
+    """Descarga el adjunto demand_data de un documento"""
+    response = session.get(f"{url}/{doc_id}/{DEMAND_ATTACHMENT}", timeout=timeout)
+    response.raise_for_status()
+    return decode_demand_attachment(response.content)
+
+
+def rehydrate_document(
+    document: Dict[str, Any],
+    session: Optional[requests.Session] = None,
+    url: Optional[str] = None,
+    timeout: float = 10
+) -> Dict[str, Any]:
+    """
+    Devuelve un documento sips_data con la forma antigua (sips_raw_data,
+    current_powers, demand_data, periods), sea cual sea su esquema
+
+    Si demand_data está en un adjunto que no viene en línea (documento leído
+    sin ?attachments=true) se descarga con `session` desde `url` (la base de
+    datos); sin sesión, demand_data queda vacío.
+    """
+    if document.get('schema_version', 1) < SCHEMA_VERSION:
+        return document
+
+    if 'demand_data' in document:
+        demand_data = document['demand_data']
+    else:
+        attachment = (document.get('_attachments') or {}).get(DEMAND_ATTACHMENT)
+        if attachment is None:
+            demand_data = []
+        elif 'data' in attachment:
+            demand_data = decode_demand_attachment(base64.b64decode(attachment['data']))
+        elif session is not None and url:
+            demand_data = _fetch_attachment(session, url, document['_id'], timeout)
+        else:
+            demand_data = []
+
+    sips_raw_data = {**document.get('sips', {}), 'demand_data': demand_data}
+
+    legacy = {k: v for k, v in document.items() if k not in ('sips', 'schema_version', '_attachments')}
+    legacy.update({
+        'sips_raw_data': sips_raw_data,
+        'current_powers': sips_raw_data.get('current_powers', {}),
+        'demand_data': demand_data,
+        'periods': sips_raw_data.get('periods', []),
+        'records_found': len(demand_data),
+    })
+    return legacy
+
+
+def migrate_document(document: Dict[str, Any], attach_demand: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Documento antiguo -> esquema 2 (mismo _id y _rev, para guardarlo como
+    nueva revisión)
+
+    Returns:
+        Documento migrado, o None si no hay que migrarlo (ya es esquema 2,
+        no es sips_data o no tiene sips_raw_data)
+    """
+    if document.get('type') != 'sips_data' or document.get('schema_version', 1) >= SCHEMA_VERSION:
+        return None
+
+    sips_data = document.get('sips_raw_data')
+    if not isinstance(sips_data, dict):
+        return None
+
+    meta = {k: document[k] for k in META_FIELDS if k in document}
+    # La lectura desde CouchDB filtra por months: sin el campo en la raíz, el
+    # de sips_raw_data
+    if 'months' not in meta and 'months' in sips_data:
+        meta['months'] = sips_data['months']
+    return compact_document(sips_data, meta, attach_demand)
+
+
+def iter_all_docs(
+    session: requests.Session,
+    url: str,
+    page_size: int = 200,
+    timeout: float = 60
+) -> Iterator[List[Dict[str, Any]]]:
+    """Páginas de documentos de la base de datos (_all_docs con include_docs)"""
+    startkey = None
+
+    while True:
+        params = {'include_docs': 'true', 'limit': page_size + 1}
+        if startkey is not None:
+            params['startkey'] = json.dumps(startkey)
+
+        response = session.get(f"{url}/_all_docs", params=params, timeout=timeout)
+        response.raise_for_status()
+        rows = response.json().get('rows', [])
+
+        # Se pide una fila de más para saber dónde empieza la página siguiente
+        page = rows[:page_size]
+        docs = [row['doc'] for row in page if row.get('doc') and not row['id'].startswith('_design/')]
+        if docs:
+            yield docs
+
+        if len(rows) <= page_size:
+            return
+        startkey = rows[page_size]['id']
+
+
+def migrate_database(
+    session: requests.Session,
+    url: str,
+    batch_size: int = 200,
+    attach_demand: bool = False,
+    dry_run: bool = False,
+    timeout: float = 60
+) -> Dict[str, Any]:
+    """
+    Reescribe con _bulk_docs todos los documentos antiguos de la base de datos
+
+    Returns:
+        Resumen (documentos leídos, migrados, con error y bytes ahorrados)
+    """
+    start = time.perf_counter()
+    summary = {'scanned': 0, 'migrated': 0, 'failed': 0, 'skipped': 0, 'bytes_before': 0, 'bytes_after': 0}
+
+    for docs in iter_all_docs(session, url, batch_size, timeout):
+        summary['scanned'] += len(docs)
+
+        migrated = []
+        for doc in docs:
+            new_doc = migrate_document(doc, attach_demand)
+            if new_doc is None:
+                summary['skipped'] += 1
+                continue
+            summary['bytes_before'] += len(json.dumps(doc, default=str))
+            summary['bytes_after'] += len(json.dumps(new_doc, default=str))
+            migrated.append(new_doc)
+
+        if migrated and not dry_run:
+            results = post_bulk_docs(session, url, migrated, timeout)
+            ok = sum(1 for r in results if r['ok'])
+            summary['migrated'] += ok
+            summary['failed'] += len(results) - ok
+        else:
+            summary['migrated'] += len(migrated)
+
+        print(f"   ... {summary['scanned']} documentos leídos, {summary['migrated']} migrados")
+
+    summary['elapsed_s'] = round(time.perf_counter() - start, 2)
+    summary['dry_run'] = dry_run
+    return summary
+
+
+def main(argv: Optional[List[str]] = None):
+    """CLI: migración de documentos al esquema 2"""
+    parser = argparse.ArgumentParser(
+        description='Migra los documentos sips_data de CouchDB al esquema compacto (sin datos duplicados)'
+    )
+    parser.add_argument('--batch-size', type=int, default=200, help='Documentos por página y por _bulk_docs')
+    parser.add_argument('--attach', action='store_true',
+                        default=os.getenv('COUCHDB_DEMAND_ATTACHMENT', 'false').lower() == 'true',
+                        help='Guardar demand_data como adjunto gzip')
+    parser.add_argument('--dry-run', action='store_true', help='Solo contar, sin escribir')
+    args = parser.parse_args(argv)
+
+    from sips_client_crm import SIPSClient
+
+    client = SIPSClient()
+    url = f"{client.couchdb_url}/{client.couchdb_db}"
+
+    print(f"\n{'='*60}")
+    print(f"🗜️  MIGRACIÓN AL ESQUEMA {SCHEMA_VERSION}")
+    print(f"{'='*60}")
+    print(f"Base de datos: {url}")
+    print(f"Adjunto gzip: {'sí' if args.attach else 'no'}")
+    print(f"Dry run: {'sí' if args.dry_run else 'no'}")
+    print(f"{'='*60}\n")
+
+    summary = migrate_database(
+        client.get_couch_session(),
+        url,
+        batch_size=args.batch_size,
+        attach_demand=args.attach,
+        dry_run=args.dry_run,
+        timeout=max(client.couch_timeout, 60)
+    )
+
+    saved = summary['bytes_before'] - summary['bytes_after']
+    print(f"\n{'='*60}")
+    print(f"✅ MIGRACIÓN COMPLETADA")
+    print(f"{'='*60}")
+    print(f"Documentos leídos: {summary['scanned']}")
+    print(f"Migrados: {summary['migrated']} (errores: {summary['failed']}, sin cambios: {summary['skipped']})")
+    if summary['bytes_before']:
+        print(f"Tamaño: {summary['bytes_before']} -> {summary['bytes_after']} bytes "
+              f"({saved / summary['bytes_before'] * 100:.0f}% menos)")
+    print(f"Tiempo: {summary['elapsed_s']} s")
+    print(f"{'='*60}")
+
+    return summary
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+SIPS Fleet - Optimización de potencia de toda la cartera
+=========================================================
+Recorre toda la tabla sips_cache en streaming, optimiza la potencia de
+cada CUPS en un pool de procesos (bloques de CUPS por tarea) y escribe el
+ranking por ahorro en un fichero NDJSON y/o en CouchDB. Pensado para
+ejecutarse de noche y localizar clientes con potencia sobrecontratada.
+
+El proceso principal solo lee filas de MySQL; el parseo del JSON y la
+optimización se hacen en los workers, así el throughput escala con el
+número de núcleos. Como mucho hay 2 bloques por worker en vuelo, de forma
+que la memoria no depende del tamaño de la tabla.
+
+Uso:
+    python3 sips_fleet.py --processes 8 --output ranking.ndjson
+    python3 sips_client_crm.py fleet --couch --min-savings 50
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import itertools
+import threading
+import multiprocessing
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sips_optimizer import optimize_sips_data
+
+DEFAULT_CHUNK_SIZE = int(os.getenv('SIPS_FLEET_CHUNK_SIZE', 50))
+
+
+def score_chunk(chunk: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+    """
+    Worker: parsea y optimiza un bloque de (cups, JSON de sips_cache)
+
+    Devuelve un resultado compacto por CUPS (sin demand_data)
+    """
+    results = []
+    for cups, raw in chunk:
+        try:
+            sips_data = json.loads(raw)
+            optimization = optimize_sips_data(sips_data)
+        except Exception as e:
+            results.append({'cups': cups, 'error': str(e)})
+            continue
+
+        if 'error' in optimization:
+            results.append({'cups': cups, 'error': optimization['error']})
+            continue
+
+        results.append({
+            'cups': cups,
+            'current_powers': optimization['current_powers'],
+            'optimal_powers': optimization['optimal_powers'],
+            'current_cost': optimization['current_cost'],
+            'optimal_cost': optimization['optimal_cost'],
+            'savings': optimization['savings'],
+            'savings_pct': optimization['savings_pct'],
+            'days': optimization['days'],
+        })
+    return results
+
+
+def _chunked(rows: Iterable[Tuple[str, str]], size: int, slots: threading.BoundedSemaphore) -> Iterator[List[Tuple[str, str]]]:
+    """Agrupa filas en bloques; espera un hueco antes de entregar cada bloque"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            slots.acquire()
+            yield chunk
+            chunk = []
+    if chunk:
+        slots.acquire()
+        yield chunk
+
+
+def run_fleet(
+    client,
+    processes: Optional[int] = None,
+    chunk_size: int = None,
+    limit: Optional[int] = None,
+    output: Optional[str] = None,
+    to_couch: bool = False,
+    min_savings: float = 0.0,
+    top: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Optimiza todos los CUPS de sips_cache y escribe el ranking
+
+    Args:
+        client: SIPSClient (versión CRM) con acceso a sips_cache
+        processes: Procesos del pool (default: núcleos de la máquina)
+        chunk_size: CUPS por tarea (default: SIPS_FLEET_CHUNK_SIZE o 50)
+        limit: Procesar solo los primeros N CUPS
+        output: Fichero NDJSON con el ranking (una línea por CUPS)
+        to_couch: Guardar el ranking en CouchDB (un documento por CUPS)
+        min_savings: Ahorro mínimo (€) para entrar en el ranking
+        top: Guardar solo los N primeros del ranking
+
+    Returns:
+        Resumen de la ejecución (totales, tiempos y throughput)
+    """
+    processes = processes or os.cpu_count() or 1
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S') + '_' + uuid.uuid4().hex[:6]
+
+    if client.pool is None and not client.connect_db():
+        raise RuntimeError("No hay conexión a la base de datos")
+
+    print(f"\n{'='*60}")
+    print(f"🏭 OPTIMIZACIÓN DE CARTERA")
+    print(f"{'='*60}")
+    print(f"Run: {run_id}")
+    print(f"Procesos: {processes}")
+    print(f"CUPS por tarea: {chunk_size}")
+    print(f"{'='*60}\n")
+
+    start = time.perf_counter()
+    scored = []
+    processed = 0
+    errors = 0
+
+    source = client.iter_sips_cache()
+    rows = itertools.islice(source, limit) if limit else source
+
+    slots = threading.BoundedSemaphore(processes * 2)
+
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            for results in pool.imap_unordered(score_chunk, _chunked(rows, chunk_size, slots)):
+                slots.release()
+                processed += len(results)
+                for result in results:
+                    if 'error' in result:
+                        errors += 1
+                    elif result['savings'] is not None and result['savings'] >= min_savings:
+                        scored.append(result)
+
+                if processed % (chunk_size * processes * 10) < len(results):
+                    elapsed = time.perf_counter() - start
+                    print(f"   ... {processed} CUPS ({processed / elapsed:.0f} CUPS/s)")
+    finally:
+        # Con --limit el cursor puede quedar a medias: liberar la conexión
+        source.close()
+
+    scored.sort(key=lambda r: r['savings'], reverse=True)
+    if top:
+        scored = scored[:top]
+    for rank, result in enumerate(scored, 1):
+        result['rank'] = rank
+
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        'run_id': run_id,
+        'processed': processed,
+        'ranked': len(scored),
+        'errors': errors,
+        'total_savings': round(sum(r['savings'] for r in scored), 2),
+        'processes': processes,
+        'chunk_size': chunk_size,
+        'elapsed_s': round(elapsed, 2),
+        'throughput_per_s': round(processed / elapsed, 1) if elapsed else None,
+        'finished_at': datetime.now().isoformat(),
+    }
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            for result in scored:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+        print(f"💾 Ranking guardado en: {output}")
+
+    if to_couch:
+        summary['saved_to_couchdb'] = save_ranking(client, run_id, scored, summary)
+
+    print(f"\n{'='*60}")
+    print(f"✅ CARTERA COMPLETADA")
+    print(f"{'='*60}")
+    print(f"CUPS procesados: {processed} ({errors} sin datos válidos)")
+    print(f"En el ranking: {len(scored)}")
+    print(f"Ahorro total estimado: {summary['total_savings']} €")
+    print(f"Tiempo: {elapsed:.1f} s ({summary['throughput_per_s']} CUPS/s)")
+    print(f"{'='*60}")
+
+    return summary
+
+
+def save_ranking(client, run_id: str, scored: List[Dict[str, Any]], summary: Dict[str, Any]) -> int:
+    """Guarda el ranking en CouchDB con _bulk_docs (un documento por CUPS y uno de resumen)"""
+    writer = client.get_couch_writer()
+    futures = [
+        writer.add({
+            '_id': f"fleet_{run_id}_{result['rank']:06d}",
+            'type': 'power_optimization',
+            'run_id': run_id,
+            **result,
+        })
+        for result in scored
+    ]
+    futures.append(writer.add({
+        '_id': f"fleet_{run_id}",
+        'type': 'power_optimization_run',
+        **summary,
+    }))
+    client.flush_couchdb()
+
+    saved = sum(1 for future in futures if future.result()['ok'])
+    print(f"💾 Guardados en CouchDB: {saved}/{len(futures)}")
+    return saved
+
+
+def main(argv: Optional[List[str]] = None):
+    """CLI: python3 sips_fleet.py [opciones]  /  sips_client_crm.py fleet [opciones]"""
+    parser = argparse.ArgumentParser(
+        prog='sips_client_crm.py fleet',
+        description='Optimiza la potencia de todos los CUPS de sips_cache y genera un ranking por ahorro'
+    )
+    parser.add_argument('--processes', type=int, help='Procesos del pool (default: núcleos)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='CUPS por tarea')
+    parser.add_argument('--limit', type=int, help='Procesar solo los primeros N CUPS')
+    parser.add_argument('--output', help='Fichero NDJSON con el ranking')
+    parser.add_argument('--couch', action='store_true', help='Guardar el ranking en CouchDB')
+    parser.add_argument('--min-savings', type=float, default=0.0, help='Ahorro mínimo (€) para entrar en el ranking')
+    parser.add_argument('--top', type=int, help='Guardar solo los N primeros')
+    args = parser.parse_args(argv)
+
+    if not args.output and not args.couch:
+        parser.error('Indica --output y/o --couch')
+
+    from sips_client_crm import SIPSClient
+
+    client = SIPSClient()
+    try:
+        run_fleet(
+            client,
+            processes=args.processes,
+            chunk_size=args.chunk_size,
+            limit=args.limit,
+            output=args.output,
+            to_couch=args.couch,
+            min_savings=args.min_savings,
+            top=args.top
+        )
+    finally:
+        client.disconnect_db()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
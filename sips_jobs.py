@@ -0,0 +1,324 @@
+"""
+SIPS Jobs - Trabajos asíncronos para batches muy grandes
+=========================================================
+Permite encolar decenas de miles de CUPS sin mantener abierta la conexión
+HTTP. El estado de cada trabajo y el resultado de cada CUPS se guardan en
+SQLite, de forma que si la API se reinicia el trabajo continúa por los
+CUPS pendientes en lugar de empezar de cero.
+
+Solo un proceso ejecuta trabajos (el que obtiene el lock del fichero
+`<db>.lock`). El resto de procesos, por ejemplo otros workers de la API,
+pueden crear trabajos y consultar su estado.
+
+Autor: Aenergetic
+Fecha: 2026-10-16
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from sips_logging import get_logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: sin lock entre procesos
+
+logger = get_logger(__name__)
+
+# Estados de un trabajo
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    options TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    resumed_at REAL,
+    resumed_from INTEGER NOT NULL DEFAULT 0,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    cups TEXT,
+    invoice_id INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    result TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS job_items_pending ON job_items (job_id, status, idx);
+"""
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    """Epoch -> ISO 8601"""
+    return datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+
+
+class JobManager:
+    """Cola persistente de trabajos SIPS con un hilo ejecutor"""
+
+    def __init__(
+        self,
+        process_chunk: Callable[[List[Dict[str, Any]], Dict[str, Any]], List[Dict[str, Any]]],
+        db_path: str = None,
+        chunk_size: int = None,
+        poll_interval: float = 2.0
+    ):
+        """
+        Args:
+            process_chunk: Procesa una lista de elementos {'cups', 'invoice_id'}
+                con las opciones del trabajo y devuelve un resultado por
+                elemento, en el mismo orden (cada uno con 'success')
+            db_path: Fichero SQLite (default: SIPS_JOBS_DB o sips_jobs.sqlite3)
+            chunk_size: CUPS por bloque procesado y guardado (default: SIPS_JOBS_CHUNK_SIZE o 200)
+            poll_interval: Segundos entre comprobaciones de trabajos nuevos
+        """
+        self.process_chunk = process_chunk
+        self.db_path = db_path or os.getenv('SIPS_JOBS_DB', 'sips_jobs.sqlite3')
+        self.chunk_size = chunk_size or int(os.getenv('SIPS_JOBS_CHUNK_SIZE', 200))
+        self.poll_interval = poll_interval
+
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock_file = None
+
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Conexión SQLite nueva (una por operación, válida entre hilos)"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def start(self) -> bool:
+        """
+        Arranca el ejecutor si este proceso obtiene el lock
+
+        Returns:
+            True si este proceso ejecuta los trabajos
+        """
+        if self._thread is not None:
+            return True
+
+        if fcntl is not None:
+            lock_file = open(f"{self.db_path}.lock", 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+
+        self._thread = threading.Thread(target=self._run, name='sips-jobs', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout: float = 30):
+        """Detiene el ejecutor al terminar el bloque en curso"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+    def submit(self, items: List[Dict[str, Any]], options: Dict[str, Any]) -> str:
+        """Crea un trabajo y devuelve su id"""
+        job_id = uuid.uuid4().hex
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, options, total, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(options), len(items), time.time())
+            )
+            conn.executemany(
+                "INSERT INTO job_items (job_id, idx, cups, invoice_id) VALUES (?, ?, ?, ?)",
+                (
+                    (job_id, i, item.get('cups'), item.get('invoice_id'))
+                    for i, item in enumerate(items)
+                )
+            )
+
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Estado de un trabajo: progreso, throughput y ETA"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        processed = row['done'] + row['failed']
+        throughput = None
+        eta_seconds = None
+
+        if row['resumed_at']:
+            end = row['finished_at'] or time.time()
+            elapsed = end - row['resumed_at']
+            if elapsed > 0:
+                throughput = round((processed - row['resumed_from']) / elapsed, 2)
+            if throughput and row['status'] != COMPLETED:
+                eta_seconds = round((row['total'] - processed) / throughput)
+
+        return {
+            'job_id': row['id'],
+            'status': row['status'],
+            'total': row['total'],
+            'processed': processed,
+            'succeeded': row['done'],
+            'failed': row['failed'],
+            'progress': round(processed / row['total'], 4) if row['total'] else 1.0,
+            'throughput_per_s': throughput,
+            'eta_seconds': eta_seconds,
+            'created_at': _iso(row['created_at']),
+            'started_at': _iso(row['started_at']),
+            'finished_at': _iso(row['finished_at']),
+            'options': json.loads(row['options']),
+        }
+
+    def iter_results(self, job_id: str, offset: int = 0, limit: int = None) -> Iterator[Dict[str, Any]]:
+        """Resultados ya procesados de un trabajo, en orden de cups_list"""
+        query = """
+            SELECT idx, cups, invoice_id, status, result
+            FROM job_items
+            WHERE job_id = ? AND idx >= ?
+            ORDER BY idx
+        """
+        params = [job_id, offset]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        conn = self._connect()
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    return
+                for row in rows:
+                    if row['result'] is not None:
+                        yield {'index': row['idx'], **json.loads(row['result'])}
+                    else:
+                        yield {
+                            'index': row['idx'],
+                            'cups': row['cups'],
+                            'invoice_id': row['invoice_id'],
+                            'status': 'pending'
+                        }
+        finally:
+            conn.close()
+
+    def _next_job(self) -> Optional[str]:
+        """Siguiente trabajo a ejecutar (primero los interrumpidos)"""
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                SELECT id FROM jobs
+                WHERE status IN (?, ?)
+                ORDER BY status = ? DESC, created_at
+                LIMIT 1
+                """,
+                (RUNNING, QUEUED, RUNNING)
+            ).fetchone()
+        return row['id'] if row else None
+
+    def _run(self):
+        """Hilo ejecutor"""
+        while not self._stop.is_set():
+            job_id = self._next_job()
+            if job_id is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._run_job(job_id)
+            except Exception as e:
+                logger.exception("❌ Error ejecutando trabajo %s: %s", job_id, e, extra={'job_id': job_id})
+                self._stop.wait(self.poll_interval)
+
+    def _run_job(self, job_id: str):
+        """Procesa los CUPS pendientes de un trabajo por bloques"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT options FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            conn.execute(
+                """
+                UPDATE jobs
+                SET status = ?, started_at = COALESCE(started_at, ?),
+                    resumed_at = ?, resumed_from = done + failed
+                WHERE id = ?
+                """,
+                (RUNNING, now, now, job_id)
+            )
+        options = json.loads(row['options'])
+
+        logger.info("⚙️  Ejecutando trabajo %s", job_id, extra={'job_id': job_id})
+
+        while not self._stop.is_set():
+            with self._connect() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT idx, cups, invoice_id FROM job_items
+                    WHERE job_id = ? AND status = 'pending'
+                    ORDER BY idx
+                    LIMIT ?
+                    """,
+                    (job_id, self.chunk_size)
+                ).fetchall()
+
+            if not rows:
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?",
+                        (COMPLETED, time.time(), job_id)
+                    )
+                logger.info("✅ Trabajo %s completado", job_id, extra={'job_id': job_id})
+                return
+
+            items = [{'cups': r['cups'], 'invoice_id': r['invoice_id']} for r in rows]
+
+            try:
+                results = self.process_chunk(items, options)
+            except Exception as e:
+                results = [
+                    {'cups': item['cups'], 'invoice_id': item['invoice_id'], 'success': False, 'error': str(e)}
+                    for item in items
+                ]
+
+            ok = sum(1 for r in results if r.get('success'))
+
+            with self._connect() as conn:
+                conn.executemany(
+                    "UPDATE job_items SET status = ?, result = ? WHERE job_id = ? AND idx = ?",
+                    (
+                        ('done' if r.get('success') else 'failed', json.dumps(r, default=str), job_id, row['idx'])
+                        for row, r in zip(rows, results)
+                    )
+                )
+                conn.execute(
+                    "UPDATE jobs SET done = done + ?, failed = failed + ? WHERE id = ?",
+                    (ok, len(results) - ok, job_id)
+                )
@@ -0,0 +1,190 @@
+"""
+SIPS Logging - Logs con niveles, estructurados y sin bloquear
+==============================================================
+Los clientes y las APIs escriben con logging en lugar de print():
+
+    from sips_logging import get_logger
+    logger = get_logger(__name__)              # sips.client_crm, sips.api_crm...
+
+    logger.debug("✅ Datos SIPS obtenidos desde caché: %s", cups, extra={'cups': cups})
+
+Niveles:
+    DEBUG       Detalle de cada consulta (banners, orígenes, potencias...)
+    INFO        Arranque, conexiones, índices, spool, trabajos
+    WARNING     Degradación (CouchDB caído, índice sin crear...)
+    ERROR       Errores de consulta o de guardado
+
+Los mensajes se formatean con %s (no con f-strings): si el nivel está
+desactivado no se construye la cadena. Los campos de `extra` se añaden
+como claves en el formato JSON.
+
+setup_logging('cli') (main() de los clientes): texto tal cual en stdout,
+nivel DEBUG y escritura directa; es la salida de siempre y se intercala en
+orden con los print() del resultado.
+
+setup_logging('api') (al importar las APIs): nivel INFO, así que el detalle
+por petición está desactivado, y formato JSON, una línea por registro. El
+hilo de la petición solo mete el registro en una cola (QueueHandler) y un
+QueueListener lo escribe en stdout desde su propio hilo: un stdout lento
+(pipe de launchd o systemd) ya no añade latencia ni mezcla líneas de
+distintos hilos. Si la cola se llena (LOG_QUEUE_SIZE) el registro se
+descarta y se cuenta en sips_log_records_dropped_total.
+
+Variables de entorno:
+    LOG_LEVEL       Nivel de los loggers sips.* (DEBUG activa el detalle por
+                    petición en la API)
+    LOG_FORMAT      json | text (por defecto json en la API, text en la CLI)
+    LOG_QUEUE_SIZE  Registros en cola antes de descartar (API, 10000)
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+from sips_metrics import LOG_DROPPED, REGISTRY
+
+ROOT_LOGGER = 'sips'
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s'
+
+# Atributos propios de LogRecord: el resto viene de `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_lock = threading.Lock()
+_listener: Optional[logging.handlers.QueueListener] = None
+_mode: Optional[str] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Logger del módulo `name` dentro de la jerarquía sips.* (sips_client_crm
+    -> sips.client_crm)
+    """
+    if name.startswith('sips_'):
+        name = name[len('sips_'):]
+    elif name == '__main__':
+        name = 'main'
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro: ts, level, logger, msg y los campos de extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca espera: con la cola llena descarta el registro
+    (y lo cuenta) en lugar de bloquear el hilo de la petición
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # El mensaje y el traceback se formatean en el hilo que registra (los
+        # argumentos pueden cambiar antes de que escriba el listener); el
+        # traceback va aparte para que el formato JSON lo ponga en 'exc'
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+def _formatter(fmt: str, mode: str) -> logging.Formatter:
+    if fmt == 'json':
+        return JsonFormatter()
+    if mode == 'cli':
+        return logging.Formatter('%(message)s')
+    return logging.Formatter(TEXT_FORMAT)
+
+
+def setup_logging(mode: str = 'api', level: Optional[str] = None, fmt: Optional[str] = None):
+    """
+    Configura los loggers sips.* (solo la primera llamada tiene efecto)
+
+    Args:
+        mode: 'api' (cola + hilo escritor, INFO, JSON) o 'cli' (stdout
+            directo, DEBUG, texto)
+        level: Nivel (por defecto LOG_LEVEL o el del modo)
+        fmt: 'json' o 'text' (por defecto LOG_FORMAT o el del modo)
+    """
+    global _listener, _mode
+
+    with _lock:
+        if _mode is not None:
+            return
+        _mode = mode
+
+        level = (level or os.getenv('LOG_LEVEL') or ('DEBUG' if mode == 'cli' else 'INFO')).upper()
+        fmt = (fmt or os.getenv('LOG_FORMAT') or ('text' if mode == 'cli' else 'json')).lower()
+
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(_formatter(fmt, mode))
+
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(level)
+        logger.propagate = False
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+
+        if mode == 'cli':
+            logger.addHandler(stream_handler)
+            return
+
+        log_queue = queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+        logger.addHandler(DroppingQueueHandler(log_queue))
+
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+        REGISTRY.gauge(
+            'sips_log_queue_records',
+            'Registros de log pendientes de escribir',
+            (),
+            log_queue.qsize
+        )
+
+
+def stop_logging():
+    """Escribe lo que quede en la cola y detiene el hilo escritor"""
+    global _listener
+
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
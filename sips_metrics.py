@@ -0,0 +1,507 @@
+"""
+SIPS Metrics - Métricas en formato Prometheus
+==============================================
+Contadores, gauges e histogramas en memoria, sin dependencias externas,
+que las APIs exponen en GET /metrics (formato de texto de Prometheus 0.0.4).
+
+Los clientes SIPS miden cada etapa de get_sips_history con stage():
+
+    with stage('sips_cache_query'):
+        cursor.execute(query, (cups,))
+        row = cursor.fetchone()
+
+(o con el decorador @timed('etapa') para un método entero) y cuentan
+aciertos y fallos de cada origen de datos con count_lookup():
+
+    count_lookup('sips_cache', 'hit')
+
+Etapas (etiqueta stage de sips_stage_duration_seconds):
+    db_connect          Obtener una conexión del pool MySQL
+    sips_cache_query    Consulta a sips_cache (uno o varios CUPS)
+    json_parse          json.loads de sips_cache.data
+    consumos_query      Consulta y lectura de consumos_historicos
+    invoice_lookup      Consulta a invoices
+    couch_read          Lectura del documento más reciente en CouchDB
+    couch_write         Guardado (o encolado) en CouchDB
+    optimize            Optimización de potencias
+    serialize           Serialización de la respuesta JSON (APIs)
+    summary             get_sips_summary completo
+    get_sips_history    get_sips_history completo
+
+Las mismas etapas alimentan el desglose por petición: mientras hay un
+StageTimings activo en el contexto (collect_timings()), cada etapa medida
+en esa petición se suma también ahí. Las APIs lo envían en la cabecera
+Server-Timing y, si se pide, en "timings" del JSON. Los hilos que trabajan
+para la petición deben ejecutarse con contextvars.copy_context().run (ver
+sips_batch.iter_batch); las tareas asyncio heredan el contexto solas.
+
+Coste en la ruta caliente: dos perf_counter(), una búsqueda binaria en los
+buckets y un lock sin contención por etapa (unos pocos µs).
+
+Las métricas son del proceso: con gunicorn cada worker tiene las suyas y
+/metrics devuelve las del worker que atiende la petición.
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import asyncio
+import contextvars
+import functools
+import math
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Segundos: de 0,5 ms (caché en memoria) a 30 s (consumos de muchos meses)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# CUPS por batch
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Metric:
+    """Base de las métricas: nombre, ayuda y nombres de etiquetas"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[Any, ...], float]]:
+        """Muestras como (sufijo, nombres de etiquetas, valores, valor)"""
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        """Líneas en formato de texto de Prometheus"""
+        lines = [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """Contador monótono, uno por combinación de etiquetas (nombre acabado en _total)"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[Any, ...], float] = {}
+
+    def inc(self, *labelvalues: Any, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues: Any) -> float:
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [('', self.labelnames, labels, value) for labels, value in items]
+
+
+class Gauge(Metric):
+    """
+    Valor que sube y baja
+
+    Con `function` el valor se calcula al leer /metrics: la función
+    devuelve un número o un dict {tupla de valores de etiquetas: número}.
+    """
+
+    kind = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], Any]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._values: Dict[Tuple[Any, ...], float] = {}
+
+    def inc(self, *labelvalues: Any, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues: Any, amount: float = 1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value: float, *labelvalues: Any):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def value(self, *labelvalues: Any) -> float:
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                result = self.function()
+            except Exception:
+                return []
+            if result is None:
+                return []
+            items = result.items() if isinstance(result, dict) else [((), result)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return [('', self.labelnames, labels, value) for labels, value in items if value is not None]
+
+
+class Histogram(Metric):
+    """Histograma con buckets fijos, uno por combinación de etiquetas"""
+
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        self._series: Dict[Tuple[Any, ...], list] = {}  # etiquetas -> [cuentas por bucket, suma]
+
+    def observe(self, value: float, *labelvalues: Any):
+        # Índice del primer bucket con límite >= value (le es inclusivo)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labelvalues: Any) -> int:
+        with self._lock:
+            series = self._series.get(labelvalues)
+            return sum(series[0]) if series else 0
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+
+        bucket_names = self.labelnames + ('le',)
+        samples = []
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(('_bucket', bucket_names, labels + (_format_value(bound),), cumulative))
+            samples.append(('_sum', self.labelnames, labels, total))
+            samples.append(('_count', self.labelnames, labels, cumulative))
+        return samples
+
+
+class Registry:
+    """Conjunto de métricas que se exponen juntas"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Añade una métrica (si ya existe una con ese nombre, la sustituye)"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], Any]] = None
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Todas las métricas en formato de texto de Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'sips_stage_duration_seconds',
+    'Duración de cada etapa de get_sips_history',
+    ('stage',)
+)
+LOOKUPS = REGISTRY.counter(
+    'sips_lookups_total',
+    'Consultas por origen de datos (result_cache, negative_cache, couchdb, sips_cache, consumos_historicos) y resultado',
+    ('source', 'result')
+)
+COUCH_ERRORS = REGISTRY.counter(
+    'sips_couchdb_errors_total',
+    'Errores de CouchDB por operación (read, write, bulk, spool)',
+    ('operation',)
+)
+BATCH_SIZE = REGISTRY.histogram(
+    'sips_batch_size',
+    'CUPS por petición de batch',
+    ('endpoint',),
+    BATCH_BUCKETS
+)
+HTTP_INFLIGHT = REGISTRY.gauge(
+    'sips_http_requests_in_flight',
+    'Peticiones HTTP en curso',
+    ('endpoint',)
+)
+HTTP_REQUESTS = REGISTRY.counter(
+    'sips_http_requests_total',
+    'Peticiones HTTP atendidas',
+    ('endpoint', 'method', 'status')
+)
+HTTP_SECONDS = REGISTRY.histogram(
+    'sips_http_request_duration_seconds',
+    'Duración de las peticiones HTTP (sin el cuerpo en streaming)',
+    ('endpoint',)
+)
+LOG_DROPPED = REGISTRY.counter(
+    'sips_log_records_dropped_total',
+    'Registros de log descartados con la cola de logs llena'
+)
+
+
+class StageTimings:
+    """
+    Tiempo acumulado por etapa de una petición (thread-safe: en un batch
+    varios hilos suman a la vez, así que los tiempos pueden superar al total)
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self._stages: Dict[str, List[float]] = {}  # etapa -> [segundos, veces]
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            entry = self._stages.get(name)
+            if entry is None:
+                self._stages[name] = [seconds, 1]
+            else:
+                entry[0] += seconds
+                entry[1] += 1
+
+    def as_dict(self) -> Dict[str, float]:
+        """Milisegundos por etapa, en orden de aparición, más 'total' hasta ahora"""
+        with self._lock:
+            stages = {name: round(seconds * 1000, 3) for name, (seconds, _) in self._stages.items()}
+        stages['total'] = round((time.perf_counter() - self.start) * 1000, 3)
+        return stages
+
+    def server_timing(self) -> str:
+        """Valor de la cabecera Server-Timing (desc = veces si la etapa se repite)"""
+        with self._lock:
+            items = [(name, seconds, count) for name, (seconds, count) in self._stages.items()]
+
+        parts = [
+            f"{name};dur={seconds * 1000:.3f}" + (f';desc="x{count}"' if count > 1 else '')
+            for name, seconds, count in items
+        ]
+        parts.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.3f}")
+        return ', '.join(parts)
+
+
+_current_timings: contextvars.ContextVar = contextvars.ContextVar('sips_stage_timings', default=None)
+
+
+def collect_timings(timings: Optional[StageTimings] = None) -> StageTimings:
+    """
+    Activa un StageTimings (nuevo si no se pasa) en el contexto actual: las
+    etapas que se midan a partir de aquí se suman también en él
+    """
+    timings = timings if timings is not None else StageTimings()
+    _current_timings.set(timings)
+    return timings
+
+
+def stop_timings():
+    """Desactiva el desglose por petición en el contexto actual"""
+    _current_timings.set(None)
+
+
+def current_timings() -> Optional[StageTimings]:
+    """StageTimings activo en el contexto actual, o None"""
+    return _current_timings.get()
+
+
+def observe_stage(name: str, seconds: float):
+    """Registra la duración de una etapa medida fuera de stage()"""
+    STAGE_SECONDS.observe(seconds, name)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+class stage:
+    """
+    Context manager que mide una etapa en sips_stage_duration_seconds
+
+    Se registra también si el bloque lanza una excepción. Es una clase y
+    no un @contextmanager para no crear un generador por etapa.
+    """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe_stage(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timed(name: str):
+    """Decorador que mide la llamada completa como la etapa `name` (también async)"""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_lookup(source: str, result: str, amount: int = 1):
+    """Cuenta consultas a `source` con resultado hit, miss o error"""
+    if amount:
+        LOOKUPS.inc(source, result, amount=amount)
+
+
+def count_couch_error(operation: str, amount: int = 1):
+    """Cuenta errores de CouchDB de una operación (read, write, bulk, spool)"""
+    if amount:
+        COUCH_ERRORS.inc(operation, amount=amount)
+
+
+def observe_batch(endpoint: str, size: int):
+    """Registra el tamaño de un batch"""
+    BATCH_SIZE.observe(size, endpoint)
+
+
+def request_started(endpoint: str) -> float:
+    """Marca el inicio de una petición HTTP; devuelve el instante para request_finished"""
+    HTTP_INFLIGHT.inc(endpoint)
+    return time.perf_counter()
+
+
+def request_finished(endpoint: str, method: str, status: int, started: float):
+    """Marca el fin de una petición empezada con request_started"""
+    HTTP_INFLIGHT.dec(endpoint)
+    HTTP_REQUESTS.inc(endpoint, method, str(status))
+    HTTP_SECONDS.observe(time.perf_counter() - started, endpoint)
+
+
+def register_client_gauges(get_client: Callable[[], Any]):
+    """
+    Gauges calculados al leer /metrics a partir del cliente SIPS de la API
+    (pool MySQL, spool de CouchDB y cachés en memoria)
+
+    Args:
+        get_client: Función que devuelve el cliente, o None si aún no existe
+    """
+    def from_stats(method: str, keys: Dict[str, str]) -> Callable[[], Optional[Dict[Tuple[str], float]]]:
+        def read():
+            client = get_client()
+            if client is None or not hasattr(client, method):
+                return None
+            stats = getattr(client, method)()
+            if not stats.get('connected', stats.get('enabled', True)):
+                return None
+            return {(label,): stats[key] for label, key in keys.items() if stats.get(key) is not None}
+        return read
+
+    REGISTRY.gauge(
+        'sips_db_pool_connections',
+        'Conexiones del pool MySQL por estado',
+        ('state',),
+        from_stats('pool_stats', {'in_use': 'in_use', 'idle': 'idle', 'max': 'size'})
+    )
+    REGISTRY.gauge(
+        'sips_result_cache_entries',
+        'Entradas de las cachés en memoria',
+        ('cache',),
+        lambda: {**(from_stats('cache_stats', {'result': 'entries'})() or {}),
+                 **(from_stats('negative_cache_stats', {'negative': 'entries'})() or {})}
+    )
+    REGISTRY.gauge(
+        'sips_singleflight_in_flight',
+        'Consultas en curso que otras peticiones pueden compartir',
+        (),
+        lambda: (get_client().inflight_stats()['in_flight'] if get_client() is not None else None)
+    )
+    REGISTRY.gauge(
+        'sips_couch_spool_documents',
+        'Documentos en el spool de CouchDB por estado',
+        ('state',),
+        from_stats('spool_stats', {'pending': 'depth', 'dead': 'dead_in_spool'})
+    )
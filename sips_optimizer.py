@@ -0,0 +1,248 @@
+"""
+SIPS Optimizer - Optimización de potencias contratadas
+=======================================================
+Busca las potencias contratadas P1..P6 que minimizan el coste anual de
+potencia a partir de current_powers y demand_data:
+
+    coste = término de potencia + penalización por excesos
+
+    término de potencia  = Σp  precio_p · Pc_p · días / 365
+    excesos (Circular 3/2020, por mes y periodo)
+                         = Σp Σmes  Kp · tep · sqrt( Σj (Pd_j - Pc_p)² )   para Pd_j > Pc_p
+
+La evaluación es vectorizada: las demandas de cada (periodo, mes) se
+ordenan una vez y, con sumas acumuladas de Pd y Pd², la suma de excesos
+al cuadrado de cualquier potencia candidata se obtiene con una búsqueda
+binaria. Con 6 periodos se respeta P1 <= P2 <= ... <= P6 mediante
+programación dinámica sobre la rejilla de candidatos.
+
+Los precios por defecto son aproximados (peajes + cargos 3.0TD, sin
+margen de comercializadora). Configurables con SIPS_POWER_PRICES
+(€/kW·año separados por comas, P1..P6) y SIPS_EXCESS_TEP (€/kW).
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from sips_columnar import HAS_NUMPY, DemandColumns, columns_from_demand_data, reading_interval_hours
+
+if HAS_NUMPY:
+    import numpy as np
+
+PERIODS = ('P1', 'P2', 'P3', 'P4', 'P5', 'P6')
+
+# €/kW·año (aproximados, ajustar con SIPS_POWER_PRICES)
+DEFAULT_POWER_PRICES = (19.46, 10.15, 4.37, 3.79, 2.49, 1.44)
+
+# Coeficientes Kp de la Circular 3/2020 para 6 periodos
+DEFAULT_KP = (1.0, 0.5, 0.37, 0.37, 0.37, 0.17)
+
+DEFAULT_TEP = 1.4064  # €/kW
+
+
+def _env_floats(name: str, default: Sequence[float]) -> List[float]:
+    value = os.getenv(name)
+    if not value:
+        return list(default)
+    return [float(v) for v in value.split(',')]
+
+
+def _sort_key(period: str):
+    return (len(period), period)
+
+
+class _PeriodDemand:
+    """Demandas de un periodo agrupadas por mes, ordenadas y con sumas acumuladas"""
+
+    __slots__ = ('groups',)
+
+    def __init__(self, demand, months):
+        self.groups = []
+        order = np.lexsort((demand, months))
+        demand, months = demand[order], months[order]
+        bounds = np.flatnonzero(np.diff(months)) + 1
+        for values in np.split(demand, bounds):
+            s1 = np.concatenate(([0.0], np.cumsum(values)))
+            s2 = np.concatenate(([0.0], np.cumsum(values * values)))
+            self.groups.append((values, s1, s2))
+
+    def excess_cost(self, candidates, kp: float, tep: float):
+        """Penalización por excesos para cada potencia candidata"""
+        cost = np.zeros(len(candidates))
+        for values, s1, s2 in self.groups:
+            n = len(values)
+            below = np.searchsorted(values, candidates, side='right')
+            above = n - below
+            sum1 = s1[n] - s1[below]
+            sum2 = s2[n] - s2[below]
+            squares = sum2 - 2 * candidates * sum1 + above * candidates * candidates
+            cost += np.sqrt(np.maximum(squares, 0.0))
+        return kp * tep * cost
+
+
+def _monotonic_path(costs):
+    """
+    Índices de rejilla no decrecientes (P1 <= P2 <= ...) de coste mínimo
+
+    costs: matriz (periodos x candidatos) con rejilla ordenada
+    """
+    n_periods, n_candidates = costs.shape
+    index = np.arange(n_candidates)
+    best = costs[0].copy()
+    back = []
+
+    for p in range(1, n_periods):
+        prefix_min = np.minimum.accumulate(best)
+        prefix_arg = np.maximum.accumulate(np.where(best == prefix_min, index, 0))
+        back.append(prefix_arg)
+        best = costs[p] + prefix_min
+
+    path = [int(np.argmin(best))]
+    for prefix_arg in reversed(back):
+        path.append(int(prefix_arg[path[-1]]))
+    path.reverse()
+    return path
+
+
+def optimize_powers(
+    columns: DemandColumns,
+    current_powers: Optional[Dict[str, float]] = None,
+    prices: Optional[Sequence[float]] = None,
+    kp: Optional[Sequence[float]] = None,
+    tep: Optional[float] = None,
+    grid_size: Optional[int] = None,
+    min_power: Optional[float] = None,
+    monotonic: Optional[bool] = None
+) -> Dict[str, Any]:
+    """
+    Calcula las potencias óptimas y el ahorro frente a las actuales
+
+    Args:
+        columns: demand_data en columnas (sips_columnar)
+        current_powers: Potencias contratadas actuales {'P1': kW, ...}
+        prices: Precio del término de potencia por periodo (€/kW·año)
+        kp: Coeficientes Kp de excesos por periodo
+        tep: Término de exceso de potencia (€/kW)
+        grid_size: Potencias candidatas evaluadas por periodo
+        min_power: Potencia mínima contratable (kW, default: SIPS_MIN_POWER o 0)
+        monotonic: Exigir P1 <= ... <= Pn (default: si hay 6 periodos)
+
+    Returns:
+        Dict con optimal_powers, costes actual y óptimo y ahorro
+    """
+    start = time.perf_counter()
+
+    prices = list(prices or _env_floats('SIPS_POWER_PRICES', DEFAULT_POWER_PRICES))
+    kp = list(kp or DEFAULT_KP)
+    tep = tep if tep is not None else float(os.getenv('SIPS_EXCESS_TEP', DEFAULT_TEP))
+    grid_size = grid_size or int(os.getenv('SIPS_OPTIMIZER_GRID', 400))
+    if min_power is None:
+        min_power = float(os.getenv('SIPS_MIN_POWER', 0))
+    current_powers = current_powers or {}
+
+    periods = sorted(columns.periods, key=_sort_key)
+    if monotonic is None:
+        monotonic = len(periods) == len(PERIODS)
+
+    demand = columns.potencia_maxima
+    peak = float(demand.max()) if len(demand) else 0.0
+    if peak <= 0:
+        return {'error': 'Sin datos de potencia demandada'}
+
+    # Días cubiertos por las lecturas (para prorratear el término de potencia)
+    fechas = columns.fecha[~np.isnat(columns.fecha)]
+    interval = reading_interval_hours(columns)
+    if len(fechas):
+        span = float((fechas.max() - fechas.min()).astype('timedelta64[s]').astype(np.float64)) / 86400
+        days = max(span + (interval or 0.0) / 24, 1.0)
+    else:
+        days = 365.0
+
+    months = columns.fecha.astype('datetime64[M]').astype(np.int64)
+    grid = np.unique(np.round(np.linspace(min_power, max(peak, min_power), grid_size), 3))
+
+    def settings(period: str):
+        i = PERIODS.index(period) if period in PERIODS else None
+        price = prices[i] if i is not None and i < len(prices) else prices[-1]
+        k = kp[i] if i is not None and i < len(kp) else 1.0
+        return price, k
+
+    demands = {}
+    power_costs = []
+    excess_costs = []
+
+    for period in periods:
+        mask = columns.period_mask(period)
+        demands[period] = _PeriodDemand(demand[mask], months[mask])
+        price, k = settings(period)
+        power_costs.append(price * grid * days / 365)
+        excess_costs.append(demands[period].excess_cost(grid, k, tep))
+
+    power_costs = np.array(power_costs)
+    excess_costs = np.array(excess_costs)
+    total = power_costs + excess_costs
+
+    if monotonic:
+        path = _monotonic_path(total)
+    else:
+        path = [int(i) for i in np.argmin(total, axis=1)]
+
+    optimal_powers = {period: float(grid[g]) for period, g in zip(periods, path)}
+    optimal_power_term = float(sum(power_costs[p, g] for p, g in enumerate(path)))
+    optimal_excess = float(sum(excess_costs[p, g] for p, g in enumerate(path)))
+
+    result = {
+        'method': 'grid_dp' if monotonic else 'grid',
+        'periods': periods,
+        'days': round(days, 1),
+        'reading_interval_hours': interval,
+        'optimal_powers': optimal_powers,
+        'optimal_cost': {
+            'power_term': round(optimal_power_term, 2),
+            'excess': round(optimal_excess, 2),
+            'total': round(optimal_power_term + optimal_excess, 2),
+        },
+        'current_powers': {p: current_powers.get(p) for p in periods},
+        'current_cost': None,
+        'savings': None,
+        'savings_pct': None,
+    }
+
+    if interval is not None and interval > 0.25:
+        # La fórmula de excesos está pensada para demandas cuartohorarias
+        result['warning'] = 'Lecturas no cuartohorarias: excesos estimados, resultado orientativo'
+
+    if all(current_powers.get(p) is not None for p in periods):
+        current_power_term = 0.0
+        current_excess = 0.0
+        for period in periods:
+            power = float(current_powers[period])
+            price, k = settings(period)
+            current_power_term += price * power * days / 365
+            current_excess += float(demands[period].excess_cost(np.array([power]), k, tep)[0])
+
+        current_total = current_power_term + current_excess
+        savings = current_total - result['optimal_cost']['total']
+        result['current_cost'] = {
+            'power_term': round(current_power_term, 2),
+            'excess': round(current_excess, 2),
+            'total': round(current_total, 2),
+        }
+        result['savings'] = round(savings, 2)
+        result['savings_pct'] = round(savings / current_total * 100, 2) if current_total else None
+
+    result['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    return result
+
+
+def optimize_sips_data(sips_data: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+    """optimize_powers() a partir de un resultado de get_sips_history"""
+    if not HAS_NUMPY:
+        return {'error': 'NumPy no está instalado (pip install numpy)'}
+
+    columns = columns_from_demand_data(sips_data.get('demand_data') or [])
+    return optimize_powers(columns, sips_data.get('current_powers'), **kwargs)
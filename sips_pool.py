@@ -0,0 +1,236 @@
+"""
+SIPS Pool - Pool de conexiones MySQL thread-safe
+=================================================
+Pool de conexiones compartido por los clientes SIPS. Cada llamada obtiene
+su propia conexión, de forma que varios hilos de Flask pueden consultar
+MySQL en paralelo sin compartir cursores.
+
+Características:
+    - Tamaño máximo configurable (las peticiones esperan si está lleno)
+    - Health check (ping) de conexiones que llevan tiempo inactivas
+    - Reciclado de conexiones inactivas demasiado tiempo
+    - Estadísticas de uso (stats()); el tiempo de obtener conexión se
+      registra en la etapa db_connect de sips_metrics
+    - Consultas en streaming con cursor sin buffer (iter_query())
+
+Autor: Aenergetic
+Fecha: 2026-10-16
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Sequence
+
+import mysql.connector
+from mysql.connector import Error
+from mysql.connector.errors import PoolError
+
+from sips_metrics import observe_stage
+
+
+class MySQLPool:
+    """Pool de conexiones MySQL con health check y reciclado"""
+
+    def __init__(
+        self,
+        size: int = 10,
+        recycle: int = 300,
+        health_check_interval: int = 30,
+        timeout: float = 10,
+        **connect_args
+    ):
+        """
+        Inicializa el pool (las conexiones se crean bajo demanda)
+
+        Args:
+            size: Número máximo de conexiones abiertas
+            recycle: Segundos de inactividad tras los que se recicla una conexión
+            health_check_interval: Segundos de inactividad tras los que se hace ping
+            timeout: Segundos máximos de espera para obtener una conexión
+            connect_args: Argumentos para mysql.connector.connect()
+        """
+        self.size = size
+        self.recycle = recycle
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self.connect_args = dict(connect_args)
+        # Consultas de solo lectura: autocommit evita snapshots antiguos
+        # de InnoDB en conexiones que se reutilizan
+        self.connect_args.setdefault('autocommit', True)
+
+        self._idle = deque()  # (conexión, último uso)
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._stats = {
+            'created': 0,
+            'recycled': 0,
+            'health_check_failures': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'in_use': 0,
+        }
+
+    def _create(self):
+        """Abre una conexión nueva"""
+        conn = mysql.connector.connect(**self.connect_args)
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        """Cierra una conexión ignorando errores"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn) -> bool:
+        """Comprueba que una conexión sigue viva"""
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            with self._lock:
+                self._stats['health_check_failures'] += 1
+            return False
+
+    def acquire(self):
+        """Obtiene una conexión del pool (bloquea si está lleno)"""
+        if self._closed:
+            raise PoolError("El pool de conexiones está cerrado")
+
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['waits'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise PoolError(
+                    f"Timeout esperando conexión del pool ({self.size} en uso)"
+                )
+
+        try:
+            conn = None
+            while conn is None:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+
+                if entry is None:
+                    conn = self._create()
+                    break
+
+                candidate, last_used = entry
+                idle_for = time.monotonic() - last_used
+
+                if idle_for > self.recycle:
+                    self._close(candidate)
+                    with self._lock:
+                        self._stats['recycled'] += 1
+                    continue
+
+                if idle_for > self.health_check_interval and not self._is_healthy(candidate):
+                    self._close(candidate)
+                    continue
+
+                conn = candidate
+        except Exception:
+            self._slots.release()
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_time_total'] += elapsed
+        observe_stage('db_connect', elapsed)
+
+        return conn
+
+    def release(self, conn, discard: bool = False):
+        """Devuelve una conexión al pool"""
+        with self._lock:
+            self._stats['in_use'] -= 1
+
+        try:
+            if discard or self._closed or not conn.is_connected():
+                self._close(conn)
+                return
+
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager que presta una conexión durante un bloque
+
+        Ejemplo:
+            with pool.connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+        """
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except Error:
+            # Ante errores de MySQL no reutilizar la conexión
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def iter_query(self, query: str, params: Sequence[Any] = (), chunk_size: int = 1000) -> Iterator[tuple]:
+        """
+        Ejecuta una query y produce sus filas (tuplas) por bloques
+
+        Usa un cursor sin buffer: el servidor envía las filas según se leen
+        con fetchmany() y la memoria no depende del tamaño del resultado.
+        La conexión queda prestada hasta que el generador se agota o se
+        cierra; si se cierra antes de leer todas las filas, la conexión se
+        descarta porque tiene resultados pendientes.
+        """
+        conn = self.acquire()
+        discard = True
+        try:
+            cursor = conn.cursor(buffered=False)
+            cursor.execute(query, tuple(params))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+            cursor.close()
+            discard = False
+        finally:
+            self.release(conn, discard=discard)
+
+    def close(self):
+        """Cierra todas las conexiones inactivas y rechaza nuevas peticiones"""
+        self._closed = True
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas del pool"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+
+        checkouts = stats['checkouts']
+        stats['size'] = self.size
+        stats['avg_wait_ms'] = round(stats.pop('wait_time_total') / checkouts * 1000, 3) if checkouts else 0.0
+        stats['closed'] = self._closed
+        return stats
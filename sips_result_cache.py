@@ -0,0 +1,365 @@
+"""
+SIPS Result Cache - Caché en memoria de resultados SIPS
+========================================================
+Caché LRU con expiración (TTL) y límite de memoria aproximado para los
+resultados de get_sips_history. Evita volver a MySQL (y re-parsear el
+JSON de sips_cache) cuando n8n pide el mismo CUPS varias veces seguidas.
+
+Las claves son tuplas cuyo primer elemento es el CUPS, por ejemplo
+(cups, months, invoice_id), lo que permite invalidar por CUPS.
+
+NegativeCache guarda las claves que no tienen resultado (CUPS sin datos)
+con un TTL corto y su propio límite de entradas.
+
+Incluye también SingleFlight, que agrupa peticiones concurrentes con la
+misma clave en una sola ejecución cuyo resultado comparten todas, y su
+versión asyncio (AsyncSingleFlight, para sips_client_async).
+
+Autor: Aenergetic
+Fecha: 2026-10-16
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+def estimate_size(value: Any) -> int:
+    """Tamaño aproximado en bytes de un resultado (su JSON serializado)"""
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+class ResultCache:
+    """Caché LRU + TTL thread-safe con límite de bytes"""
+
+    def __init__(self, ttl: float = 300, max_bytes: int = 64 * 1024 * 1024):
+        """
+        Args:
+            ttl: Segundos de validez de cada entrada
+            max_bytes: Tamaño máximo aproximado de todas las entradas
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # clave -> (valor, expira, bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Devuelve el valor cacheado o None si no existe o ha expirado"""
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            value, expires_at, size = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Guarda un valor (desalojando los menos usados si no cabe)"""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, time.monotonic() + self.ttl, size)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+
+    def _remove(self, key: Hashable):
+        """Elimina una entrada (llamar con el lock adquirido)"""
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def invalidate(self, cups: Optional[str] = None) -> int:
+        """
+        Invalida las entradas de un CUPS, o todas si no se indica
+
+        Returns:
+            Número de entradas eliminadas
+        """
+        with self._lock:
+            if cups is None:
+                keys = list(self._entries)
+            else:
+                keys = [k for k in self._entries if isinstance(k, tuple) and k and k[0] == cups]
+
+            for key in keys:
+                self._remove(key)
+
+            self._stats['invalidations'] += len(keys)
+            return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['ttl'] = self.ttl
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+class NegativeCache:
+    """
+    Claves sin resultado (p. ej. CUPS desconocidos), thread-safe
+
+    Las entradas caducan a los `ttl` segundos y, como mucho, hay
+    `max_entries` (se desalojan las más antiguas). Además se vacía entera
+    cuando cambia la generación de los datos (set_generation), por ejemplo
+    MAX(date_add) de sips_cache: un CUPS nuevo deja de darse por inexistente
+    en cuanto aparece.
+    """
+
+    def __init__(self, ttl: float = 60, max_entries: int = 10000):
+        """
+        Args:
+            ttl: Segundos que se recuerda que una clave no tiene resultado
+            max_entries: Número máximo de claves
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._entries: "OrderedDict[Hashable, float]" = OrderedDict()  # clave -> expira
+        self._generation = None
+        self._lock = threading.Lock()
+
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'generation_changes': 0,
+        }
+
+    def contains(self, key: Hashable) -> bool:
+        """True si la clave está marcada como sin resultado y no ha caducado"""
+        with self._lock:
+            expires_at = self._entries.get(key)
+
+            if expires_at is None or expires_at <= time.monotonic():
+                if expires_at is not None:
+                    del self._entries[key]
+                self._stats['misses'] += 1
+                return False
+
+            self._stats['hits'] += 1
+            return True
+
+    def add(self, key: Hashable):
+        """Marca una clave como sin resultado"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.monotonic() + self.ttl
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def set_generation(self, generation: Any) -> bool:
+        """
+        Registra la generación actual de los datos; si ha cambiado respecto
+        a la anterior, vacía la caché
+
+        Returns:
+            True si se ha vaciado
+        """
+        with self._lock:
+            previous, self._generation = self._generation, generation
+            if previous is None or previous == generation:
+                return False
+
+            self._stats['generation_changes'] += 1
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+            return True
+
+    def invalidate(self, cups: Optional[str] = None) -> int:
+        """
+        Elimina las claves de un CUPS, o todas si no se indica
+
+        Returns:
+            Número de claves eliminadas
+        """
+        with self._lock:
+            if cups is None:
+                keys = list(self._entries)
+            else:
+                keys = [k for k in self._entries if isinstance(k, tuple) and k and k[0] == cups]
+
+            for key in keys:
+                del self._entries[key]
+
+            self._stats['invalidations'] += len(keys)
+            return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché negativa"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['generation'] = str(self._generation) if self._generation is not None else None
+
+        stats['ttl'] = self.ttl
+        stats['max_entries'] = self.max_entries
+        return stats
+
+
+class _Flight:
+    """Ejecución en curso de SingleFlight"""
+
+    __slots__ = ('done', 'value', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalescencia de llamadas concurrentes con la misma clave"""
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+        self._stats = {'leaders': 0, 'coalesced': 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Ejecuta fn() salvo que ya haya una ejecución en curso para `key`,
+        en cuyo caso espera a que termine y reutiliza su resultado
+
+        Returns:
+            (resultado, compartido) - compartido es True si el resultado
+            viene de la ejecución de otra llamada
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+                self._stats['leaders'] += 1
+            else:
+                flight.waiters += 1
+                leader = False
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.value, False
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas de coalescencia"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._flights)
+        return stats
+
+
+class AsyncSingleFlight:
+    """SingleFlight para corrutinas (un solo event loop, sin locks)"""
+
+    def __init__(self):
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+        self._stats = {'leaders': 0, 'coalesced': 0}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Espera fn() salvo que ya haya una ejecución en curso para `key`,
+        en cuyo caso espera a esa y reutiliza su resultado
+
+        Returns:
+            (resultado, compartido) como SingleFlight.do
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self._stats['coalesced'] += 1
+            # shield: si se cancela esta espera, la ejecución sigue para el resto
+            return await asyncio.shield(flight), True
+
+        # fn() corre en su propia tarea: cancelar al que la lanzó (cliente
+        # desconectado, wait_for vencido) no la cancela para los demás
+        flight = self._flights[key] = asyncio.ensure_future(fn())
+        self._stats['leaders'] += 1
+        flight.add_done_callback(lambda task: self._finish(key, task))
+
+        return await asyncio.shield(flight), False
+
+    def _finish(self, key: Hashable, task: asyncio.Future):
+        """Retira la ejecución terminada y marca su excepción como leída"""
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # Aunque no quede nadie esperando
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas de coalescencia"""
+        return {**self._stats, 'in_flight': len(self._flights)}
+
+
+def result_cache_from_env() -> Optional[ResultCache]:
+    """
+    Crea la caché según variables de entorno (None si está desactivada)
+
+    SIPS_RESULT_CACHE=true|false, SIPS_RESULT_CACHE_TTL (segundos),
+    SIPS_RESULT_CACHE_MAX_MB (megabytes)
+    """
+    if os.getenv('SIPS_RESULT_CACHE', 'false').lower() != 'true':
+        return None
+
+    return ResultCache(
+        ttl=float(os.getenv('SIPS_RESULT_CACHE_TTL', 300)),
+        max_bytes=int(float(os.getenv('SIPS_RESULT_CACHE_MAX_MB', 64)) * 1024 * 1024)
+    )
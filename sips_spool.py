@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+SIPS Spool - Escritura diferida (write-behind) a CouchDB
+=========================================================
+Con COUCHDB_WRITE_BEHIND=true los documentos no se envían a CouchDB dentro
+de la petición: se guardan en un spool SQLite local (COUCHDB_SPOOL_DB) y la
+petición responde al momento. Un hilo de fondo vacía el spool con
+_bulk_docs cada COUCHDB_SPOOL_INTERVAL segundos, o antes si se acumulan
+COUCHDB_BULK_SIZE documentos.
+
+Si CouchDB falla, los documentos siguen en el spool y se reintentan con
+backoff exponencial; tras COUCHDB_SPOOL_MAX_ATTEMPTS intentos pasan a
+'dead' y se pueden reencolar con --replay. Como el spool está en disco,
+lo pendiente se envía también tras reiniciar la API.
+
+Solo un proceso vacía el spool (el que obtiene el lock de `<db>.lock`); el
+resto de procesos, por ejemplo otros workers de la API, solo encolan.
+
+Uso:
+    python3 sips_spool.py --stats
+    python3 sips_spool.py --replay      # reencolar los documentos 'dead'
+    python3 sips_spool.py --drain       # enviar ya todo lo pendiente
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+from sips_couch import post_bulk_docs
+from sips_metrics import count_couch_error
+from sips_logging import get_logger, setup_logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: sin lock entre procesos
+
+logger = get_logger(__name__)
+
+# Estados de un documento del spool
+PENDING = 'pending'
+DEAD = 'dead'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc_id TEXT,
+    doc TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS spool_due ON spool (status, next_attempt, id);
+"""
+
+MAX_BACKOFF = 300  # segundos
+
+
+class CouchSpool:
+    """Cola persistente de documentos CouchDB con un hilo que la vacía"""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], requests.Session],
+        url: str,
+        path: str = None,
+        batch_size: int = 100,
+        interval: float = None,
+        timeout: float = 30,
+        compress: bool = False,
+        max_attempts: int = None,
+        on_result: Optional[Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]] = None
+    ):
+        """
+        Args:
+            session_factory: Devuelve la sesión HTTP de CouchDB
+            url: URL de la base de datos (https://host/db)
+            path: Fichero SQLite (default: COUCHDB_SPOOL_DB o couch_spool.sqlite3)
+            batch_size: Documentos por petición _bulk_docs
+            interval: Segundos entre vaciados (default: COUCHDB_SPOOL_INTERVAL o 2)
+            timeout: Timeout de cada petición HTTP
+            compress: Enviar los cuerpos comprimidos con gzip
+            max_attempts: Intentos antes de marcar un documento como 'dead'
+                (default: COUCHDB_SPOOL_MAX_ATTEMPTS o 20)
+            on_result: Recibe (documento, resultado de _bulk_docs) y devuelve
+                el resultado final (p. ej. resolver un 409 con CouchDedupe)
+        """
+        self.session_factory = session_factory
+        self.url = url
+        self.path = path or os.getenv('COUCHDB_SPOOL_DB', 'couch_spool.sqlite3')
+        self.batch_size = batch_size
+        self.interval = interval if interval is not None else float(os.getenv('COUCHDB_SPOOL_INTERVAL', 2))
+        self.timeout = timeout
+        self.compress = compress
+        self.max_attempts = max_attempts or int(os.getenv('COUCHDB_SPOOL_MAX_ATTEMPTS', 20))
+        self.on_result = on_result
+
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock_file = None
+        self._send_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._enqueued_since_drain = 0
+        self._stats = {'enqueued': 0, 'sent': 0, 'retried': 0, 'dead': 0, 'requests': 0}
+        self._last_error = None
+
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Conexión SQLite nueva (una por operación, válida entre hilos)"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def start(self) -> bool:
+        """
+        Arranca el hilo que vacía el spool si este proceso obtiene el lock
+
+        Returns:
+            True si este proceso vacía el spool
+        """
+        if self._thread is not None:
+            return True
+
+        if not self.acquire():
+            return False
+
+        self._thread = threading.Thread(target=self._run, name='couch-spool', daemon=True)
+        self._thread.start()
+        return True
+
+    def acquire(self) -> bool:
+        """Obtiene el lock de vaciado (un solo proceso envía el spool)"""
+        if self._lock_file is not None or fcntl is None:
+            return True
+
+        lock_file = open(f"{self.path}.lock", 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def stop(self, timeout: float = 10):
+        """Detiene el hilo (lo pendiente queda en disco)"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    @property
+    def draining(self) -> bool:
+        """True si este proceso vacía el spool"""
+        return self._thread is not None
+
+    def enqueue(self, document: Dict[str, Any]) -> int:
+        """Guarda un documento en el spool y devuelve su id en el spool"""
+        body = json.dumps(document, default=str, ensure_ascii=False)
+
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO spool (doc_id, doc, created_at) VALUES (?, ?, ?)',
+                (document.get('_id'), body, time.time())
+            )
+            spool_id = cursor.lastrowid
+
+        with self._lock:
+            self._stats['enqueued'] += 1
+            self._enqueued_since_drain += 1
+            full = self._enqueued_since_drain >= self.batch_size
+
+        if full:
+            self._wakeup.set()
+
+        return spool_id
+
+    def drain_once(self) -> int:
+        """
+        Envía un bloque de documentos pendientes cuyo reintento ya toca
+
+        Returns:
+            Número de documentos del bloque (0 si no había nada que enviar)
+        """
+        with self._send_lock:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    'SELECT id, doc, attempts FROM spool WHERE status = ? AND next_attempt <= ? ORDER BY id LIMIT ?',
+                    (PENDING, time.time(), self.batch_size)
+                ).fetchall()
+
+            if not rows:
+                return 0
+
+            with self._lock:
+                self._enqueued_since_drain = 0
+
+            docs = [json.loads(doc) for _, doc, _ in rows]
+            results = post_bulk_docs(self.session_factory(), self.url, docs, self.timeout, self.compress)
+
+            sent, retry, dead = [], [], []
+            now = time.time()
+
+            for (spool_id, _, attempts), doc, result in zip(rows, docs, results):
+                if self.on_result is not None:
+                    try:
+                        result = self.on_result(doc, result)
+                    except Exception as e:
+                        result = {'id': doc.get('_id'), 'ok': False, 'error': 'on_result', 'reason': str(e)}
+
+                if result['ok']:
+                    sent.append((spool_id,))
+                    continue
+
+                error = f"{result.get('error')}: {result.get('reason')}"
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    dead.append((DEAD, attempts, error, spool_id))
+                else:
+                    backoff = min(2 ** attempts, MAX_BACKOFF)
+                    retry.append((attempts, now + backoff, error, spool_id))
+                self._last_error = error
+
+            with self._connect() as conn:
+                conn.executemany('DELETE FROM spool WHERE id = ?', sent)
+                conn.executemany(
+                    'UPDATE spool SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?', retry
+                )
+                conn.executemany(
+                    'UPDATE spool SET status = ?, attempts = ?, last_error = ? WHERE id = ?', dead
+                )
+
+            with self._lock:
+                self._stats['requests'] += 1
+                self._stats['sent'] += len(sent)
+                self._stats['retried'] += len(retry)
+                self._stats['dead'] += len(dead)
+            count_couch_error('spool', len(retry) + len(dead))
+
+            if dead:
+                logger.error("❌ Spool CouchDB: %s documentos descartados tras %s intentos", len(dead), self.max_attempts)
+
+            return len(rows)
+
+    def drain(self, max_batches: Optional[int] = None) -> int:
+        """Envía bloques hasta que no quede nada pendiente que toque enviar"""
+        total = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            sent = self.drain_once()
+            if not sent:
+                break
+            total += sent
+            batches += 1
+        return total
+
+    def replay(self) -> int:
+        """Reencola los documentos 'dead' (y adelanta los reintentos pendientes)"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'UPDATE spool SET status = ?, attempts = 0, next_attempt = 0 WHERE status = ? OR next_attempt > ?',
+                (PENDING, DEAD, time.time())
+            )
+            count = cursor.rowcount
+        self._wakeup.set()
+        return count
+
+    def _run(self):
+        """Hilo de fondo: vacía el spool cada `interval` segundos o al llenarse un bloque"""
+        while not self._stop.is_set():
+            self._wakeup.wait(timeout=self.interval)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+
+            try:
+                # Tras una caída puede haber mucho pendiente: seguir mientras haya bloques llenos
+                while self.drain_once() >= self.batch_size and not self._stop.is_set():
+                    pass
+            except Exception as e:
+                self._last_error = str(e)
+                logger.error("❌ Error vaciando el spool de CouchDB: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        """Profundidad del spool y contadores de envío"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT status, COUNT(*), MIN(created_at) FROM spool GROUP BY status'
+            ).fetchall()
+            due = conn.execute(
+                'SELECT COUNT(*) FROM spool WHERE status = ? AND next_attempt <= ?',
+                (PENDING, time.time())
+            ).fetchone()[0]
+
+        by_status = {status: (count, oldest) for status, count, oldest in rows}
+        pending, oldest = by_status.get(PENDING, (0, None))
+
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats.update({
+            'depth': pending,
+            'due': due,
+            'waiting_retry': pending - due,
+            'dead_in_spool': by_status.get(DEAD, (0, None))[0],
+            'oldest_pending_age_s': round(time.time() - oldest, 1) if oldest else None,
+            'last_error': self._last_error,
+            'draining': self.draining,
+            'path': self.path,
+        })
+        return stats
+
+
+def main(argv: Optional[List[str]] = None):
+    """CLI: estado, replay y vaciado manual del spool"""
+    setup_logging('cli')
+
+    parser = argparse.ArgumentParser(description='Spool local de escrituras a CouchDB (COUCHDB_WRITE_BEHIND)')
+    parser.add_argument('--stats', action='store_true', help='Mostrar profundidad y errores del spool')
+    parser.add_argument('--replay', action='store_true', help="Reencolar los documentos 'dead'")
+    parser.add_argument('--drain', action='store_true', help='Enviar ya todo lo pendiente')
+    parser.add_argument('--crm', action='store_true', help='Usar la configuración del cliente CRM')
+    args = parser.parse_args(argv)
+
+    if args.crm:
+        from sips_client_crm import SIPSClient
+    else:
+        from sips_client import SIPSClient
+
+    client = SIPSClient()
+    spool = client.get_couch_spool(start=False)
+
+    if args.replay:
+        print(f"🔁 Reencolados: {spool.replay()}")
+
+    if args.drain or args.replay:
+        if spool.acquire():
+            print(f"📤 Enviados: {spool.drain()}")
+            spool.stop()
+        else:
+            print("⚠️  Otro proceso (la API) está vaciando el spool: enviará lo pendiente")
+
+    print(json.dumps(spool.stats(), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
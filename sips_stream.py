@@ -0,0 +1,103 @@
+"""
+SIPS Stream - Consumo incremental de consumos_historicos
+========================================================
+Utilidades para procesar las filas de iter_consumos_rows() según llegan
+de MySQL, sin cargar todo el histórico en memoria: conversión al formato
+de demand_data, agregación por periodo y exportación a NDJSON.
+
+Cada fila es una tupla:
+
+    (fecha_lectura, periodo, consumo_kwh, potencia_contratada, potencia_maxima)
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+import json
+from typing import Any, Dict, Iterable, Optional, TextIO
+
+CONSUMOS_COLUMNS = ('fecha_lectura', 'periodo', 'consumo_kwh', 'potencia_contratada', 'potencia_maxima')
+
+
+def demand_record(row: tuple) -> Dict[str, Any]:
+    """Fila de consumos_historicos -> elemento de demand_data"""
+    fecha, periodo, consumo_kwh, _, potencia_maxima = row
+    return {
+        'fecha': fecha.isoformat() if fecha else None,
+        'periodo': periodo,
+        'consumo_kwh': float(consumo_kwh) if consumo_kwh else 0,
+        'potencia_maxima': float(potencia_maxima) if potencia_maxima else 0,
+    }
+
+
+class ConsumosAggregator:
+    """Totales por periodo calculados fila a fila (memoria constante)"""
+
+    def __init__(self):
+        self.records = 0
+        self.first_date = None
+        self.last_date = None
+        self.periods: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, row: tuple):
+        """Acumula una fila"""
+        fecha, periodo, consumo_kwh, potencia_contratada, potencia_maxima = row
+        self.records += 1
+
+        if fecha is not None:
+            if self.first_date is None or fecha < self.first_date:
+                self.first_date = fecha
+            if self.last_date is None or fecha > self.last_date:
+                self.last_date = fecha
+
+        stats = self.periods.get(periodo)
+        if stats is None:
+            # Las filas llegan de la más reciente a la más antigua: la
+            # primera de cada periodo trae la potencia contratada actual
+            stats = self.periods[periodo] = {
+                'records': 0,
+                'consumo_kwh': 0.0,
+                'potencia_maxima': 0.0,
+                'potencia_contratada': float(potencia_contratada) if potencia_contratada else 0,
+            }
+
+        stats['records'] += 1
+        stats['consumo_kwh'] += float(consumo_kwh) if consumo_kwh else 0
+        if potencia_maxima and float(potencia_maxima) > stats['potencia_maxima']:
+            stats['potencia_maxima'] = float(potencia_maxima)
+
+    def result(self) -> Dict[str, Any]:
+        """Resumen acumulado"""
+        return {
+            'records': self.records,
+            'first_date': self.first_date.isoformat() if self.first_date else None,
+            'last_date': self.last_date.isoformat() if self.last_date else None,
+            'total_kwh': round(sum(p['consumo_kwh'] for p in self.periods.values()), 3),
+            'periods': {
+                periodo: {**stats, 'consumo_kwh': round(stats['consumo_kwh'], 3)}
+                for periodo, stats in sorted(self.periods.items(), key=lambda item: str(item[0]))
+            },
+        }
+
+
+def aggregate_consumos(rows: Iterable[tuple]) -> Dict[str, Any]:
+    """Agrega un iterable de filas por periodo"""
+    aggregator = ConsumosAggregator()
+    for row in rows:
+        aggregator.add(row)
+    return aggregator.result()
+
+
+def export_ndjson(rows: Iterable[tuple], out: TextIO, cups: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Escribe una línea JSON por fila (formato demand_data) y devuelve el
+    resumen agregado de lo exportado
+    """
+    aggregator = ConsumosAggregator()
+    for row in rows:
+        aggregator.add(row)
+        record = demand_record(row)
+        if cups:
+            record = {'cups': cups, **record}
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return aggregator.result()
@@ -0,0 +1,196 @@
+"""
+SIPS Summary - Resumen compacto por periodo y mes
+==================================================
+Muchos flujos de n8n solo necesitan totales y máximas por periodo, no el
+array demand_data completo. Este módulo construye ese resumen:
+
+    - Desde consumos_historicos, agregando en MySQL (GROUP BY mes, periodo)
+    - Desde el JSON de sips_cache, agregando demand_data en Python
+
+Las dos fuentes dan el mismo formato:
+
+    {
+        'cups': ..., 'source': 'consumos_historicos' | 'sips_cache',
+        'records': ..., 'first_date': ..., 'last_date': ..., 'total_kwh': ...,
+        'current_powers': {'P1': kW, ...},
+        'periods': {'P1': {'records', 'consumo_kwh', 'potencia_maxima', 'potencia_contratada'}, ...},
+        'monthly': {'2026-01': {'consumo_kwh': ..., 'periods': {'P1': {'consumo_kwh', 'potencia_maxima'}}}, ...}
+    }
+
+Autor: Aenergetic
+Fecha: 2026-10-17
+"""
+
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, Optional
+
+# Totales por (mes, periodo). DATE_FORMAT lleva %% porque la query tiene parámetros
+SUMMARY_QUERY = """
+    SELECT
+        DATE_FORMAT(fecha_lectura, '%%Y-%%m') AS mes,
+        periodo,
+        COUNT(*) AS registros,
+        SUM(consumo_kwh) AS consumo_kwh,
+        MAX(potencia_maxima) AS potencia_maxima,
+        MIN(fecha_lectura) AS primera_lectura,
+        MAX(fecha_lectura) AS ultima_lectura
+    FROM consumos_historicos
+    WHERE cups = %s
+    AND fecha_lectura >= %s
+    GROUP BY mes, periodo
+    ORDER BY mes, periodo
+"""
+
+# Potencia contratada de la lectura más reciente de cada periodo
+CURRENT_POWERS_QUERY = """
+    SELECT c.periodo, c.potencia_contratada
+    FROM consumos_historicos c
+    JOIN (
+        SELECT periodo, MAX(fecha_lectura) AS max_fecha
+        FROM consumos_historicos
+        WHERE cups = %s
+        AND fecha_lectura >= %s
+        GROUP BY periodo
+    ) latest
+    ON latest.periodo = c.periodo AND latest.max_fecha = c.fecha_lectura
+    WHERE c.cups = %s
+"""
+
+
+def _iso(value: Any) -> Optional[str]:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value) if value else None
+
+
+def _summary(
+    cups: str,
+    source: str,
+    groups: Dict[tuple, Dict[str, Any]],
+    current_powers: Dict[str, float],
+    first_date: Optional[str],
+    last_date: Optional[str]
+) -> Dict[str, Any]:
+    """Monta el resumen a partir de los totales por (mes, periodo)"""
+    periods: Dict[str, Dict[str, Any]] = {}
+    monthly: Dict[str, Dict[str, Any]] = {}
+
+    for (month, periodo), group in sorted(groups.items(), key=lambda item: (item[0][0] or '', item[0][1])):
+        stats = periods.setdefault(periodo, {
+            'records': 0,
+            'consumo_kwh': 0.0,
+            'potencia_maxima': 0.0,
+            'potencia_contratada': current_powers.get(periodo, 0),
+        })
+        stats['records'] += group['records']
+        stats['consumo_kwh'] += group['consumo_kwh']
+        stats['potencia_maxima'] = max(stats['potencia_maxima'], group['potencia_maxima'])
+
+        if month is None:
+            continue
+        entry = monthly.setdefault(month, {'consumo_kwh': 0.0, 'periods': {}})
+        entry['consumo_kwh'] += group['consumo_kwh']
+        entry['periods'][periodo] = {
+            'consumo_kwh': round(group['consumo_kwh'], 3),
+            'potencia_maxima': group['potencia_maxima'],
+        }
+
+    for stats in periods.values():
+        stats['consumo_kwh'] = round(stats['consumo_kwh'], 3)
+    for entry in monthly.values():
+        entry['consumo_kwh'] = round(entry['consumo_kwh'], 3)
+
+    return {
+        'cups': cups,
+        'source': source,
+        'records': sum(p['records'] for p in periods.values()),
+        'first_date': first_date,
+        'last_date': last_date,
+        'total_kwh': round(sum(p['consumo_kwh'] for p in periods.values()), 3),
+        'current_powers': current_powers,
+        'periods': dict(sorted(periods.items(), key=lambda item: (len(item[0]), item[0]))),
+        'monthly': monthly,
+        'query_date': datetime.now().isoformat(),
+    }
+
+
+def summary_from_aggregates(
+    cups: str,
+    rows: Iterable[tuple],
+    power_rows: Iterable[tuple]
+) -> Optional[Dict[str, Any]]:
+    """
+    Resumen a partir de las filas de SUMMARY_QUERY y CURRENT_POWERS_QUERY
+
+    Returns:
+        Resumen, o None si no hay lecturas
+    """
+    groups = {}
+    first_date = last_date = None
+
+    for month, periodo, records, consumo_kwh, potencia_maxima, first, last in rows:
+        groups[(month, str(periodo))] = {
+            'records': int(records),
+            'consumo_kwh': float(consumo_kwh or 0),
+            'potencia_maxima': float(potencia_maxima or 0),
+        }
+        if first is not None and (first_date is None or first < first_date):
+            first_date = first
+        if last is not None and (last_date is None or last > last_date):
+            last_date = last
+
+    if not groups:
+        return None
+
+    current_powers = {}
+    for periodo, potencia_contratada in power_rows:
+        # Empates en fecha_lectura: nos quedamos con la primera
+        current_powers.setdefault(str(periodo), float(potencia_contratada) if potencia_contratada else 0)
+
+    return _summary(cups, 'consumos_historicos', groups, current_powers, _iso(first_date), _iso(last_date))
+
+
+def summarize_demand_data(cups: str, sips_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Resumen de un resultado SIPS ya cargado (p. ej. el JSON de sips_cache),
+    agregando demand_data en Python
+
+    Returns:
+        Resumen, o None si no hay demand_data
+    """
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    first_date = last_date = None
+
+    for record in sips_data.get('demand_data') or []:
+        fecha = _iso(record.get('fecha'))
+        month = fecha[:7] if fecha else None
+
+        group = groups.get((month, str(record.get('periodo'))))
+        if group is None:
+            group = groups[(month, str(record.get('periodo')))] = {
+                'records': 0,
+                'consumo_kwh': 0.0,
+                'potencia_maxima': 0.0,
+            }
+
+        group['records'] += 1
+        group['consumo_kwh'] += float(record.get('consumo_kwh') or 0)
+        potencia = float(record.get('potencia_maxima') or 0)
+        if potencia > group['potencia_maxima']:
+            group['potencia_maxima'] = potencia
+
+        if fecha:
+            if first_date is None or fecha < first_date:
+                first_date = fecha
+            if last_date is None or fecha > last_date:
+                last_date = fecha
+
+    if not groups:
+        return None
+
+    current_powers = {
+        str(periodo): float(power) if power else 0
+        for periodo, power in (sips_data.get('current_powers') or {}).items()
+    }
+
+    return _summary(cups, 'sips_cache', groups, current_powers, first_date, last_date)